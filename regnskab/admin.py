@@ -4,7 +4,7 @@ from django.core.urlresolvers import reverse
 from django.utils.html import format_html
 from regnskab.models import (
     Alias, Transaction, Sheet, EmailTemplate, Session,
-    SheetImage, Newsletter,
+    SheetImage, Newsletter, SheetRow, ledger_changed,
 )
 
 
@@ -37,6 +37,20 @@ class TransactionAdmin(admin.ModelAdmin):
 
     has_delete_permission = has_change_permission
 
+    def save_model(self, request, obj, form, change):
+        old = Transaction.objects.filter(pk=obj.pk)
+        profile_ids = set(old.values_list('profile_id', flat=True))
+        periods = set(old.values_list('period', flat=True))
+        obj.save()
+        ledger_changed(profile_ids | {obj.profile_id},
+                       since=obj.created_time,
+                       periods=periods | {obj.period, obj.session.period})
+
+    def delete_model(self, request, obj):
+        obj.delete()
+        ledger_changed([obj.profile_id], since=obj.created_time,
+                       periods=(obj.period, obj.session.period))
+
 
 class SheetAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
@@ -49,6 +63,22 @@ class SheetAdmin(admin.ModelAdmin):
 
     has_delete_permission = has_change_permission
 
+    def save_model(self, request, obj, form, change):
+        periods = set(Sheet.objects.filter(pk=obj.pk).values_list(
+            'period', flat=True))
+        obj.save()
+        profile_ids = set(SheetRow.objects.filter(sheet=obj).values_list(
+            'profile_id', flat=True))
+        ledger_changed(profile_ids, since=obj.created_time,
+                       periods=periods | {obj.period, obj.session.period})
+
+    def delete_model(self, request, obj):
+        profile_ids = set(SheetRow.objects.filter(sheet=obj).values_list(
+            'profile_id', flat=True))
+        periods = (obj.period, obj.session.period)
+        obj.delete()
+        ledger_changed(profile_ids, since=obj.created_time, periods=periods)
+
 
 class EmailTemplateAdmin(admin.ModelAdmin):
     list_display = ('subject', 'created_time')
@@ -69,6 +99,19 @@ class SessionAdmin(admin.ModelAdmin):
 
     has_delete_permission = has_change_permission
 
+    def delete_model(self, request, obj):
+        profile_ids = set(SheetRow.objects.filter(
+            sheet__session=obj).values_list('profile_id', flat=True))
+        profile_ids |= set(Transaction.objects.filter(
+            session=obj).values_list('profile_id', flat=True))
+        periods = {obj.period}
+        periods |= set(Sheet.objects.filter(session=obj).values_list(
+            'period', flat=True))
+        periods |= set(Transaction.objects.filter(session=obj).values_list(
+            'period', flat=True))
+        obj.delete()
+        ledger_changed(profile_ids, since=obj.created_time, periods=periods)
+
     def item_link(self, obj):
         if obj.sent:
             return 'Udsendt %s' % (obj.send_time,)
@@ -1,6 +1,27 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
 
 
 class RegnskabConfig(AppConfig):
     name = 'regnskab'
     verbose_name = 'Regnskab'
+
+    def ready(self):
+        from regnskab.models import (
+            Profile, Title, Alias, SheetStatus, titles_changed,
+            search_object_saved, search_object_deleted,
+        )
+
+        for model in (Profile, Title, Alias, SheetStatus):
+            uid = 'regnskab.titles_changed.%s' % model.__name__
+            post_save.connect(titles_changed, sender=model,
+                              dispatch_uid=uid)
+            post_delete.connect(titles_changed, sender=model,
+                                dispatch_uid=uid)
+
+        for model in (Profile, Title, Alias):
+            uid = 'regnskab.search_index.%s' % model.__name__
+            post_save.connect(search_object_saved, sender=model,
+                              dispatch_uid=uid)
+            post_delete.connect(search_object_deleted, sender=model,
+                                dispatch_uid=uid)
@@ -0,0 +1,20 @@
+import time
+
+
+def best_of(fn, repeat=5, setup=None):
+    '''
+    Call fn() `repeat` times and return the pair
+    (fastest wall-clock time in seconds, result of the last call).
+    If given, setup() is called before each call of fn() and not timed.
+    '''
+    best = None
+    result = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t1 = time.perf_counter()
+        result = fn()
+        t2 = time.perf_counter()
+        if best is None or t2 - t1 < best:
+            best = t2 - t1
+    return best, result
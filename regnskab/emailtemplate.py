@@ -1,4 +1,7 @@
 import re
+import hashlib
+import threading
+from collections import OrderedDict
 
 
 def format_price(p):
@@ -13,6 +16,139 @@ def format_count(c):
     return ('%.2f' % c).rstrip('0').rstrip('.').replace('.', ',')
 
 
+# Variables are written #NAME#, where NAME starts with a capital letter.
+VARIABLE = re.compile(r'#([A-Z][^#]*)#')
+# The rest of a line starting with #SKJULNUL:# is hidden if any variable
+# in it is zero.
+HIDE_ZERO = re.compile(r'#SKJULNUL:#(.*\n?)')
+NEWLINE = re.compile(r'\r\n|\n|\r')
+BLANK_LINES = re.compile(r'\n\n+')
+
+COMPILED_CACHE_SIZE = 64
+
+
+def template_hash(template):
+    '''
+    Content hash of a template string, like EmailTemplateInline.compute_hash.
+    '''
+    algo = 'sha256'
+    hexdigest = getattr(hashlib, algo)(template.encode('utf8')).hexdigest()
+    return '%s-%s' % (algo, hexdigest)
+
+
+def _parse_variables(text):
+    '''
+    Split text into literal strings and variable names (as 1-tuples).
+
+    >>> _parse_variables('a #B# c #D')
+    ['a ', ('B',), ' c #D']
+    '''
+    segments = []
+    i = 0
+    for mo in VARIABLE.finditer(text):
+        if mo.start() > i:
+            segments.append(text[i:mo.start()])
+        segments.append((mo.group(1),))
+        i = mo.end()
+    if i < len(text):
+        segments.append(text[i:])
+    return segments
+
+
+class CompiledTemplate:
+    '''
+    A template parsed once into a list of segments: literal strings,
+    variables (1-tuples) and hide-zero lines (lists of literal strings and
+    variables), so that rendering it for each recipient is a single join.
+    '''
+
+    def __init__(self, template):
+        template = NEWLINE.sub('\n', template)
+        self.segments = []
+        i = 0
+        for mo in HIDE_ZERO.finditer(template):
+            self.segments.extend(_parse_variables(template[i:mo.start()]))
+            line = mo.group(1)
+            at_line_start = mo.start() == 0 or template[mo.start()-1] == '\n'
+            if line.endswith('\n') and not at_line_start:
+                # Hide the rest of the line, but keep the line break.
+                self.segments.append(_parse_variables(line[:-1]))
+                self.segments.append('\n')
+            else:
+                self.segments.append(_parse_variables(line))
+            i = mo.end()
+        self.segments.extend(_parse_variables(template[i:]))
+
+    def render(self, context):
+        parts = []
+        for s in self.segments:
+            if isinstance(s, str):
+                parts.append(s)
+            elif isinstance(s, tuple):
+                parts.append(context[s[0]])
+            elif not any(context[x[0]].strip('0,.') == ''
+                         for x in s if isinstance(x, tuple)):
+                parts.extend(x if isinstance(x, str) else context[x[0]]
+                             for x in s)
+        res = ''.join(parts)
+        if '\n\n\n' in res:
+            res = BLANK_LINES.sub('\n\n', res)
+        return res
+
+
+class ContentCache:
+    '''
+    LRU cache of fn(template) by template_hash(template), shared by the
+    threads of a process, so fn is computed once per distinct template
+    no matter how many sessions and newsletters use it.
+    '''
+
+    def __init__(self, fn, size=COMPILED_CACHE_SIZE):
+        self.fn = fn
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, template):
+        key = template_hash(template)
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                value = self.fn(template)
+                while len(self._items) >= self.size:
+                    self._items.popitem(last=False)
+            self._items[key] = value
+        return value
+
+
+def _html_to_plain(html):
+    from regnskab.utils import html_to_plain
+
+    return html_to_plain(html)
+
+
+_compiled = ContentCache(CompiledTemplate)
+_plain = ContentCache(_html_to_plain)
+
+
+def compile(template):
+    '''
+    Return the CompiledTemplate of the given template string, which is
+    cached by content hash, so it is only parsed once across all the
+    sessions and newsletters that use it.
+    '''
+    return _compiled(template)
+
+
+def html_to_plain(html):
+    '''
+    Same as regnskab.utils.html_to_plain(), which is slow, but cached by
+    content hash like compile().
+    '''
+    return _plain(html)
+
+
 def format(template, context):
     r'''
     >>> format('Hello #TARGET#!', dict(TARGET='world'))
@@ -30,18 +166,4 @@ def format(template, context):
     ...        dict(X='1', Y='0'))
     ''
     '''
-    pattern = r'#([A-Z][^#]*)#'
-    res = re.sub(r'\r\n|\n|\r', '\n', template)
-
-    def hide_zero(s):
-        if any(context[m.group(1)].strip('0,.') == ''
-               for m in re.finditer(pattern, s)):
-            return ''
-        else:
-            return s
-
-    res = re.sub(r'#SKJULNUL:#(.*\n?)',
-                 lambda mo: hide_zero(mo.group(1)), res)
-    res = re.sub(pattern, lambda mo: context[mo.group(1)], res)
-    res = re.sub(r'\n\n+', '\n\n', res)
-    return res
+    return compile(template).render(context)
@@ -0,0 +1,78 @@
+'''
+Exact integer fixed-point representation of amounts and counts.
+
+Prices and transaction amounts are whole øre (ORE = 2 decimal places),
+Purchase.count is in ten-thousandths of a cross (COUNT = 4 decimal places),
+and Purchase.amount, being a count times a price, has AMOUNT = 6 decimal
+places. Internal computations (balance sums, columnar caches) use ints in
+these units, and convert to Decimal with from_fixed() only when the result
+is displayed or saved.
+
+The doctests below check that the int computations give exactly the same
+results as the Decimal computations they replace, on random inputs.
+
+>>> import random
+>>> rng = random.Random(2017)
+>>> def rand(places, digits=12):
+...     n = rng.randint(-10 ** digits, 10 ** digits)
+...     return Decimal(n).scaleb(-places)
+>>> amounts = [rand(AMOUNT) for i in range(1000)]
+>>> all(from_fixed(to_fixed(a, AMOUNT), AMOUNT) == a for a in amounts)
+True
+>>> total = sum(to_fixed(a, AMOUNT) for a in amounts)
+>>> from_fixed(total, AMOUNT) == sum(amounts)
+True
+>>> counts = [rand(COUNT, 6) for i in range(1000)]
+>>> prices = [rand(ORE, 5) for i in range(1000)]
+>>> all(to_fixed(c, COUNT) * to_fixed(p, ORE) == to_fixed(c * p, AMOUNT)
+...     for c, p in zip(counts, prices))
+True
+>>> all(str(from_fixed(to_fixed(p, ORE), ORE)) == str(p) for p in prices)
+True
+'''
+
+from decimal import Decimal
+
+
+ORE = 2
+COUNT = 4
+AMOUNT = ORE + COUNT
+
+
+def to_fixed(value, places):
+    '''
+    Convert a Decimal (or int) to an int in units of 10**-places.
+    Raises ValueError if the conversion would not be exact.
+
+    >>> to_fixed(Decimal('12.34'), ORE)
+    1234
+    >>> to_fixed(Decimal('-0.3333'), COUNT)
+    -3333
+    >>> to_fixed(5, ORE)
+    500
+    >>> to_fixed(Decimal('0.001'), ORE)
+    Traceback (most recent call last):
+    ...
+    ValueError: 0.001 has more than 2 decimal places
+    '''
+    if isinstance(value, int):
+        return value * 10 ** places
+    scaled = value.scaleb(places)
+    result = int(scaled)
+    if result != scaled:
+        raise ValueError('%s has more than %s decimal places' %
+                         (value, places))
+    return result
+
+
+def from_fixed(value, places):
+    '''
+    Convert an int in units of 10**-places to a Decimal.
+
+    >>> from_fixed(1234, ORE)
+    Decimal('12.34')
+    >>> from_fixed(0, COUNT)
+    Decimal('0.0000')
+    '''
+    return Decimal(value).scaleb(-places)
+
@@ -4,8 +4,7 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from regnskab.models import EmailTemplate, Session, config
 from regnskab.widgets import RichTextarea
-from regnskab.utils import plain_to_html, html_to_plain
-import tktitler as tk
+from regnskab.utils import plain_to_html, html_to_plain, title_prefix
 
 
 def placeholder_from_help(cls):
@@ -179,17 +178,16 @@ class TransactionBatchForm(forms.Form):
         except KeyError:
             period = config.GFYEAR
         super().__init__(**kwargs)
-        with tk.set_gfyear(period):
-            self._init(profiles)
+        self._init(profiles, period)
 
-    def _init(self, profiles):
+    def _init(self, profiles, period):
         self._profiles = []
         for profile, amount, selected in profiles:
             p = 'profile%d_' % profile.id
             if profile.title:
                 profile.display_name = (
                     '%s %s' %
-                    (tk.prefix(profile.title, type='unicode')
+                    (title_prefix(profile.title, period, type='unicode')
                      if profile.title.period else profile.title.root,
                      profile.name))
             else:
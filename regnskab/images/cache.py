@@ -0,0 +1,220 @@
+'''
+On-disk cache of decoded images: the stitched Sheet.row_image PNGs, and
+the pages of the uploaded sheet PDFs as rasterized by ImageMagick.
+
+Decoding a row image or rasterizing a PDF page takes much longer than
+reading the result, so each image is saved once as an uncompressed uint8
+.npy file in REGNSKAB_ROW_IMAGE_CACHE_DIR and memory-mapped read-only from
+there. The worker processes that load the same image thus share the pages
+through the OS page cache, and a slice of rows is a view of the mapped
+file rather than a copy.
+
+Files are named by the SHA-1 of the source file (and for PDF pages, the
+page number and density), so a changed file is never served stale.
+When the files take up more than REGNSKAB_IMAGE_CACHE_MAX_BYTES, the
+least recently used are deleted. The most recently used
+REGNSKAB_ROW_IMAGE_CACHE_SIZE mappings are kept open in each process.
+
+The cache can be warmed or cleared with ./manage.py image_cache.
+'''
+
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+
+import numpy as np
+from django.conf import settings
+
+
+CACHE_DIR = getattr(settings, 'REGNSKAB_ROW_IMAGE_CACHE_DIR',
+                    os.path.join(tempfile.gettempdir(), 'regnskab-row-images'))
+CACHE_SIZE = getattr(settings, 'REGNSKAB_ROW_IMAGE_CACHE_SIZE', 16)
+MAX_BYTES = getattr(settings, 'REGNSKAB_IMAGE_CACHE_MAX_BYTES', 2 * 1024 ** 3)
+
+_mapped = collections.OrderedDict()
+_digests = {}
+_lock = threading.Lock()
+
+
+def _decode(png_data):
+    import io
+    import scipy.misc
+
+    return scipy.misc.imread(io.BytesIO(png_data))
+
+
+def _open(name):
+    '''
+    Return the cached array of the given name, or None if not cached.
+    '''
+    with _lock:
+        try:
+            _mapped.move_to_end(name)
+            return _mapped[name]
+        except KeyError:
+            pass
+    filename = os.path.join(CACHE_DIR, name + '.npy')
+    try:
+        image = np.load(filename, mmap_mode='r')
+        # The modification time orders the files for evict().
+        os.utime(filename)
+    except (OSError, ValueError):
+        # Missing, or evicted by another process.
+        return None
+    with _lock:
+        _mapped[name] = image
+        while len(_mapped) > CACHE_SIZE:
+            _mapped.popitem(last=False)
+    return image
+
+
+def _store(name, image):
+    '''
+    Save the array under the given name and return it memory-mapped.
+    '''
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, image)
+        # Atomic, so other processes never see a partial file.
+        os.replace(tmp, os.path.join(CACHE_DIR, name + '.npy'))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    evict()
+    result = _open(name)
+    return image if result is None else result
+
+
+def evict(max_bytes=None):
+    '''
+    Delete the least recently used files until the cache takes up at most
+    max_bytes (by default REGNSKAB_IMAGE_CACHE_MAX_BYTES), and return the
+    number of files deleted. A process that has a deleted file mapped can
+    keep using it.
+    '''
+    if max_bytes is None:
+        max_bytes = MAX_BYTES
+    try:
+        names = os.listdir(CACHE_DIR)
+    except FileNotFoundError:
+        return 0
+    files = []
+    for name in names:
+        if name.endswith('.npy'):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+    files.sort()
+    total = sum(size for mtime, size, path in files)
+    deleted = 0
+    for mtime, size, path in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    return deleted
+
+
+def file_digest(filename):
+    '''
+    SHA-1 of the file, remembered while its size and mtime are the same.
+    '''
+    st = os.stat(filename)
+    key = (filename, st.st_size, st.st_mtime_ns)
+    try:
+        return _digests[key]
+    except KeyError:
+        pass
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            h.update(block)
+    _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def load_row_image(sheet):
+    '''
+    Return the decoded row image of the sheet as a read-only array,
+    or None if the sheet has no row image.
+    '''
+    if not sheet.row_image:
+        return None
+    sheet.row_image.open('rb')
+    try:
+        png_data = sheet.row_image.read()
+    finally:
+        sheet.row_image.close()
+    name = 'rows-%s' % hashlib.sha1(png_data).hexdigest()
+    image = _open(name)
+    if image is None:
+        image = _store(name, _decode(png_data))
+    return image
+
+
+def _page_name(digest, page):
+    from regnskab.images.utils import PDF_DENSITY
+
+    return 'page-%s-%s-%s' % (digest, page, PDF_DENSITY)
+
+
+def _page_count_name(digest):
+    from regnskab.images.utils import PDF_DENSITY
+
+    return 'pages-%s-%s' % (digest, PDF_DENSITY)
+
+
+def load_sheet_page(sheet, page):
+    '''
+    Return page number `page` (starting at 1) of the sheet's image file as
+    a uint8 array, rasterizing it only if it is not cached.
+    '''
+    from regnskab.images.utils import rasterize_pdf_page
+
+    with sheet.image_file_name() as filename:
+        name = _page_name(file_digest(filename), page)
+        image = _open(name)
+        if image is None:
+            image = _store(name, rasterize_pdf_page(filename, page - 1))
+    return image
+
+
+def load_sheet_pages(sheet):
+    '''
+    Return every page of the sheet's image file as uint8 arrays. Unless
+    they are all cached, the pages are rasterized in one pass.
+    '''
+    from regnskab.images.utils import rasterize_pdf_pages
+
+    with sheet.image_file_name() as filename:
+        digest = file_digest(filename)
+        count = _open(_page_count_name(digest))
+        if count is not None:
+            pages = [_open(_page_name(digest, i + 1))
+                     for i in range(int(count[0]))]
+            if all(page is not None for page in pages):
+                return pages
+        pages = [_store(_page_name(digest, i + 1), image)
+                 for i, image in enumerate(rasterize_pdf_pages(filename))]
+        _store(_page_count_name(digest), np.array([len(pages)]))
+    return pages
+
+
+def clear():
+    '''
+    Delete the cached files and forget the mappings of this process.
+    '''
+    with _lock:
+        _mapped.clear()
+    return evict(0)
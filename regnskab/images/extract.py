@@ -470,25 +470,22 @@ def get_person_crosses(person_rows, øl=15, guldøl=6, sodavand=15):
 
 def get_images(sheet):
     from regnskab.models import SheetImage
+    from regnskab.images.cache import load_sheet_pages
+
+    existing = []
     if sheet.pk:
         existing = list(SheetImage.objects.filter(sheet=sheet))
-        if existing:
-            for o in existing:
-                o.get_image()
-            return existing
+    by_page = {o.page: o for o in existing}
     images = []
-    with sheet.image_file_name():
-        i = 1
-        while i < 1000:
-            try:
-                im = SheetImage(sheet=sheet, page=i)
-                im.get_image()
-                images.append(im)
-            except Exception:
-                if i == 1:
-                    raise
-                break
-            i += 1
+    # Rasterize every page in one pass instead of one process per page.
+    for i, page_image in enumerate(load_sheet_pages(sheet)):
+        im = by_page.get(i + 1) or SheetImage(sheet=sheet, page=i + 1)
+        im._image = page_image / 255.0
+        images.append(im)
+    if existing:
+        return existing
+    if not images:
+        raise ValueError('No pages in %s' % sheet.image_file)
     return images
 
 
@@ -554,11 +551,13 @@ def extract_row_image(sheet, kinds, images):
                         row=rows[-1],
                         kind=kind,
                         count=count))
+                    purchases[-1].set_amount()
                 if boxcount:
                     purchases.append(Purchase(
                         row=rows[-1],
                         kind=boxkind,
                         count=boxcount))
+                    purchases[-1].set_amount()
 
             stitched_image_height += height
             i = j
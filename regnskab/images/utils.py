@@ -41,17 +41,79 @@ def load_tiff_page(filename, page):
     return a / 255.0
 
 
-def load_pdf_page(filename, page):
+PDF_DENSITY = '150'
+PDF_DEPTH = '8'
+
+
+def rasterize_pdf_page(filename, page):
+    """
+    Render a page of a PDF file as a uint8 array with ImageMagick.
+    """
     # convert -density 150 '2221_001.pdf[0]' 2221_001_1.png
     with tempfile.NamedTemporaryFile(suffix='.ppm') as fp:
         subprocess.check_call(
-            ('convert', '-density', '150', '-depth', '8',
+            ('convert', '-density', PDF_DENSITY, '-depth', PDF_DEPTH,
              # '-background', 'white', '-alpha', 'remove',
              '%s[%s]' % (filename, page),
              fp.name))
-        img = scipy.misc.imread(fp.name)
+        return scipy.misc.imread(fp.name)
+
+
+def _read_ppm_token(fp):
+    token = b''
+    while True:
+        c = fp.read(1)
+        if not c:
+            return token or None
+        if c == b'#':
+            fp.readline()
+        elif c.isspace():
+            if token:
+                return token
+        else:
+            token += c
+
 
-    return img / 255.0
+def read_ppm_stream(fp):
+    r"""
+    Generate the images (uint8 arrays of shape (height, width, 3)) of a
+    stream of concatenated binary PPM files.
+
+    >>> import io
+    >>> data = b'P6\n2 1\n255\n' + bytes(range(6)) + b'P6 1 1 255 ' + b'abc'
+    >>> [im.tolist() for im in read_ppm_stream(io.BytesIO(data))]
+    [[[[0, 1, 2], [3, 4, 5]]], [[[97, 98, 99]]]]
+    """
+    while True:
+        magic = _read_ppm_token(fp)
+        if magic is None:
+            return
+        if magic != b'P6':
+            raise ValueError('Not a binary PPM: %r' % magic)
+        width, height, maxval = (int(_read_ppm_token(fp)) for _ in range(3))
+        if maxval > 255:
+            raise ValueError('Unsupported PPM maxval %s' % maxval)
+        size = width * height * 3
+        data = fp.read(size)
+        if len(data) != size:
+            raise ValueError('Truncated PPM')
+        yield np.frombuffer(data, np.uint8).reshape(height, width, 3)
+
+
+def rasterize_pdf_pages(filename):
+    """
+    Generate every page of a PDF file as a uint8 array like
+    rasterize_pdf_page(), rendered by a single ImageMagick process that
+    streams the pages to us as PPM as it renders them.
+    """
+    cmdline = ('convert', '-density', PDF_DENSITY, '-depth', PDF_DEPTH,
+               filename, 'ppm:-')
+    p = subprocess.Popen(cmdline, stdin=subprocess.DEVNULL,
+                         stdout=subprocess.PIPE)
+    with p:
+        yield from read_ppm_stream(p.stdout)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmdline)
 
 
 def save_png(im_array):
@@ -0,0 +1,382 @@
+'''
+A database-backed queue of slow work, so that views can return before the
+work is done.
+
+A view calls enqueue() and redirects to the job's status page
+(regnskab:job_detail), which polls regnskab:job_status until the job is
+done. The jobs are run by one or more processes started with
+
+    ./manage.py run_jobs --workers N
+
+If a pending job of the same kind and key already exists, enqueue()
+merges the new arguments into it instead of adding another job, so e.g.
+saving a sheet many times in a row renders the emails of the session once.
+
+A job that is still running after REGNSKAB_JOB_TIMEOUT seconds (by default
+an hour) was claimed by a worker that died, and is queued again. Handlers
+must therefore be safe to run twice.
+'''
+
+import time
+import logging
+import datetime
+import traceback
+
+from django.conf import settings
+from django.db import connections
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from regnskab.models import Job
+
+
+logger = logging.getLogger('regnskab')
+
+HANDLERS = {}
+CLAIM_TIMEOUT = datetime.timedelta(
+    seconds=getattr(settings, 'REGNSKAB_JOB_TIMEOUT', 60 * 60))
+
+
+def handler(kind, merge=None):
+    '''
+    Register fn(job, **arguments) as the handler of jobs of the given kind.
+    merge(old_arguments, new_arguments) returns the arguments of a pending
+    job that is coalesced with a new one; by default the new arguments
+    replace the old.
+    '''
+    def decorator(fn):
+        HANDLERS[kind] = (fn, merge)
+        return fn
+
+    return decorator
+
+
+def enqueue(kind, key='', arguments=None, coalesce=True, user=None,
+            next_url=''):
+    if kind not in HANDLERS:
+        raise KeyError(kind)
+    arguments = arguments or {}
+    with atomic():
+        if coalesce:
+            pending = Job.objects.select_for_update().filter(
+                state=Job.PENDING, kind=kind, key=key).first()
+            if pending is not None:
+                fn, merge = HANDLERS[kind]
+                pending.arguments = (merge(pending.arguments, arguments)
+                                     if merge else arguments)
+                pending.next_url = next_url or pending.next_url
+                # Only update the job if no worker has claimed it
+                # (SQLite ignores select_for_update()).
+                updated = Job.objects.filter(
+                    pk=pending.pk, state=Job.PENDING).update(
+                        arguments=pending.arguments,
+                        next_url=pending.next_url)
+                if updated:
+                    return pending
+        job = Job(kind=kind, key=key, arguments=arguments,
+                  created_by=user, next_url=next_url)
+        job.save()
+        return job
+
+
+def requeue_stale():
+    '''
+    Queue jobs again whose worker died.
+    '''
+    return Job.objects.filter(
+        state=Job.RUNNING,
+        started_time__lt=timezone.now() - CLAIM_TIMEOUT).update(
+            state=Job.PENDING, started_time=None)
+
+
+def claim_next():
+    '''
+    Mark the oldest pending job as running and return it,
+    or return None if no job is pending.
+    '''
+    requeue_stale()
+    for job in Job.objects.filter(state=Job.PENDING)[:10]:
+        # Another worker may have claimed the job since we looked.
+        claimed = Job.objects.filter(pk=job.pk, state=Job.PENDING).update(
+            state=Job.RUNNING, started_time=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_job(job):
+    fn, merge = HANDLERS[job.kind]
+    try:
+        # Not atomic, so that set_progress() is visible while the job runs.
+        # Handlers wrap their writes in atomic() themselves.
+        fn(job, **job.arguments)
+    except Exception as exn:
+        logger.exception("Job %s (%s) failed", job.pk, job.kind)
+        job.state = Job.FAILED
+        job.message = '%s\n\n%s' % (exn, traceback.format_exc())
+    else:
+        job.state = Job.DONE
+    job.finished_time = timezone.now()
+    job.save()
+
+
+def work(once=False, interval=2):
+    '''
+    Run pending jobs until interrupted,
+    or until no job is pending if once is True.
+    When no job is pending, send the outbox messages that are due
+    (retries and messages of senders that died).
+    '''
+    from regnskab.outbox import has_due_messages, process_outbox
+
+    while True:
+        job = claim_next()
+        if job is not None:
+            run_job(job)
+        elif has_due_messages():
+            process_outbox()
+        elif once:
+            return
+        else:
+            time.sleep(interval)
+
+
+def close_connections():
+    '''
+    Must be called before forking worker processes,
+    which must not share database connections.
+    '''
+    for conn in connections.all():
+        conn.close()
+
+
+def merge_profile_ids(old, new):
+    if old['profile_ids'] is None or new['profile_ids'] is None:
+        profile_ids = None
+    else:
+        profile_ids = sorted(
+            set(old['profile_ids']) | set(new['profile_ids']))
+    return dict(new, profile_ids=profile_ids)
+
+
+@handler('regenerate_emails', merge=merge_profile_ids)
+def regenerate_emails_job(job, model, pk, profile_ids):
+    from regnskab.models import Session, Newsletter, regenerate_emails
+
+    email_set_class = {'Session': Session, 'Newsletter': Newsletter}[model]
+    email_set = email_set_class.objects.get(pk=pk)
+    if email_set.sent or email_set.email_template is None:
+        return
+    counts = regenerate_emails(email_set, profile_ids,
+                               progress=job.set_progress)
+    job.message = ('%(created)s oprettet, %(updated)s ændret, ' +
+                   '%(deleted)s slettet, %(unchanged)s uændret') % counts
+
+
+def enqueue_regenerate_emails(email_set, profile_ids=None, **kwargs):
+    model = email_set.__class__.__name__
+    if profile_ids is not None:
+        profile_ids = sorted(p_id for p_id in profile_ids if p_id is not None)
+    return enqueue('regenerate_emails', '%s:%s' % (model, email_set.pk),
+                   dict(model=model, pk=email_set.pk,
+                        profile_ids=profile_ids),
+                   **kwargs)
+
+
+def get_unfinished_email_job(email_set):
+    '''
+    Return a pending or running job that changes the emails of email_set
+    or their krydser.png, or None. The emails must not be sent until
+    such a job is done.
+    '''
+    key = '%s:%s' % (email_set.__class__.__name__, email_set.pk)
+    return Job.objects.filter(
+        kind__in=('regenerate_emails', 'crosses_images'), key=key,
+        state__in=(Job.PENDING, Job.RUNNING)).first()
+
+
+@handler('crosses_images', merge=merge_profile_ids)
+def crosses_images_job(job, session, profile_ids):
+    '''
+    Store the krydser.png of the given profiles in a session.
+    '''
+    from regnskab.models import Session
+    from regnskab.mime import update_crosses_images
+
+    session = Session.objects.get(pk=session)
+    update_crosses_images(session, profile_ids, progress=job.set_progress)
+
+
+def enqueue_crosses_images(session, profile_ids=None, **kwargs):
+    if profile_ids is not None:
+        profile_ids = sorted(p_id for p_id in profile_ids if p_id is not None)
+    return enqueue('crosses_images', 'Session:%s' % session.pk,
+                   dict(session=session.pk, profile_ids=profile_ids),
+                   **kwargs)
+
+
+@handler('extract_images')
+def extract_images_job(job, sheet):
+    '''
+    Extract the rows of a new sheet from its scanned image file.
+    '''
+    from regnskab.models import Sheet, Purchase, ledger_changed
+    from regnskab.images.extract import extract_images
+
+    sheet = Sheet.objects.get(pk=sheet)
+    kinds = list(sheet.purchasekind_set.all())
+    images, rows, purchases = extract_images(sheet, kinds)
+    job.set_progress(1, 2)
+    with atomic():
+        sheet.save()  # Save row_image
+        for o in images + rows:
+            o.sheet = o.sheet  # Update sheet_id
+            o.save()
+        for o in purchases:
+            o.row = o.row  # Update row_id
+            o.set_amount()
+        Purchase.objects.bulk_create(purchases)
+        ledger_changed((o.profile_id for o in rows),
+                       since=sheet.created_time,
+                       periods=(sheet.period,
+                                sheet.session and sheet.session.period))
+    job.set_progress(2, 2)
+    if sheet.session:
+        enqueue_crosses_images(sheet.session, [o.profile_id for o in rows])
+    if sheet.session and sheet.session.email_template:
+        enqueue_regenerate_emails(
+            sheet.session, [o.profile_id for o in rows])
+
+
+@handler('extract_sheet_image')
+def extract_sheet_image_job(job, sheet_image, reset):
+    '''
+    Extract a sheet again after the parameters of one of its pages changed,
+    and replace the rows of the sheet if reset is True.
+    '''
+    from regnskab.models import SheetImage, Purchase, ledger_changed
+    from regnskab.images.extract import extract_images
+
+    sheet_image = SheetImage.objects.get(pk=sheet_image)
+    sheet = sheet_image.sheet
+    images, rows, purchases = extract_images(
+        sheet, list(sheet.purchasekind_set.all()))
+    sheet_image, = [im for im in images if im.page == sheet_image.page]
+    sheet_image.set_verified(False)
+    sheet_image.save()  # Save computed values
+    if reset:
+        with atomic():
+            profile_ids = set(sheet.sheetrow_set.values_list(
+                'profile_id', flat=True))
+            sheet.sheetrow_set.all().delete()
+            for o in rows:
+                o.save()
+            for o in purchases:
+                o.row = o.row  # Update row_id
+                o.set_amount()
+            Purchase.objects.bulk_create(purchases)
+            profile_ids |= set(o.profile_id for o in rows)
+            ledger_changed(
+                profile_ids, since=sheet.created_time,
+                periods=(sheet.period,
+                         sheet.session and sheet.session.period))
+        if sheet.session:
+            enqueue_crosses_images(sheet.session, profile_ids)
+        if sheet.session and sheet.session.email_template:
+            enqueue_regenerate_emails(sheet.session, profile_ids)
+
+
+@handler('balance_print')
+def balance_print_job(job, session, tex_source, print_it, filename, fake):
+    '''
+    Render the balance print of a session to PDF, and either print it or
+    keep it in job.output for download.
+    '''
+    import io
+    from regnskab.texrender import tex_to_pdf, pdfnup, RenderError
+    try:
+        from uniprint.api import print_new_document
+    except ImportError:
+        from regnskab.texrender import print_new_document
+
+    try:
+        pdf = pdfnup(tex_to_pdf(tex_source))
+    except RenderError as exn:
+        raise ValueError(str(exn) + ': ' + exn.output)
+    job.set_progress(1, 2 if print_it else 1)
+    if not print_it:
+        job.output = pdf
+        job.output_type = 'application/pdf'
+        return
+    print_new_document(io.BytesIO(pdf),
+                       filename=filename,
+                       username=job.created_by.username,
+                       printer='A2',
+                       duplex=False, fake=fake)
+    logger.info("%s: Udskriv opgørelse id=%s på A2", job.created_by, session)
+    job.set_progress(2)
+
+
+@handler('send_outbox')
+def send_outbox_job(job, ids=None):
+    '''
+    Send the pending messages of the outbox (or those with the given ids).
+    '''
+    from regnskab.outbox import process_outbox
+
+    total = len(ids) if ids is not None else None
+    metrics = process_outbox(
+        ids=ids, progress=lambda n: job.set_progress(n, total))
+    job.message = ('%(sent)s sendt, %(failed)s fejlet, ' +
+                   '%(retried)s forsøges igen, %(per_second).1f/s') % metrics
+
+
+@handler('send_emails', merge=merge_profile_ids)
+def send_emails_job(job, model, pk, profile_ids):
+    '''
+    Build the messages of a session or newsletter in a process pool
+    (see regnskab.mime), and queue and send them batch by batch.
+
+    Profiles that already have a message of the email set in the outbox
+    are skipped, so a job that died can simply be run again.
+    '''
+    import django.core.mail
+    from regnskab.models import Session, Newsletter, OutboxMessage
+    from regnskab.mime import build_messages, BATCH_SIZE
+    from regnskab.outbox import queue_raw_messages, process_outbox
+
+    email_set_class = {'Session': Session, 'Newsletter': Newsletter}[model]
+    email_set = email_set_class.objects.get(pk=pk)
+    emails = email_set.email_set.select_related('profile')
+    if profile_ids is not None:
+        emails = emails.filter(profile_id__in=profile_ids)
+    key = 'session' if model == 'Session' else 'newsletter'
+    queued = set(OutboxMessage.objects.filter(
+        **{key: email_set}).values_list('profile_id', flat=True))
+    emails = [e for e in emails if e.profile_id not in queued]
+
+    metrics = dict(sent=0, failed=0, retried=0)
+    connection = django.core.mail.get_connection()
+    messages = build_messages(emails)
+    for i in range(0, len(emails), BATCH_SIZE):
+        batch = emails[i:i+BATCH_SIZE]
+        items = [next(messages) for e in batch]
+        with atomic():
+            rows = queue_raw_messages(items, email_set,
+                                      [e.profile for e in batch])
+        m = process_outbox(ids=[o.pk for o in rows], connection=connection)
+        for k in metrics:
+            metrics[k] += m[k]
+        job.set_progress(i + len(batch), len(emails))
+    job.message = ('%(sent)s sendt, %(failed)s fejlet, ' +
+                   '%(retried)s forsøges igen') % metrics
+
+
+def enqueue_send_emails(email_set, emails=None, **kwargs):
+    model = email_set.__class__.__name__
+    profile_ids = (None if emails is None else
+                   sorted(e.profile_id for e in emails))
+    return enqueue('send_emails', '%s:%s' % (model, email_set.pk),
+                   dict(model=model, pk=email_set.pk,
+                        profile_ids=profile_ids),
+                   **kwargs)
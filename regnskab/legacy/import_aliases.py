@@ -25,7 +25,9 @@ def main():
 
 
 def import_aliases(data, fp):
-    from regnskab.models import Alias, Title, Profile
+    from regnskab.models import (
+        Alias, Title, Profile, titles_changed, rebuild_search_index,
+    )
     profiles = {p.name: p for p in Profile.objects.all()}
 
     aliases = []
@@ -50,6 +52,8 @@ def import_aliases(data, fp):
 
     fp.write("Create %s aliases\n" % len(new))
     Alias.objects.bulk_create(new)
+    titles_changed()
+    rebuild_search_index()
 
 
 if __name__ == "__main__":
@@ -201,7 +201,9 @@ def import_profiles(data, helper):
 
 
 def import_sheets(data, helper):
-    from regnskab.models import Purchase
+    from regnskab.models import (
+        Purchase, rebuild_balances, rebuild_kind_totals,
+    )
     save_all = helper.save_all
     filter_related = helper.filter_related
 
@@ -222,8 +224,12 @@ def import_sheets(data, helper):
                     only_new=True)
     purchases = filter_related(purchase_kinds, purchases, 'kind')
     purchases = filter_related(rows, purchases, 'row')
+    for o in purchases:
+        o.set_amount()
     helper.stdout.write("Create %s purchases\n" % len(purchases))
     Purchase.objects.bulk_create(purchases)
+    rebuild_balances()
+    rebuild_kind_totals()
 
 
 if __name__ == "__main__":
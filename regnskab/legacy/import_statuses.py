@@ -30,7 +30,7 @@ def main():
 
 
 def import_statuses(data, fp):
-    from regnskab.models import SheetStatus
+    from regnskab.models import SheetStatus, titles_changed
     profiles = get_profiles_without_data()
     objects = []
     for o in data:
@@ -44,6 +44,7 @@ def import_statuses(data, fp):
                         end_time=strptime(o['end_time'])))
     fp.write("Create %s statuses\n" % len(objects))
     SheetStatus.objects.bulk_create(objects)
+    titles_changed()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from regnskab.benchmark import best_of
+from regnskab.models import (
+    Session, compute_balance, compute_balance_orm,
+)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        session = Session.objects.order_by('-created_time').first()
+        cases = [('all', {})]
+        if session is not None:
+            since = (session.created_time - datetime.timedelta(90)).date()
+            cases.append(('created_before',
+                          dict(created_before=session.created_time)))
+            cases.append(('output_matrix',
+                          dict(output_matrix=True,
+                               purchases_after=since)))
+        else:
+            cases.append(('output_matrix', dict(output_matrix=True)))
+
+        for name, kwargs in cases:
+            t_orm, r_orm = best_of(
+                lambda: compute_balance_orm(**kwargs), repeat)
+            t_sql, r_sql = best_of(
+                lambda: compute_balance(**kwargs), repeat)
+            self.stdout.write(
+                '%-16s orm %8.4f s  union %8.4f s  %5.1fx  %s' %
+                (name, t_orm, t_sql, t_orm / t_sql,
+                 'same' if r_orm == r_sql else 'DIFFERENT'))
@@ -0,0 +1,58 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from regnskab.benchmark import best_of
+from regnskab.images.utils import save_png
+from regnskab.mime import get_image_for_emails, build_messages
+from regnskab.models import Session
+
+
+def serial(emails):
+    '''
+    The message building loop of EmailSend before regnskab.mime.
+    '''
+    messages = [e.to_message() for e in emails]
+    for message, image in zip(messages, get_image_for_emails(emails)):
+        if image is not None:
+            png_data = save_png(image)
+            message.attach('krydser.png', png_data, 'image/png')
+    return [m.message().as_bytes() for m in messages]
+
+
+class Command(BaseCommand):
+    help = ('Compare building the MIME messages of a session serially ' +
+            'and with regnskab.mime.build_messages() in a process pool ' +
+            'of each of the given sizes. Nothing is sent.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--session', type=int)
+        parser.add_argument('-r', '--repeat', type=int, default=3)
+        parser.add_argument('workers', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        qs = Session.objects.exclude(email_template=None)
+        if options['session']:
+            qs = qs.filter(pk=options['session'])
+        session = qs.order_by('-pk').first()
+        if session is None:
+            raise CommandError('No session with emails')
+        emails = list(session.email_set.select_related('profile'))
+        workers = options['workers'] or [1, 2, os.cpu_count() or 1]
+
+        t_serial, r_serial = best_of(lambda: serial(emails), repeat)
+        size = sum(map(len, r_serial))
+        self.stdout.write('Opgørelse %s: %d emails, %.1f MB' %
+                          (session.pk, len(emails), size / 1e6))
+        self.stdout.write('serial    %8.4f s  %6.1f/s' %
+                          (t_serial, len(emails) / t_serial))
+        for n in workers:
+            t, r = best_of(
+                lambda: list(build_messages(emails, workers=n)), repeat)
+            # The MIME boundaries and dates differ between runs,
+            # so only the number of messages is compared.
+            self.stdout.write(
+                '%2d workers %8.4f s  %6.1f/s  %6.1fx  %s' %
+                (n, t, len(emails) / t, t_serial / t,
+                 'same' if len(r) == len(r_serial) else 'DIFFERENT'))
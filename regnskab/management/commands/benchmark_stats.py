@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic, set_rollback
+
+from regnskab.benchmark import best_of
+from regnskab.models import (
+    Purchase, Transaction, LEDGER_VERSION_KEY, bump_version,
+)
+from regnskab.stats import Ledger, get_ledger
+from regnskab.utils import sum_matrix
+
+
+def orm_by_year():
+    by_year = sum_matrix(
+        Purchase.objects.all(),
+        'kind__name', 'row__sheet__period', 'count')
+    by_year.update(sum_matrix(
+        Transaction.objects.all(), 'kind', 'period', 'amount'))
+    return by_year
+
+
+def copy_objects(model, objects, copies):
+    for i in range(copies):
+        for o in objects:
+            o.pk = None
+        model.objects.bulk_create(objects, batch_size=500)
+
+
+class Command(BaseCommand):
+    help = ('Compare SessionList\'s whole-history pivot using the ORM ' +
+            'and regnskab.stats at multiples of the current data volume. ' +
+            'The extra data is rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--repeat', type=int, default=3)
+        parser.add_argument('scales', nargs='*', type=int,
+                            default=[1, 10, 100])
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        purchases = list(Purchase.objects.all())
+        transactions = list(Transaction.objects.all())
+        scale = 1
+        with atomic():
+            for target in sorted(options['scales']):
+                if target > scale:
+                    copy_objects(Purchase, purchases, target - scale)
+                    copy_objects(Transaction, transactions, target - scale)
+                    scale = target
+                    bump_version(LEDGER_VERSION_KEY)
+                t_orm, r_orm = best_of(orm_by_year, repeat)
+                t_load, ledger = best_of(Ledger.load, repeat)
+                # The cached ledger, including the version lookup.
+                get_ledger()
+                t_pivot, r_pivot = best_of(
+                    lambda: get_ledger().sum_matrix(
+                        'kind', 'period', 'count'),
+                    repeat)
+                self.stdout.write(
+                    '%4dx %8d rows  orm %8.4f s  load %8.4f s  ' %
+                    (scale, ledger.size, t_orm, t_load) +
+                    'cached %8.4f s  %6.1fx  %s' %
+                    (t_pivot, t_orm / t_pivot,
+                     'same' if r_orm == r_pivot else 'DIFFERENT'))
+            set_rollback(True)
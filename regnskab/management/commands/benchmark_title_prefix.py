@@ -0,0 +1,43 @@
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+import regnskab.utils
+from regnskab.benchmark import best_of
+from regnskab.models import config, _compute_profiles_title_status
+from regnskab.utils import title_prefix_info
+from regnskab.views import ProfileSearch
+from regnskab.views.base import build_profile_directory
+
+
+class Command(BaseCommand):
+    help = ('Time ProfileSearch.get_results, get_profiles_title_status ' +
+            '(without its index) and the ProfileDirectory JSON with and ' +
+            'without the title_prefix() cache.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--repeat', type=int, default=5)
+        parser.add_argument('-q', '--query', default='KASS')
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        period = config.GFYEAR
+        cases = [
+            ('ProfileSearch',
+             lambda: ProfileSearch().get_results(options['query'], False)),
+            ('title_status',
+             lambda: [p.title_name for p in
+                      _compute_profiles_title_status(period, None)]),
+            ('ProfileDirectory', lambda: build_profile_directory(period)),
+        ]
+
+        uncached = regnskab.utils._title_prefix.__wrapped__
+        for name, fn in cases:
+            with patch('regnskab.utils._title_prefix', uncached):
+                t_before, r_before = best_of(fn, repeat)
+            t_after, r_after = best_of(fn, repeat)
+            self.stdout.write(
+                '%-16s before %8.4f s  after %8.4f s  %6.1fx  %s' %
+                (name, t_before, t_after, t_before / t_after,
+                 'same' if r_before == r_after else 'DIFFERENT'))
+        self.stdout.write('title_prefix cache: %s' % (title_prefix_info(),))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from regnskab.images import cache
+from regnskab.models import Sheet
+
+
+class Command(BaseCommand):
+    help = ('Warm the image cache with the pages and row images of the ' +
+            'given sheets (by default all sheets), evict the least ' +
+            'recently used files down to the size limit, or clear it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('warm', 'evict', 'clear'))
+        parser.add_argument('sheets', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        if options['action'] == 'clear':
+            self.stdout.write('Deleted %s files' % cache.clear())
+            return
+        if options['action'] == 'evict':
+            self.stdout.write('Deleted %s files' % cache.evict())
+            return
+        sheets = Sheet.objects.order_by('pk')
+        if options['sheets']:
+            sheets = sheets.filter(pk__in=options['sheets'])
+        for sheet in sheets:
+            pages = 0
+            if sheet.image_file:
+                pages = len(cache.load_sheet_pages(sheet))
+            if sheet.row_image:
+                cache.load_row_image(sheet)
+            self.stdout.write('Krydsliste %s: %s sider%s' %
+                              (sheet.pk, pages,
+                               ', rækker' if sheet.row_image else ''))
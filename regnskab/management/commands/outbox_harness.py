@@ -0,0 +1,115 @@
+import tempfile
+import datetime
+
+from django.core.mail import EmailMessage
+from django.core.mail.backends import locmem, filebased
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic, set_rollback
+from django.utils import timezone
+
+from regnskab.models import OutboxMessage
+from regnskab.outbox import queue_messages, process_outbox, claim_chunk
+
+
+class FlakyMixin:
+    '''
+    Fail every fail_every'th send, and always fail recipients in dead.
+    '''
+
+    def __init__(self, fail_every=0, dead=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fail_every = fail_every
+        self.dead = set(dead)
+        self.attempts = 0
+        self.delivered = []
+
+    def send_messages(self, messages):
+        for m in messages:
+            self.attempts += 1
+            if self.dead & set(m.recipients()):
+                raise ConnectionError('%s is dead' % m.recipients())
+            if self.fail_every and self.attempts % self.fail_every == 0:
+                raise ConnectionError('Flaky failure %s' % self.attempts)
+        n = super().send_messages(messages)
+        self.delivered.extend(r for m in messages for r in m.recipients())
+        return n
+
+
+class FlakyLocmemBackend(FlakyMixin, locmem.EmailBackend):
+    pass
+
+
+class FlakyFileBackend(FlakyMixin, filebased.EmailBackend):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Send synthetic messages through the outbox with a locmem ' +
+            'or file email backend that fails on purpose, simulate a ' +
+            'crashed sender, and check that every message ends up sent ' +
+            'or failed. The messages are rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--messages', type=int, default=200)
+        parser.add_argument('-c', '--chunk-size', type=int, default=25)
+        parser.add_argument('-f', '--fail-every', type=int, default=7)
+        parser.add_argument('-b', '--backend', choices=('locmem', 'file'),
+                            default='locmem')
+
+    def handle(self, *args, **options):
+        n = options['messages']
+        addresses = ['member%s@example.com' % i for i in range(n)]
+        dead = addresses[:1]
+        max_attempts = 3
+        with tempfile.TemporaryDirectory() as d, atomic():
+            if options['backend'] == 'file':
+                backend = FlakyFileBackend(
+                    fail_every=options['fail_every'], dead=dead, file_path=d)
+            else:
+                backend = FlakyLocmemBackend(
+                    fail_every=options['fail_every'], dead=dead)
+            messages = [EmailMessage(subject='Test %s' % i, body='Test',
+                                     from_email='admin@example.com',
+                                     to=[a])
+                        for i, a in enumerate(addresses)]
+            ids = [o.pk for o in queue_messages(messages)]
+
+            # A sender that claims a chunk and dies
+            crashed = claim_chunk(options['chunk_size'], ids)
+            OutboxMessage.objects.filter(
+                pk__in=[o.pk for o in crashed]).update(
+                    claimed_time=timezone.now() - datetime.timedelta(days=1))
+
+            runs = []
+            while OutboxMessage.objects.filter(
+                    pk__in=ids, state=OutboxMessage.PENDING).exists():
+                runs.append(process_outbox(
+                    chunk_size=options['chunk_size'], ids=ids,
+                    connection=backend, max_attempts=max_attempts,
+                    backoff=0))
+
+            qs = OutboxMessage.objects.filter(pk__in=ids)
+            sent = qs.filter(state=OutboxMessage.SENT).count()
+            failed = list(qs.filter(state=OutboxMessage.FAILED))
+            seconds = sum(r['seconds'] for r in runs)
+            self.stdout.write(
+                '%s messages, %s runs, %s attempts, %.1f messages/s' %
+                (n, len(runs), backend.attempts,
+                 sum(r['sent'] for r in runs) / seconds if seconds else 0))
+            problems = []
+            if sent + len(failed) != n:
+                problems.append('%s sent + %s failed != %s' %
+                                (sent, len(failed), n))
+            if set(backend.delivered) != set(addresses) - set(dead):
+                problems.append('delivered set differs')
+            if len(backend.delivered) != len(set(backend.delivered)):
+                problems.append('duplicate deliveries')
+            if [o.recipients for o in failed] != [[a] for a in dead]:
+                problems.append('unexpected failures %s' %
+                                [o.recipients for o in failed])
+            if any(o.attempts != max_attempts for o in failed):
+                problems.append('failed before %s attempts' % max_attempts)
+            set_rollback(True)
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write('ok')
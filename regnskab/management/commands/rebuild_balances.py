@@ -0,0 +1,28 @@
+from django.core.management.base import CommandError, BaseCommand
+
+from regnskab.models import (
+    rebuild_balances, rebuild_kind_totals, check_balances,
+)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--check', action='store_true',
+                            help='Compare the stored balances to ' +
+                                 'compute_balance() without rebuilding')
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            n = rebuild_balances()
+            rebuild_kind_totals()
+            self.stdout.write('Rebuilt balances of %s profiles ' % n +
+                              'and the per-period kind totals')
+            return
+        mismatches = check_balances()
+        for profile_id, stored, computed in mismatches:
+            self.stdout.write('Profile %s: stored %s, computed %s' %
+                              (profile_id, stored, computed))
+        if mismatches:
+            raise CommandError('%s balances are inconsistent' %
+                               len(mismatches))
+        self.stdout.write('All balances are consistent')
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from regnskab.models import SearchEntry, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trigram index used by the profile search.'
+
+    def handle(self, *args, **options):
+        rebuild_search_index()
+        self.stdout.write('Indexed %s aliases, titles and profiles' %
+                          SearchEntry.objects.count())
@@ -0,0 +1,35 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+
+from regnskab.jobs import work, close_connections
+
+
+class Command(BaseCommand):
+    help = ('Run the jobs queued by regnskab.jobs.enqueue(), and send ' +
+            'the outbox messages that are due when no job is pending.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='Number of worker processes')
+        parser.add_argument('-i', '--interval', type=float, default=2,
+                            help='Seconds to wait when no job is pending')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when no job is pending')
+
+    def handle(self, *args, **options):
+        kwargs = dict(once=options['once'], interval=options['interval'])
+        if options['workers'] == 1:
+            work(**kwargs)
+            return
+        close_connections()
+        processes = [multiprocessing.Process(target=work, kwargs=kwargs)
+                     for i in range(options['workers'])]
+        for p in processes:
+            p.start()
+        try:
+            for p in processes:
+                p.join()
+        except KeyboardInterrupt:
+            for p in processes:
+                p.terminate()
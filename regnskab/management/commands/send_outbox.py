@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from regnskab.outbox import process_outbox, get_outbox_status
+
+
+class Command(BaseCommand):
+    help = 'Send the pending messages of the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--chunk-size', type=int)
+        parser.add_argument('-s', '--status', action='store_true',
+                            help='Only print the number of messages ' +
+                                 'in each state')
+
+    def handle(self, *args, **options):
+        if not options['status']:
+            metrics = process_outbox(chunk_size=options['chunk_size'])
+            self.stdout.write(
+                'Sent %(sent)s, failed %(failed)s, retry later %(retried)s ' %
+                metrics +
+                'in %(chunks)s chunks, %(seconds).2f s, %(per_second).1f/s' %
+                metrics)
+        counts = get_outbox_status()['counts']
+        self.stdout.write(' '.join('%s=%s' % kv
+                                   for kv in sorted(counts.items())))
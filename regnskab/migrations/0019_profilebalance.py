@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0018_newsletter_newsletteremail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileBalance',
+            fields=[
+                ('profile', models.OneToOneField(related_name='+', primary_key=True, on_delete=django.db.models.deletion.CASCADE, serialize=False, to=profile_model)),
+                ('balance', models.DecimalField(max_digits=15, decimal_places=6)),
+            ],
+        ),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F, Sum
+
+
+def sum_vector(qs, index_spec, value_spec):
+    # Copy of regnskab.utils.sum_vector, so that later changes to it
+    # do not change this migration.
+    qs = qs.order_by()
+    qs = qs.annotate(index_spec=F(index_spec))
+    qs = qs.values('index_spec')
+    qs = qs.annotate(value_spec=Sum(value_spec))
+    return {record['index_spec']: record['value_spec'] for record in qs}
+
+
+def populate_profilebalance(apps, schema_editor):
+    Purchase = apps.get_model('regnskab', 'Purchase')
+    Transaction = apps.get_model('regnskab', 'Transaction')
+    ProfileBalance = apps.get_model('regnskab', 'ProfileBalance')
+    purchase_qs = Purchase.objects.exclude(row__profile_id=None)
+    balance = sum_vector(purchase_qs, 'row__profile_id',
+                         F('count') * F('kind__unit_price'))
+    transaction_balance = sum_vector(
+        Transaction.objects.all(), 'profile_id', 'amount')
+    for profile_id, amount in transaction_balance.items():
+        balance[profile_id] = balance.get(profile_id, 0) + amount
+    ProfileBalance.objects.all().delete()
+    ProfileBalance.objects.bulk_create([
+        ProfileBalance(profile_id=p_id, balance=b)
+        for p_id, b in balance.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0019_profilebalance'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_profilebalance),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0020_populate_profilebalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewsletterBalance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('balance', models.DecimalField(max_digits=15, decimal_places=6)),
+                ('newsletter', models.ForeignKey(related_name='balance_set', on_delete=django.db.models.deletion.CASCADE, to='regnskab.Newsletter')),
+                ('profile', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to=profile_model)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SessionBalance',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('balance', models.DecimalField(max_digits=15, decimal_places=6)),
+                ('profile', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to=profile_model)),
+                ('session', models.ForeignKey(related_name='balance_set', on_delete=django.db.models.deletion.CASCADE, to='regnskab.Session')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sessionbalance',
+            unique_together=set([('session', 'profile')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='newsletterbalance',
+            unique_together=set([('newsletter', 'profile')]),
+        ),
+    ]
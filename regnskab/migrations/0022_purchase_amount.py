@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0021_sessionbalance_newsletterbalance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='amount',
+            field=models.DecimalField(max_digits=15, decimal_places=6, default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='purchase',
+            name='profile',
+            field=models.ForeignKey(related_name='+', null=True, on_delete=django.db.models.deletion.CASCADE, editable=False, to=profile_model),
+        ),
+        migrations.AlterIndexTogether(
+            name='purchase',
+            index_together=set([('profile', 'amount')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F
+
+
+def populate_purchase_amount(apps, schema_editor):
+    Purchase = apps.get_model('regnskab', 'Purchase')
+    PurchaseKind = apps.get_model('regnskab', 'PurchaseKind')
+    SheetRow = apps.get_model('regnskab', 'SheetRow')
+    # UPDATE cannot refer to joined fields, so update one kind
+    # and one profile at a time.
+    kinds = PurchaseKind.objects.values_list('id', 'unit_price')
+    for kind_id, unit_price in kinds:
+        Purchase.objects.filter(kind_id=kind_id).update(
+            amount=F('count') * unit_price)
+    profile_ids = SheetRow.objects.exclude(profile_id=None).values_list(
+        'profile_id', flat=True).distinct().order_by()
+    for profile_id in profile_ids:
+        Purchase.objects.filter(row__profile_id=profile_id).update(
+            profile_id=profile_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0022_purchase_amount'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_purchase_amount),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0023_populate_purchase_amount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KindTotal',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('period', models.IntegerField(verbose_name='Årgang')),
+                ('kind', models.CharField(max_length=200)),
+                ('total', models.DecimalField(max_digits=15, decimal_places=4)),
+                ('session', models.ForeignKey(related_name='+', null=True, on_delete=django.db.models.deletion.CASCADE, to='regnskab.Session')),
+                ('sheet', models.ForeignKey(related_name='+', null=True, on_delete=django.db.models.deletion.CASCADE, to='regnskab.Sheet')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='kindtotal',
+            index_together=set([('period', 'session', 'sheet')]),
+        ),
+    ]
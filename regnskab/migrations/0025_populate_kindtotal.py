@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F, Sum
+
+
+def sum_matrix(qs, column_spec, row_spec, value_spec):
+    # Copy of regnskab.utils.sum_matrix, so that later changes to it
+    # do not change this migration.
+    qs = qs.order_by()
+    qs = qs.annotate(row_spec=F(row_spec), column_spec=F(column_spec))
+    qs = qs.values('row_spec', 'column_spec')
+    qs = qs.annotate(value_spec=Sum(value_spec))
+    res = {}
+    for record in qs:
+        cells = res.setdefault(record['column_spec'], {})
+        cells[record['row_spec']] = record['value_spec']
+    return res
+
+
+def populate_kindtotal(apps, schema_editor):
+    Purchase = apps.get_model('regnskab', 'Purchase')
+    Transaction = apps.get_model('regnskab', 'Transaction')
+    Sheet = apps.get_model('regnskab', 'Sheet')
+    KindTotal = apps.get_model('regnskab', 'KindTotal')
+
+    by_period = sum_matrix(Purchase.objects.all(),
+                           'kind__name', 'row__sheet__period', 'count')
+    by_period.update(sum_matrix(Transaction.objects.all(),
+                                'kind', 'period', 'amount'))
+    by_session = sum_matrix(
+        Purchase.objects.exclude(row__sheet__session=None),
+        'kind__name', 'row__sheet__session_id', 'count')
+    by_session.update(sum_matrix(
+        Transaction.objects.exclude(session=None),
+        'kind', 'session_id', 'amount'))
+    by_sheet = sum_matrix(
+        Purchase.objects.filter(row__sheet__session=None),
+        'kind__name', 'row__sheet_id', 'count')
+    by_sheet_time = sum_matrix(
+        Transaction.objects.filter(session=None), 'kind', 'time', 'amount')
+    if by_sheet_time:
+        date_to_sheet = dict(
+            Sheet.objects.filter(session=None).values_list('end_date', 'id'))
+        for kind, column in by_sheet_time.items():
+            output = by_sheet.setdefault(kind, {})
+            for time, v in column.items():
+                sheet_id = date_to_sheet.get(time.date())
+                if sheet_id is not None:
+                    output[sheet_id] = output.get(sheet_id, 0) + v
+
+    session_period = dict(
+        apps.get_model('regnskab', 'Session').objects.values_list(
+            'id', 'period'))
+    sheet_period = dict(Sheet.objects.values_list('id', 'period'))
+    totals = [KindTotal(period=period, kind=kind, total=total)
+              for kind, column in by_period.items()
+              for period, total in column.items()]
+    totals += [KindTotal(period=session_period[session_id],
+                         session_id=session_id, kind=kind, total=total)
+               for kind, column in by_session.items()
+               for session_id, total in column.items()]
+    totals += [KindTotal(period=sheet_period[sheet_id],
+                         sheet_id=sheet_id, kind=kind, total=total)
+               for kind, column in by_sheet.items()
+               for sheet_id, total in column.items()]
+    KindTotal.objects.all().delete()
+    KindTotal.objects.bulk_create(totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0024_kindtotal'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_kindtotal),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0025_populate_kindtotal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('position', models.PositiveIntegerField()),
+                ('date', models.DateField()),
+                ('href', models.CharField(max_length=200, blank=True)),
+                ('name', models.TextField()),
+                ('amount', models.DecimalField(max_digits=15, decimal_places=6, null=True)),
+                ('balance', models.DecimalField(max_digits=15, decimal_places=6)),
+                ('profile', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to=profile_model)),
+            ],
+            options={
+                'ordering': ['profile', 'position'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='timelineentry',
+            unique_together=set([('profile', 'position')]),
+        ),
+    ]
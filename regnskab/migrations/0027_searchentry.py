@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0026_timelineentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=10)),
+                ('object_id', models.IntegerField()),
+                ('display', models.CharField(max_length=200)),
+                ('key', models.CharField(max_length=200, db_index=True)),
+                ('gfyear', models.IntegerField(null=True, db_index=True)),
+                ('active', models.BooleanField(default=True)),
+                ('size', models.PositiveIntegerField(help_text='antal trigrammer')),
+                ('profile', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to=profile_model)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchTrigram',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('trigram', models.CharField(max_length=3)),
+                ('entry', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to='regnskab.SearchEntry')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchentry',
+            unique_together=set([('kind', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='searchtrigram',
+            index_together=set([('trigram', 'entry')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('regnskab', '0027_searchentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=200, blank=True)),
+                ('arguments', jsonfield.fields.JSONField(default={})),
+                ('state', models.CharField(max_length=10, choices=[('pending', 'I kø'), ('running', 'I gang'), ('done', 'Færdig'), ('failed', 'Fejlet')], default='pending')),
+                ('progress', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(null=True, blank=True)),
+                ('message', models.TextField(blank=True)),
+                ('next_url', models.CharField(max_length=200, blank=True)),
+                ('output', models.BinaryField(null=True, blank=True)),
+                ('output_type', models.CharField(max_length=100, blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('started_time', models.DateTimeField(null=True, blank=True)),
+                ('finished_time', models.DateTimeField(null=True, blank=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created_time'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('state', 'kind', 'key')]),
+        ),
+    ]
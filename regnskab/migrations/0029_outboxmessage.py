@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+import jsonfield.fields
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0028_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('from_email', models.CharField(max_length=255)),
+                ('recipients', jsonfield.fields.JSONField(default=[])),
+                ('message', models.BinaryField()),
+                ('batch', models.CharField(max_length=32, db_index=True)),
+                ('state', models.CharField(max_length=10, choices=[('pending', 'Venter'), ('sending', 'Sendes'), ('sent', 'Sendt'), ('failed', 'Fejlet')], default='pending')),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt_time', models.DateTimeField(null=True, blank=True)),
+                ('claimed_time', models.DateTimeField(null=True, blank=True)),
+                ('sent_time', models.DateTimeField(null=True, blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('newsletter', models.ForeignKey(null=True, blank=True, on_delete=django.db.models.deletion.CASCADE, to='regnskab.Newsletter')),
+                ('profile', models.ForeignKey(null=True, blank=True, related_name='+', on_delete=django.db.models.deletion.SET_NULL, to=profile_model)),
+                ('session', models.ForeignKey(null=True, blank=True, on_delete=django.db.models.deletion.CASCADE, to='regnskab.Session')),
+            ],
+            options={
+                'ordering': ['pk'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxmessage',
+            index_together=set([('state', 'next_attempt_time')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+profile_model = settings.TKWEB_IDM_MODULE.split('.')[-1] + '.Profile'
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(profile_model),
+        ('regnskab', '0029_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrossesImage',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=40)),
+                ('png', models.BinaryField(null=True)),
+                ('updated_time', models.DateTimeField(auto_now=True)),
+                ('profile', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to=profile_model)),
+                ('session', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.CASCADE, to='regnskab.Session')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='crossesimage',
+            unique_together=set([('session', 'profile')]),
+        ),
+    ]
@@ -0,0 +1,249 @@
+'''
+Assembly of the MIME messages of a session or newsletter.
+
+The rows of each profile in the sheet images of a session are stitched
+into the krydser.png attachment by update_crosses_images(), which stores
+it as a CrossesImage in the background when the rows of a sheet change,
+so sending and previewing only read the stored PNG.
+
+Making any missing krydser.png, rendering the HTML inlines and serializing
+the messages is CPU-bound, so build_messages() can spread it over a pool
+of worker processes (REGNSKAB_MIME_WORKERS, by default one per CPU). The
+emails are built in batches that are yielded in order as soon as they are
+done, so the caller can store or send them while the rest are built.
+'''
+
+import os
+import hashlib
+import concurrent.futures
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.transaction import atomic
+
+from regnskab.models import Email, SheetRow, CrossesImage
+
+
+WORKERS = getattr(settings, 'REGNSKAB_MIME_WORKERS', None)
+BATCH_SIZE = 20
+
+
+def get_rows_by_profile(session, profile_ids):
+    '''
+    Map each of the given profile ids to the list of its SheetRows
+    with an image in the session, with the sheet of each row cached.
+    '''
+    rows_by_profile = {p_id: [] for p_id in profile_ids}
+    sheets = session.sheet_set.exclude(row_image=None).exclude(row_image='')
+    sheets = sheets.order_by('pk').prefetch_related('sheetrow_set')
+    for sheet in sheets:
+        for row in sheet.sheetrow_set.all():
+            try:
+                p = rows_by_profile[row.profile_id]
+            except KeyError:
+                continue
+            if row.image_start is not None and row.image_stop is not None:
+                row.sheet = sheet
+                p.append(row)
+    return rows_by_profile
+
+
+def crosses_image_key(rows):
+    '''
+    Identify the image made from the given rows. The row images are not
+    changed once saved, and a changed row is saved as a new SheetRow.
+    '''
+    data = repr([(row.pk, row.sheet.row_image.name,
+                  row.image_start, row.image_stop) for row in rows])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def stitch_rows(images):
+    '''
+    Stack row images on top of each other, padding them to the same width.
+    '''
+    import numpy as np
+
+    if not images:
+        return None
+    image_width = max(image.shape[1] for image in images)
+    for i, image in enumerate(images):
+        if image.shape[1] < image_width:
+            images[i] = np.pad(
+                image,
+                [(0, 0), (0, image_width - image.shape[1])],
+                'maximum')
+    return np.concatenate(images)
+
+
+class RowImages:
+    '''
+    Load the row image of each sheet at most once.
+    '''
+
+    def __init__(self):
+        self.images = {}
+
+    def get(self, row):
+        from regnskab.images.cache import load_row_image
+
+        try:
+            row_image = self.images[row.sheet.pk]
+        except KeyError:
+            row_image = self.images[row.sheet.pk] = load_row_image(row.sheet)
+        return row_image[row.image_start:row.image_stop]
+
+    def stitch(self, rows):
+        return stitch_rows([self.get(row) for row in rows])
+
+
+def get_image_for_emails(emails):
+    '''
+    Generate the stitched row images (NumPy arrays) of the given session
+    emails by decoding the sheet images. Used by update_crosses_images().
+    '''
+    assert all(isinstance(email, Email) for email in emails)
+    if not emails:
+        return
+    session = emails[0].session
+    assert all(email.session == session for email in emails)
+    assert all(email.profile_id for email in emails)
+    rows_by_profile = get_rows_by_profile(
+        session, [email.profile_id for email in emails])
+    row_images = RowImages()
+    for email in emails:
+        yield row_images.stitch(rows_by_profile[email.profile_id])
+
+
+def update_crosses_images(session, profile_ids=None, progress=None):
+    '''
+    Store the krydser.png of the given profiles (by default, all profiles
+    with rows in the session) in CrossesImage, unless the stored image is
+    up to date. Return a dict mapping each profile id to its CrossesImage.
+    '''
+    from regnskab.images.utils import save_png
+
+    if profile_ids is None:
+        profile_ids = set(SheetRow.objects.filter(
+            sheet__session=session).exclude(profile=None).values_list(
+                'profile_id', flat=True))
+    profile_ids = sorted(set(profile_ids))
+    rows_by_profile = get_rows_by_profile(session, profile_ids)
+    stored = {
+        o.profile_id: o
+        for o in CrossesImage.objects.filter(
+            session=session, profile_id__in=profile_ids)}
+    row_images = RowImages()
+    result = {}
+    for i, p_id in enumerate(profile_ids):
+        rows = rows_by_profile[p_id]
+        key = crosses_image_key(rows)
+        o = stored.get(p_id)
+        if o is None or o.key != key:
+            image = row_images.stitch(rows)
+            png = None if image is None else save_png(image)
+            if o is None:
+                o = CrossesImage(session=session, profile_id=p_id)
+            o.key = key
+            o.png = png
+            try:
+                with atomic():
+                    o.save()
+            except IntegrityError:
+                # Stored by another process in the meantime.
+                pass
+        result[p_id] = o
+        if progress is not None:
+            progress(i + 1, len(profile_ids))
+    return result
+
+
+def get_crosses_pngs(emails):
+    '''
+    Return the krydser.png (bytes or None) of each of the given emails.
+    Images that are not stored yet (or out of date) are made and stored
+    now. NewsletterEmails have no image.
+    '''
+    emails = list(emails)
+    if not emails or not isinstance(emails[0], Email):
+        return [None] * len(emails)
+    images = update_crosses_images(emails[0].session,
+                                   [e.profile_id for e in emails])
+    return [None if images[e.profile_id].png is None
+            else bytes(images[e.profile_id].png)
+            for e in emails]
+
+
+def get_crosses_image(email):
+    '''
+    Return the up to date CrossesImage of a session Email.
+    '''
+    return update_crosses_images(email.session, [email.profile_id])[
+        email.profile_id]
+
+
+def build_message(email, png=None, override_recipient=None):
+    '''
+    Return (from_email, recipients, MIME bytes) of an Email or
+    NewsletterEmail with the given PNG attached as krydser.png.
+    '''
+    message = email.to_message()
+    if png is not None:
+        message.attach('krydser.png', png, 'image/png')
+    if override_recipient:
+        message.to = [override_recipient]
+    return (message.from_email, message.recipients(),
+            message.message().as_bytes())
+
+
+def send_test_email(email, override_recipient):
+    '''
+    Build and send a single email to override_recipient right away.
+    The message is not attributed to the session or newsletter in the
+    outbox, so it does not count as sent to the profile.
+    '''
+    from regnskab.outbox import queue_raw_messages, process_outbox
+
+    items = list(build_messages([email], override_recipient, workers=1))
+    queued = queue_raw_messages(items, profiles=[email.profile])
+    return process_outbox(ids=[o.pk for o in queued])
+
+
+def _build_batch(emails, override_recipient):
+    # Runs in a worker process, which opens its own database connection.
+    pngs = get_crosses_pngs(emails)
+    return [build_message(e, png, override_recipient)
+            for e, png in zip(emails, pngs)]
+
+
+def build_messages(emails, override_recipient=None, workers=None,
+                   batch_size=BATCH_SIZE):
+    '''
+    Generate build_message() of each email, in order. Emails of a Session
+    get the rows of their sheet images attached, which are made in the
+    batch of the email if they are not stored yet.
+
+    With workers > 1, the messages are built in that many processes.
+    The database connections are closed first, since the workers are
+    forked and must not share them.
+    '''
+    emails = list(emails)
+    batches = [emails[i:i+batch_size]
+               for i in range(0, len(emails), batch_size)]
+
+    if workers is None:
+        workers = WORKERS or os.cpu_count() or 1
+    workers = min(workers, len(batches))
+    if workers <= 1:
+        for batch in batches:
+            yield from _build_batch(batch, override_recipient)
+        return
+
+    from regnskab.jobs import close_connections
+
+    close_connections()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(_build_batch, batches,
+                               [override_recipient] * len(batches))
+        for result in results:
+            yield from result
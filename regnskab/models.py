@@ -1,5 +1,7 @@
 import os
 import re
+import copy
+import bisect
 import base64
 import hashlib
 import logging
@@ -7,13 +9,15 @@ import datetime
 import tempfile
 import functools
 import itertools
+import threading
 import contextlib
 from collections import namedtuple, OrderedDict
 from decimal import Decimal
 
 from django.core.exceptions import ValidationError, ImproperlyConfigured
-from django.db import models
-from django.db.models import F
+from django.db import models, connection, IntegrityError
+from django.db.models import F, Case, When, Value
+from django.db.transaction import atomic
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.mail import EmailMessage
@@ -28,8 +32,9 @@ from jsonfield import JSONField
 import tktitler as tk
 
 from regnskab.rules import get_default_prices
+from regnskab.fixedpoint import COUNT, AMOUNT, to_fixed, from_fixed
 from regnskab.utils import (
-    sum_vector, sum_matrix, plain_to_html, html_to_plain, EmailMultiRelated,
+    sum_vector, sum_matrix, title_prefix, plain_to_html, EmailMultiRelated,
 )
 
 logger = logging.getLogger('regnskab')
@@ -201,6 +206,175 @@ def get_primary_titles(*args, **kwargs):
     return {p: ts[0] for p, ts in all_titles.items()}
 
 
+def trigrams(s):
+    '''
+    The set of trigrams of the lowercased words of s, each word padded
+    with two spaces in front and one behind.
+
+    >>> sorted(trigrams('Ab'))
+    ['  a', ' ab', 'ab ']
+    '''
+    result = set()
+    for word in s.lower().split():
+        w = '  %s ' % word
+        result.update(w[i:i+3] for i in range(len(w) - 2))
+    return result
+
+
+class SearchEntry(models.Model):
+    '''
+    A string that ProfileSearch matches against: the (prefixed) alias or
+    title, or the name of a profile. Aliases and profile names also have
+    their trigrams in SearchTrigram for the fuzzy search. Titles only take
+    part in exact matches, so they are only looked up by key.
+
+    Maintained by update_search_index() when aliases, titles and profiles
+    are saved, and rebuilt by rebuild_search_index().
+    '''
+
+    ALIAS, TITLE, PROFILE = 'alias', 'title', 'profile'
+
+    kind = models.CharField(max_length=10)
+    object_id = models.IntegerField()
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE,
+                                related_name='+')
+    display = models.CharField(max_length=200)
+    # Lowercased display, with $ replaced by s for titles
+    key = models.CharField(max_length=200, db_index=True)
+    # The GFYEAR the display is prefixed relative to, or None if the
+    # alias or title has no period
+    gfyear = models.IntegerField(null=True, db_index=True)
+    # False for aliases that have ended
+    active = models.BooleanField(default=True)
+    size = models.PositiveIntegerField(help_text='antal trigrammer')
+
+    class Meta:
+        unique_together = [('kind', 'object_id')]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.kind, self.object_id, self.display)
+
+
+class SearchTrigram(models.Model):
+    entry = models.ForeignKey(SearchEntry, on_delete=models.CASCADE,
+                              related_name='+')
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        index_together = [('trigram', 'entry')]
+
+
+def _search_entry(o, gfyear):
+    if isinstance(o, Alias):
+        display = title_prefix(o, gfyear) if o.period else o.root
+        return SearchEntry(
+            kind=SearchEntry.ALIAS, object_id=o.pk, profile_id=o.profile_id,
+            display=display, key=display.lower(),
+            gfyear=gfyear if o.period else None,
+            active=o.end_time is None)
+    elif isinstance(o, Title):
+        display = title_prefix(o, gfyear) if o.period else o.root
+        return SearchEntry(
+            kind=SearchEntry.TITLE, object_id=o.pk, profile_id=o.profile_id,
+            display=display, key=display.lower().replace('$', 's'),
+            gfyear=gfyear if o.period else None)
+    else:
+        return SearchEntry(
+            kind=SearchEntry.PROFILE, object_id=o.pk, profile_id=o.pk,
+            display=o.name, key=o.name.lower())
+
+
+def _search_kind(o):
+    if isinstance(o, Alias):
+        return SearchEntry.ALIAS
+    elif isinstance(o, Title):
+        return SearchEntry.TITLE
+    else:
+        return SearchEntry.PROFILE
+
+
+def update_search_index(objects, gfyear=None):
+    '''
+    Save the SearchEntry and SearchTrigram objects of the given Alias,
+    Title and Profile objects, replacing any existing entries.
+    '''
+    if gfyear is None:
+        gfyear = config.GFYEAR
+    objects = list(objects)
+    entries = [_search_entry(o, gfyear) for o in objects]
+    grams = []
+    for e in entries:
+        if e.kind != SearchEntry.TITLE:
+            grams.append(trigrams(e.display))
+        else:
+            grams.append(set())
+        e.size = len(grams[-1])
+    with atomic():
+        delete_search_entries(objects)
+        for e in entries:
+            e.save()
+        SearchTrigram.objects.bulk_create([
+            SearchTrigram(entry=e, trigram=g)
+            for e, gs in zip(entries, grams) for g in sorted(gs)])
+
+
+def delete_search_entries(objects):
+    by_kind = {}
+    for o in objects:
+        by_kind.setdefault(_search_kind(o), []).append(o.pk)
+    for kind, ids in by_kind.items():
+        SearchEntry.objects.filter(kind=kind, object_id__in=ids).delete()
+
+
+def rebuild_search_index():
+    gfyear = config.GFYEAR
+    with atomic():
+        SearchEntry.objects.all().delete()
+        update_search_index(
+            itertools.chain(Alias.objects.all(), Title.objects.all(),
+                            Profile.objects.all()),
+            gfyear)
+
+
+_search_index_gfyear = None
+
+
+def refresh_search_index():
+    '''
+    Rebuild the search index if it is empty or if the prefixes of titles
+    and aliases were computed relative to an old GFYEAR.
+
+    Only checks the database the first time it is called in a process
+    and when config.GFYEAR has changed since, so that it is cheap enough
+    to call before every search.
+    '''
+    global _search_index_gfyear
+
+    gfyear = config.GFYEAR
+    if _search_index_gfyear == gfyear:
+        return
+    if not SearchEntry.objects.exists():
+        if Profile.objects.exists():
+            rebuild_search_index()
+    else:
+        stale = SearchEntry.objects.exclude(gfyear=None)
+        stale = stale.exclude(gfyear=gfyear)
+        if stale.exists():
+            update_search_index(
+                itertools.chain(Alias.objects.exclude(period=None),
+                                Title.objects.all()),
+                gfyear)
+    _search_index_gfyear = gfyear
+
+
+def search_object_saved(sender, instance, **kwargs):
+    update_search_index([instance])
+
+
+def search_object_deleted(sender, instance, **kwargs):
+    delete_search_entries([instance])
+
+
 def slugify(string):
     return dslugify(unidecode(string))
 
@@ -288,7 +462,7 @@ class Sheet(models.Model):
                     row['profile'].name if row['profile'] else '')
             else:
                 row['display_title'] = (
-                    tk.prefix(title, self.period, type='unicode')
+                    title_prefix(title, self.period, type='unicode')
                     if title.period else title.root)
                 row['title_name'] = ' '.join(
                     (row['display_title'], row['profile'].name))
@@ -466,10 +640,32 @@ class Purchase(models.Model):
     kind = models.ForeignKey(PurchaseKind)
     count = models.DecimalField(max_digits=9, decimal_places=4,
                                 help_text='antal krydser eller brøkdel')
+    # Denormalized row.profile and count * kind.unit_price,
+    # set by set_amount() so that balances can be summed without joins.
+    profile = models.ForeignKey(Profile, null=True, editable=False,
+                                related_name='+')
+    amount = models.DecimalField(max_digits=15, decimal_places=6,
+                                 editable=False)
 
     def __str__(self):
         return '%g× %s' % (self.count, self.kind)
 
+    def set_amount(self):
+        '''
+        Update the denormalized profile and amount. Must be called on
+        instances that are saved with bulk_create(), since save() is
+        not called in that case.
+        '''
+        self.profile_id = self.row.profile_id
+        # count and unit_price may still be floats or ints from a form or
+        # a fixture; go through str() so the product is the exact Decimal.
+        self.amount = (Decimal(str(self.count)) *
+                       Decimal(str(self.kind.unit_price)))
+
+    def save(self, *args, **kwargs):
+        self.set_amount()
+        super().save(*args, **kwargs)
+
     def get_count_display(self):
         if self.count % 1 == 0:
             return str(int(self.count))
@@ -478,21 +674,25 @@ class Purchase(models.Model):
 
     class Meta:
         ordering = ['row', 'kind__position']
+        index_together = [('profile', 'amount')]
         verbose_name = 'krydser'
         verbose_name_plural = verbose_name
 
 
-def compute_balance(profile_ids=None, created_before=None, *,
-                    output_matrix=False, purchases_after=None):
+def compute_balance_orm(profile_ids=None, created_before=None, *,
+                        output_matrix=False, purchases_after=None):
+    '''
+    Reference implementation of compute_balance() using four separate
+    aggregation queries. Used by the benchmark_balance command.
+    '''
     purchase_qs = Purchase.objects.all()
     if created_before:
         purchase_qs = purchase_qs.filter(
             row__sheet__created_time__lt=created_before)
     if profile_ids:
-        purchase_qs = purchase_qs.filter(row__profile_id__in=profile_ids)
-    purchase_qs = purchase_qs.exclude(row__profile_id=None)
-    balance = sum_vector(purchase_qs, 'row__profile_id',
-                         F('count') * F('kind__unit_price'))
+        purchase_qs = purchase_qs.filter(profile_id__in=profile_ids)
+    purchase_qs = purchase_qs.exclude(profile_id=None)
+    balance = sum_vector(purchase_qs, 'profile_id', 'amount')
 
     transaction_qs = Transaction.objects.all()
     if profile_ids:
@@ -511,7 +711,7 @@ def compute_balance(profile_ids=None, created_before=None, *,
                 row__sheet__start_date__gte=purchases_after)
             transaction_qs = transaction_qs.filter(time__gt=purchases_after)
         purchases = sum_matrix(purchase_qs, 'kind__name',
-                               'row__profile_id', 'count')
+                               'profile_id', 'count')
         purchases.update(sum_matrix(transaction_qs, 'kind',
                                     'profile_id', 'amount'))
         return balance, purchases
@@ -519,6 +719,414 @@ def compute_balance(profile_ids=None, created_before=None, *,
         return balance
 
 
+def _sum_to_decimal(value, places):
+    '''
+    SUM() of decimal columns is returned as Decimal by PostgreSQL,
+    but as int or float by SQLite.
+    '''
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(repr(value)).quantize(Decimal(10) ** -places)
+
+
+def _sum_to_fixed(value, places):
+    '''
+    Convert SUM() of a decimal column to an int in units of 10**-places.
+    '''
+    if isinstance(value, float):
+        value = _sum_to_decimal(value, places)
+    return to_fixed(value, places)
+
+
+def compute_balance(profile_ids=None, created_before=None, *,
+                    output_matrix=False, purchases_after=None):
+    '''
+    Compute the balance of each profile, and if output_matrix=True,
+    also the matrix d[kind][profile_id] of purchase counts and
+    transaction amounts (since purchases_after, if given).
+
+    The balance and the matrix are computed in a single query by grouping
+    the UNION ALL of signed purchase and transaction amounts.
+    The result is the same as compute_balance_orm().
+    '''
+    qn = connection.ops.quote_name
+
+    def table(model, alias):
+        return '%s %s' % (qn(model._meta.db_table), alias)
+
+    def col(alias, model, field_name):
+        return '%s.%s' % (alias, qn(model._meta.get_field(field_name).column))
+
+    def param(model, field_name, value):
+        return model._meta.get_field(field_name).get_db_prep_value(
+            value, connection)
+
+    # Purchase.profile and Purchase.amount are denormalized,
+    # so only join the tables that the filters and the matrix need.
+    p_from = [table(Purchase, 'p')]
+    if output_matrix:
+        p_from.append('INNER JOIN %s ON %s = %s' % (
+            table(PurchaseKind, 'k'), col('p', Purchase, 'kind'),
+            col('k', PurchaseKind, 'id')))
+    if created_before or (output_matrix and purchases_after):
+        p_from.append('INNER JOIN %s ON %s = %s' % (
+            table(SheetRow, 'r'), col('p', Purchase, 'row'),
+            col('r', SheetRow, 'id')))
+        p_from.append('INNER JOIN %s ON %s = %s' % (
+            table(Sheet, 's'), col('r', SheetRow, 'sheet'),
+            col('s', Sheet, 'id')))
+    p_where = ['%s IS NOT NULL' % col('p', Purchase, 'profile')]
+    p_where_params = []
+    t_where = ['1 = 1']
+    t_where_params = []
+    if created_before:
+        p_where.append('%s < %%s' % col('s', Sheet, 'created_time'))
+        p_where_params.append(param(Sheet, 'created_time', created_before))
+        t_where.append('%s < %%s' % col('t', Transaction, 'created_time'))
+        t_where_params.append(
+            param(Transaction, 'created_time', created_before))
+    if profile_ids:
+        profile_ids = list(profile_ids)
+        placeholders = ', '.join(['%s'] * len(profile_ids))
+        p_where.append('%s IN (%s)' % (col('p', Purchase, 'profile'),
+                                       placeholders))
+        p_where_params.extend(profile_ids)
+        t_where.append('%s IN (%s)' % (col('t', Transaction, 'profile'),
+                                       placeholders))
+        t_where_params.extend(profile_ids)
+
+    p_matrix = t_matrix = 'NULL'
+    p_matrix_params = []
+    t_matrix_params = []
+    if output_matrix and purchases_after:
+        p_matrix = 'CASE WHEN %s >= %%s THEN %s END' % (
+            col('s', Sheet, 'start_date'), col('p', Purchase, 'count'))
+        p_matrix_params.append(param(Sheet, 'start_date', purchases_after))
+        t_matrix = 'CASE WHEN %s > %%s THEN %s END' % (
+            col('t', Transaction, 'time'), col('t', Transaction, 'amount'))
+        t_matrix_params.append(param(Transaction, 'time', purchases_after))
+    elif output_matrix:
+        p_matrix = col('p', Purchase, 'count')
+        t_matrix = col('t', Transaction, 'amount')
+
+    purchase_sql = (
+        'SELECT %s AS profile_id, %s AS kind, %s AS amount, ' +
+        '%s AS matrix_value FROM %s WHERE %s') % (
+            col('p', Purchase, 'profile'),
+            col('k', PurchaseKind, 'name') if output_matrix else 'NULL',
+            col('p', Purchase, 'amount'),
+            p_matrix, ' '.join(p_from), ' AND '.join(p_where))
+    transaction_sql = (
+        'SELECT %s AS profile_id, %s AS kind, %s AS amount, ' +
+        '%s AS matrix_value FROM %s WHERE %s') % (
+            col('t', Transaction, 'profile'), col('t', Transaction, 'kind'),
+            col('t', Transaction, 'amount'), t_matrix,
+            table(Transaction, 't'), ' AND '.join(t_where))
+    params = (p_matrix_params + p_where_params +
+              t_matrix_params + t_where_params)
+
+    if output_matrix:
+        sql = ('SELECT profile_id, kind, SUM(amount), SUM(matrix_value) ' +
+               'FROM (%s UNION ALL %s) ledger GROUP BY profile_id, kind')
+    else:
+        sql = ('SELECT profile_id, NULL, SUM(amount), NULL ' +
+               'FROM (%s UNION ALL %s) ledger GROUP BY profile_id')
+    with connection.cursor() as cursor:
+        cursor.execute(sql % (purchase_sql, transaction_sql), params)
+        rows = cursor.fetchall()
+
+    # The matrix holds purchase counts, except in the rows of transaction
+    # kinds, which hold transaction amounts.
+    transaction_kinds = set(k for k, label in Transaction.KIND)
+    balance = {}
+    matrix = {}
+    for profile_id, kind, amount, matrix_value in rows:
+        balance[profile_id] = (balance.get(profile_id, 0) +
+                               _sum_to_fixed(amount, AMOUNT))
+        if matrix_value is not None:
+            places = AMOUNT if kind in transaction_kinds else COUNT
+            matrix.setdefault(kind, {})[profile_id] = (
+                _sum_to_decimal(matrix_value, places))
+    balance = {p_id: from_fixed(b, AMOUNT) for p_id, b in balance.items()}
+    if output_matrix:
+        return balance, matrix
+    else:
+        return balance
+
+
+class ProfileBalance(models.Model):
+    '''
+    Materialized result of compute_balance() for each profile.
+
+    Maintained by ledger_changed() and rebuilt by rebuild_balances()
+    (or the rebuild_balances management command).
+    '''
+
+    profile = models.OneToOneField(Profile, on_delete=models.CASCADE,
+                                   primary_key=True, related_name='+')
+    balance = models.DecimalField(max_digits=15, decimal_places=6)
+
+    def __str__(self):
+        return '%s: %.2f kr.' % (self.profile_id, self.balance)
+
+
+def get_balances(profile_ids=None):
+    '''
+    Same as compute_balance(profile_ids), but reads the ProfileBalance
+    ledger instead of aggregating every Purchase and Transaction.
+    '''
+    qs = ProfileBalance.objects.all()
+    if profile_ids:
+        qs = qs.filter(profile_id__in=profile_ids)
+    return dict(qs.values_list('profile_id', 'balance'))
+
+
+def update_balances(profile_ids):
+    profile_ids = set(p_id for p_id in profile_ids if p_id is not None)
+    if not profile_ids:
+        return
+    balances = compute_balance(profile_ids=profile_ids)
+    with atomic():
+        ProfileBalance.objects.filter(profile_id__in=profile_ids).delete()
+        ProfileBalance.objects.bulk_create([
+            ProfileBalance(profile_id=p_id, balance=balance)
+            for p_id, balance in balances.items()])
+
+
+def rebuild_balances():
+    bump_version(LEDGER_VERSION_KEY)
+    balances = compute_balance()
+    with atomic():
+        ProfileBalance.objects.all().delete()
+        ProfileBalance.objects.bulk_create([
+            ProfileBalance(profile_id=p_id, balance=balance)
+            for p_id, balance in balances.items()])
+        # Timelines are rebuilt lazily by ProfileDetail.
+        TimelineEntry.objects.all().delete()
+    email_sets = itertools.chain(Session.objects.all(),
+                                 Newsletter.objects.all())
+    for email_set in email_sets:
+        snapshot_initial_balances(email_set)
+    return len(balances)
+
+
+def check_balances():
+    '''
+    Compare the ProfileBalance ledger to compute_balance().
+    Returns a list of (profile_id, stored, computed) for each profile
+    whose balances differ by at least one øre.
+    '''
+    def round_balance(b):
+        return None if b is None else b.quantize(Decimal('0.01'))
+
+    stored = get_balances()
+    computed = compute_balance()
+    mismatches = []
+    for p_id in sorted(stored.keys() | computed.keys()):
+        s, c = stored.get(p_id), computed.get(p_id)
+        if round_balance(s) != round_balance(c):
+            mismatches.append((p_id, s, c))
+    return mismatches
+
+
+def ledger_changed(profile_ids, since=None, periods=()):
+    '''
+    Must be called after Purchase, SheetRow or Transaction objects
+    are saved or deleted, with the ids of the profiles they belong(ed) to.
+
+    If the changed objects existed before this request, `since` must be
+    the earliest created_time of the changed Transactions and Sheets,
+    so that the opening balances of later sessions can be updated.
+
+    `periods` are the Sheet, Session and Transaction periods of the
+    changed objects, whose KindTotal rollups are recomputed.
+    '''
+    profile_ids = set(profile_ids)
+    update_balances(profile_ids)
+    if since is not None:
+        update_initial_balances(profile_ids, since)
+    update_kind_totals(periods)
+    timeline_changed(profile_ids)
+    bump_version(LEDGER_VERSION_KEY)
+
+
+class TimelineEntry(models.Model):
+    '''
+    One row of the table on ProfileDetail: a sheet, a transaction or
+    a sent email, with the balance after the row (the prefix sum of
+    amounts up to and including the row).
+
+    The entries of a profile are deleted by timeline_changed() and saved
+    again by save_timeline() when ProfileDetail is next shown.
+    '''
+
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE,
+                                related_name='+')
+    position = models.PositiveIntegerField()
+    date = models.DateField()
+    href = models.CharField(max_length=200, blank=True)
+    name = models.TextField()
+    amount = models.DecimalField(max_digits=15, decimal_places=6,
+                                 null=True)
+    balance = models.DecimalField(max_digits=15, decimal_places=6)
+
+    class Meta:
+        ordering = ['profile', 'position']
+        unique_together = [('profile', 'position')]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.profile_id, self.date, self.name)
+
+
+def timeline_changed(profile_ids):
+    profile_ids = set(p_id for p_id in profile_ids if p_id is not None)
+    if profile_ids:
+        TimelineEntry.objects.filter(profile_id__in=profile_ids).delete()
+
+
+def save_timeline(profile, rows):
+    '''
+    Replace the timeline of the profile by the given rows,
+    which are (date, href, amount, name) in chronological order.
+    '''
+    entries = []
+    balance = 0  # In units of 10**-AMOUNT kr.
+    for i, (date, href, amount, name) in enumerate(rows):
+        if amount is not None:
+            balance += to_fixed(amount, AMOUNT)
+        entries.append(TimelineEntry(
+            profile=profile, position=i + 1, date=date, href=href or '',
+            name=name, amount=amount, balance=from_fixed(balance, AMOUNT)))
+    try:
+        with atomic():
+            TimelineEntry.objects.filter(profile=profile).delete()
+            TimelineEntry.objects.bulk_create(entries)
+    except IntegrityError:
+        # A concurrent request saved the timeline first.
+        pass
+
+
+class KindTotal(models.Model):
+    '''
+    Rollup of purchase counts and transaction amounts by kind for either
+    a whole period (session and sheet are None), a session, or a legacy
+    sheet (a sheet without a session) in the period.
+
+    Maintained by ledger_changed() and rebuilt by rebuild_kind_totals().
+    Read by SessionList instead of aggregating the whole ledger.
+    '''
+
+    period = models.IntegerField(verbose_name='Årgang')
+    session = models.ForeignKey('Session', on_delete=models.CASCADE,
+                                null=True, related_name='+')
+    sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE,
+                              null=True, related_name='+')
+    kind = models.CharField(max_length=200)
+    total = models.DecimalField(max_digits=15, decimal_places=4)
+
+    class Meta:
+        index_together = [('period', 'session', 'sheet')]
+
+    def __str__(self):
+        return '%s %s %s %s: %s' % (self.period, self.session_id,
+                                    self.sheet_id, self.kind, self.total)
+
+
+def _kind_totals(period):
+    by_period = sum_vector(
+        Purchase.objects.filter(row__sheet__period=period),
+        'kind__name', 'count')
+    by_period.update(sum_vector(
+        Transaction.objects.filter(period=period), 'kind', 'amount'))
+
+    by_session = sum_matrix(
+        Purchase.objects.filter(row__sheet__session__period=period),
+        'kind__name', 'row__sheet__session_id', 'count')
+    by_session.update(sum_matrix(
+        Transaction.objects.filter(session__period=period),
+        'kind', 'session_id', 'amount'))
+
+    by_sheet = sum_matrix(
+        Purchase.objects.filter(row__sheet__session=None,
+                                row__sheet__period=period),
+        'kind__name', 'row__sheet_id', 'count')
+    # Legacy transactions are attached to the legacy sheet that ends on
+    # the date of the transaction. Transactions on other dates are only
+    # counted in the period total.
+    by_sheet_time = sum_matrix(
+        Transaction.objects.filter(session=None, period=period),
+        'kind', 'time', 'amount')
+    if by_sheet_time:
+        date_to_sheet = dict(
+            Sheet.objects.filter(session=None, period=period).values_list(
+                'end_date', 'id'))
+        for kind, column in by_sheet_time.items():
+            output = by_sheet.setdefault(kind, {})
+            for time, v in column.items():
+                sheet_id = date_to_sheet.get(time.date())
+                if sheet_id is not None:
+                    output[sheet_id] = output.get(sheet_id, 0) + v
+
+    totals = [KindTotal(period=period, kind=kind, total=total)
+              for kind, total in by_period.items()]
+    totals += [KindTotal(period=period, session_id=session_id,
+                         kind=kind, total=total)
+               for kind, column in by_session.items()
+               for session_id, total in column.items()]
+    totals += [KindTotal(period=period, sheet_id=sheet_id,
+                         kind=kind, total=total)
+               for kind, column in by_sheet.items()
+               for sheet_id, total in column.items()]
+    return totals
+
+
+def update_kind_totals(periods):
+    periods = set(p for p in periods if p is not None)
+    if not periods:
+        return
+    with atomic():
+        KindTotal.objects.filter(period__in=periods).delete()
+        KindTotal.objects.bulk_create(
+            [o for period in sorted(periods) for o in _kind_totals(period)])
+
+
+def rebuild_kind_totals():
+    periods = set(Sheet.objects.values_list('period', flat=True))
+    periods |= set(Session.objects.values_list('period', flat=True))
+    periods |= set(Transaction.objects.values_list('period', flat=True))
+    with atomic():
+        KindTotal.objects.all().delete()
+        update_kind_totals(periods)
+
+
+def get_period_totals():
+    '''
+    Return the KindTotal rollups of whole periods as by_period[kind][period].
+    '''
+    qs = KindTotal.objects.filter(session=None, sheet=None)
+    by_period = {}
+    for period, kind, total in qs.values_list('period', 'kind', 'total'):
+        by_period.setdefault(kind, {})[period] = total
+    return by_period
+
+
+def get_session_totals(period):
+    '''
+    Return the KindTotal rollups of the sessions and legacy sheets of the
+    given period as by_session[kind][session_id], by_sheet[kind][sheet_id].
+    '''
+    qs = KindTotal.objects.filter(period=period)
+    by_session = {}
+    by_sheet = {}
+    for session_id, sheet_id, kind, total in qs.values_list(
+            'session_id', 'sheet_id', 'kind', 'total'):
+        if session_id is not None:
+            by_session.setdefault(kind, {})[session_id] = total
+        elif sheet_id is not None:
+            by_sheet.setdefault(kind, {})[sheet_id] = total
+    return by_session, by_sheet
+
+
 class EmailTemplateInline(models.Model):
     mime_type = models.CharField(max_length=255)
     blob = models.BinaryField()
@@ -541,16 +1149,30 @@ class EmailTemplateInline(models.Model):
             return o
 
 
+@functools.lru_cache(maxsize=256)
+def get_inline(pk, hash):
+    '''
+    Return the EmailTemplateInline with the given pk and content hash,
+    or None. An inline is never changed, so it is looked up once per
+    process instead of once per email.
+    '''
+    try:
+        inline = EmailTemplateInline.objects.get(pk=pk, hash=hash)
+    except EmailTemplateInline.DoesNotExist:
+        return None
+    # Read the blob once, and not from a memoryview of the database row.
+    inline.blob = bytes(inline.blob)
+    return inline
+
+
 def _process_inlines(body_html, cb):
     '''
     Internal helper used by body_html_data_uris and body_html_inlines.
     '''
     def repl(mo):
         q1, inline_pk, hash, q2 = mo.groups()
-        try:
-            inline = EmailTemplateInline.objects.get(
-                pk=inline_pk, hash=hash)
-        except EmailTemplateInline.DoesNotExist:
+        inline = get_inline(int(inline_pk), hash)
+        if inline is None:
             res = cb(None)
             return mo.group() if res is None else q1 + res + q2
         else:
@@ -677,6 +1299,8 @@ class EmailTemplate(models.Model):
         '''
         Return body text as plain text, converting from HTML if necessary.
         '''
+        from regnskab.emailtemplate import html_to_plain
+
         if self.markup == EmailTemplate.HTML:
             return html_to_plain(self.body)
         elif self.markup == EmailTemplate.PLAIN:
@@ -684,11 +1308,41 @@ class EmailTemplate(models.Model):
         else:
             raise ValueError(self.markup)
 
+    def compile(self):
+        '''
+        Return the subject, plain text body and HTML body (or None) as
+        regnskab.emailtemplate.CompiledTemplate objects.
+        '''
+        from regnskab.emailtemplate import compile
+
+        body_html = (compile(self.body_html())
+                     if self.markup == EmailTemplate.HTML else None)
+        return compile(self.subject), compile(self.body_plain()), body_html
+
     def __str__(self):
         return self.name or str(self.created_time)
 
 
-def regenerate_emails(email_set):
+def regenerate_emails(email_set, profile_ids=None, progress=None):
+    '''
+    Render the emails of email_set again. If profile_ids is given, only the
+    emails of these profiles are rendered, which is enough after a change
+    that only affects them (e.g. to their sheet rows or transactions).
+    Otherwise all emails are rendered (e.g. after the template changed).
+
+    Titles, names and sheet statuses appear in every email, as do the
+    sheets and prices of a session, so if they have changed since the last
+    time all emails were rendered (see titles_changed() and
+    _email_render_digest()), all emails are rendered regardless of
+    profile_ids.
+
+    progress(i, n) is called after each of the n emails is rendered.
+
+    The emails are first rendered and compared to the existing emails in
+    memory, and then the changes are written in one transaction.
+    Returns a dict counting the created, updated, deleted and unchanged
+    emails.
+    '''
     assert isinstance(email_set, (Session, Newsletter))
 
     if email_set.email_template is None:
@@ -705,25 +1359,117 @@ def regenerate_emails(email_set):
             raise ValidationError(
                 '#SKJULNUL:# kan ikke bruges i HTML-emails')
 
-    recipients = email_set.get_recipient_data()
+    title_version, changed_time = get_title_version()
+    version_prefix = 'email_render.%s.%s.' % (
+        email_set.__class__.__name__, email_set.pk)
+    version_key = version_prefix + _email_render_digest(email_set)
+    stored = DataVersion.objects.filter(key=version_key).first()
+    if stored is None or stored.version != title_version:
+        profile_ids = None
+    if profile_ids is not None:
+        profile_ids = set(p_id for p_id in profile_ids if p_id is not None)
+        if not profile_ids:
+            return dict.fromkeys(EMAIL_CHANGES, 0)
+
+    recipients = email_set.get_recipient_data(profile_ids)
+    # Parse the template once instead of once per email
+    email_set._templates = email_set.email_template.compile()
+
+    changes = {k: [] for k in EMAIL_CHANGES}
+    for i, profile_data in enumerate(recipients.values()):
+        change, email = regenerate_email(email_set, profile_data)
+        if change is not None:
+            changes[change].append(email)
+        if progress is not None:
+            progress(i + 1, len(recipients))
+
+    email_class = email_class_of(email_set)
+    with atomic():
+        email_class.objects.bulk_create(changes['created'])
+        bulk_update(email_class, changes['updated'], EMAIL_FIELDS)
+        email_class.objects.filter(
+            pk__in=[o.pk for o in changes['deleted']]).delete()
+
+    if profile_ids is None:
+        with atomic():
+            DataVersion.objects.filter(
+                key__startswith=version_prefix).delete()
+            set_version(version_key, title_version)
+    return {k: len(v) for k, v in changes.items()}
+
+
+def _email_render_digest(email_set):
+    '''
+    Digest of the sheets and kind prices of a session, which appear in
+    every email of the session. Newsletters have neither.
+    '''
+    if isinstance(email_set, Session):
+        sheets = email_set.sheet_set.order_by('pk').values_list(
+            'pk', flat=True)
+        kinds = PurchaseKind.objects.filter(sheets__session=email_set)
+        kinds = kinds.order_by('name', 'unit_price').values_list(
+            'name', 'unit_price').distinct()
+        data = repr((list(sheets), [(n, str(p)) for n, p in kinds]))
+    else:
+        data = ''
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+EMAIL_FIELDS = ('subject', 'body_plain', 'body_html',
+                'recipient_name', 'recipient_email')
+EMAIL_CHANGES = ('created', 'updated', 'deleted', 'unchanged')
+
+
+def email_class_of(email_set):
+    if isinstance(email_set, Session):
+        return Email
+    elif isinstance(email_set, Newsletter):
+        return NewsletterEmail
+    else:
+        raise TypeError(type(email_set))
 
-    for profile_id, profile_data in recipients.items():
-        regenerate_email(email_set, profile_data)
 
+def bulk_update(model, objects, fields, batch_size=None):
+    '''
+    Save the given fields of existing objects with one UPDATE per batch,
+    setting each field with a CASE over the primary keys.
 
-def get_base_recipient_data(email_set):
+    Each object binds its primary key and value once per field, and its
+    primary key once in the IN list, so by default the batches are as
+    large as the database allows that many parameters per object
+    (999 // (2 * len(fields) + 1) on SQLite).
+    '''
+    if batch_size is None:
+        params = [model._meta.pk] * (2 * len(fields) + 1)
+        batch_size = connection.ops.bulk_batch_size(params, objects)
+    batch_size = max(batch_size, 1)
+    for i in range(0, len(objects), batch_size):
+        batch = objects[i:i+batch_size]
+        values = {
+            f: Case(*[When(pk=o.pk, then=Value(getattr(o, f)))
+                      for o in batch],
+                    output_field=model._meta.get_field(f))
+            for f in fields}
+        model.objects.filter(pk__in=[o.pk for o in batch]).update(**values)
+
+
+def get_base_recipient_data(email_set, profile_ids=None):
     assert isinstance(email_set, (Session, Newsletter))
     recipients = {}
     profiles = get_profiles_title_status(period=email_set.period)
     for profile in profiles:
-        recipients[profile.id] = dict(profile=profile, title=profile.title)
-    initial_balances = compute_balance(created_before=email_set.created_time)
+        if profile_ids is None or profile.id in profile_ids:
+            recipients[profile.id] = dict(profile=profile,
+                                          title=profile.title)
+    initial_balances = get_initial_balances(email_set, profile_ids)
     for p_id, initial_balance in initial_balances.items():
         recipients[p_id]['initial_balance'] = initial_balance
-    for p_id, balance in compute_balance().items():
+    for p_id, balance in get_balances(profile_ids).items():
         recipients[p_id]['balance'] = balance
 
     emails = email_set.email_set.all()
+    if profile_ids is not None:
+        emails = emails.filter(profile_id__in=profile_ids)
     emails = emails.order_by('profile_id')
     for email in emails:
         recipients[email.profile_id]['email'] = email
@@ -748,7 +1494,8 @@ def get_base_email_context(email_set, profile_data):
     initial_balance = profile_data.get('initial_balance', Decimal())
 
     if primary_title:
-        title = (tk.prefix(primary_title, email_set.period, type='unicode')
+        title = (title_prefix(primary_title, email_set.period,
+                              type='unicode')
                  if primary_title.period else primary_title.root)
     else:
         title = None
@@ -765,49 +1512,48 @@ def get_base_email_context(email_set, profile_data):
 
 
 def regenerate_email(email_set, profile_data):
+    '''
+    Render the email of one recipient and compare it to the existing email.
+    Returns (change, email) where change is one of EMAIL_CHANGES,
+    or (None, None) if there is no email before or after; nothing is saved.
+    '''
     assert isinstance(email_set, (Session, Newsletter))
 
-    if isinstance(email_set, Session):
-        email_class = Email
-    elif isinstance(email_set, Newsletter):
-        email_class = NewsletterEmail
-    else:
-        raise TypeError(type(email_set))
-
-    from regnskab.emailtemplate import format
+    email_class = email_class_of(email_set)
+    try:
+        subject, body_plain, body_html = email_set._templates
+    except AttributeError:
+        subject, body_plain, body_html = email_set.email_template.compile()
     context = email_set.get_email_context(profile_data)
     existing_email = profile_data.get('email')
     if context is None:
         if existing_email:
-            existing_email.delete()
-        return
+            return 'deleted', existing_email
+        return None, None
     profile = profile_data['profile']
 
-    email_fields = ('subject', 'body_plain', 'body_html',
-                    'recipient_name', 'recipient_email')
     try:
         email = email_class(
             profile=profile,
-            subject=format(email_set.email_template.subject, context),
-            body_plain=format(email_set.email_template.body_plain(), context),
+            subject=subject.render(context),
+            body_plain=body_plain.render(context),
             recipient_name=profile.name,
             recipient_email=profile.email,
         )
         email.email_set = email_set
-        if email_set.email_template.markup == EmailTemplate.HTML:
-            email.body_html = format(
-                email_set.email_template.body_html(), context)
+        if body_html is not None:
+            email.body_html = body_html.render(context)
     except KeyError as exn:
         raise ValidationError("Emailskabelon har en ukendt variabel %r" %
                               exn.args[0])
     if existing_email:
-        changed_keys = [k for k in email_fields
+        changed_keys = [k for k in EMAIL_FIELDS
                         if getattr(email, k) != getattr(existing_email, k)]
-        if changed_keys:
-            email.pk = existing_email.pk
-        else:
-            return
-    email.save()
+        if not changed_keys:
+            return 'unchanged', existing_email
+        email.pk = existing_email.pk
+        return 'updated', email
+    return 'created', email
 
 
 class Session(models.Model):
@@ -828,13 +1574,15 @@ class Session(models.Model):
     def sent(self):
         return bool(self.send_time)
 
-    def regenerate_emails(self):
-        regenerate_emails(self)
+    def regenerate_emails(self, profile_ids=None):
+        return regenerate_emails(self, profile_ids)
 
-    def get_recipient_data(self):
-        recipients = get_base_recipient_data(self)
+    def get_recipient_data(self, profile_ids=None):
+        recipients = get_base_recipient_data(self, profile_ids)
 
         transactions = self.transaction_set.all().order_by('profile_id')
+        if profile_ids is not None:
+            transactions = transactions.filter(profile_id__in=profile_ids)
         transaction_sums = sum_vector(transactions, 'profile_id', 'amount')
         payment_sums = sum_vector(
             transactions.filter(kind=Transaction.PAYMENT),
@@ -854,8 +1602,10 @@ class Session(models.Model):
 
         purchases = Purchase.objects.filter(
             row__sheet__session=self)
-        purchases = purchases.exclude(row__profile=None)
-        pmatrix = sum_matrix(purchases, 'row__profile_id', 'kind__name',
+        purchases = purchases.exclude(profile=None)
+        if profile_ids is not None:
+            purchases = purchases.filter(profile_id__in=profile_ids)
+        pmatrix = sum_matrix(purchases, 'profile_id', 'kind__name',
                              F('count'))
         for p_id, purchase_count in pmatrix.items():
             recipients[p_id]['purchase_count'] = purchase_count
@@ -934,16 +1684,16 @@ class Newsletter(models.Model):
     def sent(self):
         return bool(self.send_time)
 
-    def regenerate_emails(self):
-        regenerate_emails(self)
+    def regenerate_emails(self, profile_ids=None):
+        return regenerate_emails(self, profile_ids)
 
     def get_email_context(self, profile_data):
         if not profile_data['profile'].in_current:
             return
         return get_base_email_context(self, profile_data)
 
-    def get_recipient_data(self):
-        return get_base_recipient_data(self)
+    def get_recipient_data(self, profile_ids=None):
+        return get_base_recipient_data(self, profile_ids)
 
 
 def to_message(email):
@@ -1012,6 +1762,25 @@ def email_body_html_data_uris(email):
     return _process_inlines(email.body_html, cb)
 
 
+def email_body_html_urls(email):
+    '''
+    Returns HTML with valid cid:-URIs replaced by URLs of
+    regnskab:email_inline, which the browser can cache.
+    '''
+    from django.core.urlresolvers import reverse
+
+    assert isinstance(email, (Email, NewsletterEmail))
+    if email.body_html is None:
+        return format_html('<pre style="white-space: pre-wrap">{}</pre>',
+                           email.body_plain)
+    def cb(inline):
+        if inline is not None:
+            return reverse('regnskab:email_inline',
+                           kwargs=dict(hash=inline.hash))
+
+    return _process_inlines(email.body_html, cb)
+
+
 class Email(models.Model):
     session = models.ForeignKey(Session, on_delete=models.CASCADE,
                                 related_name='email_set')
@@ -1037,6 +1806,9 @@ class Email(models.Model):
     def body_html_data_uris(self):
         return email_body_html_data_uris(self)
 
+    def body_html_urls(self):
+        return email_body_html_urls(self)
+
     def __str__(self):
         return '%s <%s>' % (self.recipient_name, self.recipient_email)
 
@@ -1066,11 +1838,248 @@ class NewsletterEmail(models.Model):
     def body_html_data_uris(self):
         return email_body_html_data_uris(self)
 
+    def body_html_urls(self):
+        return email_body_html_urls(self)
+
     def __str__(self):
         return '%s <%s>' % (self.recipient_name, self.recipient_email)
 
 
+class SessionBalance(models.Model):
+    '''
+    Balance of a profile before the session was created, that is,
+    compute_balance(created_before=session.created_time).
+    '''
+
+    session = models.ForeignKey(Session, on_delete=models.CASCADE,
+                                related_name='balance_set')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE,
+                                related_name='+')
+    balance = models.DecimalField(max_digits=15, decimal_places=6)
+
+    class Meta:
+        unique_together = [('session', 'profile')]
+
+    @property
+    def email_set(self):
+        return self.session
+
+    @email_set.setter
+    def email_set(self, v):
+        self.session = v
+
+
+class NewsletterBalance(models.Model):
+    newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE,
+                                   related_name='balance_set')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE,
+                                related_name='+')
+    balance = models.DecimalField(max_digits=15, decimal_places=6)
+
+    class Meta:
+        unique_together = [('newsletter', 'profile')]
+
+    @property
+    def email_set(self):
+        return self.newsletter
+
+    @email_set.setter
+    def email_set(self, v):
+        self.newsletter = v
+
+
+def snapshot_initial_balances(email_set, profile_ids=None, balances=None):
+    '''
+    Store the balances of the given profiles (default: all profiles)
+    before email_set was created. When email_set has just been created,
+    pass balances=get_balances() to avoid aggregating the entire ledger.
+    '''
+    assert isinstance(email_set, (Session, Newsletter))
+
+    if isinstance(email_set, Session):
+        balance_class = SessionBalance
+    elif isinstance(email_set, Newsletter):
+        balance_class = NewsletterBalance
+    else:
+        raise TypeError(type(email_set))
+
+    if profile_ids is not None and not profile_ids:
+        return
+    if balances is None:
+        balances = compute_balance(profile_ids=profile_ids,
+                                   created_before=email_set.created_time)
+    existing = email_set.balance_set.all()
+    if profile_ids is not None:
+        existing = existing.filter(profile_id__in=profile_ids)
+    with atomic():
+        existing.delete()
+        snapshot = []
+        for p_id, balance in balances.items():
+            o = balance_class(profile_id=p_id, balance=balance)
+            o.email_set = email_set
+            snapshot.append(o)
+        balance_class.objects.bulk_create(snapshot)
+
+
+def get_initial_balances(email_set, profile_ids=None):
+    '''
+    Same as compute_balance(profile_ids, email_set.created_time),
+    but reads the snapshot taken when email_set was created.
+    Does not write to the database.
+    '''
+    assert isinstance(email_set, (Session, Newsletter))
+
+    qs = email_set.balance_set.all()
+    if not qs.exists():
+        # Created before snapshots were introduced;
+        # rebuild_balances() takes the missing snapshots.
+        return compute_balance(profile_ids=profile_ids or None,
+                               created_before=email_set.created_time)
+    if profile_ids:
+        qs = qs.filter(profile_id__in=profile_ids)
+    return dict(qs.values_list('profile_id', 'balance'))
+
+
+def update_initial_balances(profile_ids, since):
+    '''
+    Update the snapshots of sessions and newsletters created after `since`
+    after a change to the ledger entries of the given profiles.
+    '''
+    if not profile_ids:
+        return
+    email_sets = itertools.chain(
+        Session.objects.filter(created_time__gt=since),
+        Newsletter.objects.filter(created_time__gt=since))
+    for email_set in email_sets:
+        if email_set.balance_set.exists():
+            snapshot_initial_balances(email_set, profile_ids)
+
+
+class DataVersion(models.Model):
+    '''
+    A counter that is bumped when the data it is named after changes,
+    so that caches in every process can tell whether they are stale.
+    '''
+
+    key = models.CharField(max_length=200, primary_key=True)
+    version = models.PositiveIntegerField()
+    changed_time = models.DateTimeField()
+
+    def __str__(self):
+        return '%s: %s' % (self.key, self.version)
+
+
+def bump_version(key):
+    '''
+    Increment the DataVersion of the given key and return the new version.
+    '''
+    now = timezone.now()
+    qs = DataVersion.objects.filter(key=key)
+    with atomic():
+        if not qs.update(version=F('version') + 1, changed_time=now):
+            try:
+                with atomic():
+                    DataVersion.objects.create(key=key, version=1,
+                                               changed_time=now)
+            except IntegrityError:
+                # Created by a concurrent request.
+                qs.update(version=F('version') + 1, changed_time=now)
+        return qs.values_list('version', flat=True).get()
+
+
+def set_version(key, version):
+    DataVersion.objects.update_or_create(
+        key=key, defaults=dict(version=version, changed_time=timezone.now()))
+
+
+def get_version(key):
+    '''
+    Return (version, changed_time) of the given key,
+    or (0, None) if it has never been bumped.
+    '''
+    try:
+        return DataVersion.objects.values_list(
+            'version', 'changed_time').get(key=key)
+    except DataVersion.DoesNotExist:
+        return 0, None
+
+
+TITLE_VERSION_KEY = 'titles'
+# Bumped by ledger_changed() and rebuild_balances(); see regnskab.stats.
+LEDGER_VERSION_KEY = 'ledger'
+TITLE_INDEX_SIZE = 32
+
+_title_index = dict(version=None, event_times=[], results=OrderedDict())
+_title_index_lock = threading.Lock()
+
+
+def titles_changed(**kwargs):
+    '''
+    Bump the data version of the title index used by
+    get_profiles_title_status(). Connected to post_save and post_delete of
+    Profile, Title, Alias and SheetStatus in RegnskabConfig.ready(), and
+    must be called explicitly after bulk_create() of these models.
+    '''
+    bump_version(TITLE_VERSION_KEY)
+
+
+def get_title_version():
+    '''
+    Return (version, changed_time) of the data behind
+    get_profiles_title_status(), where version is bumped and changed_time
+    is set by titles_changed(). changed_time is None if the titles have
+    not changed since the DataVersion table was created.
+    '''
+    return get_version(TITLE_VERSION_KEY)
+
+
+def _title_event_times():
+    '''
+    The result of get_profiles_title_status(period, time) only depends on
+    which of these times are after `time`.
+    '''
+    times = set(Alias.objects.filter(is_title=True).exclude(
+        start_time=None).values_list('start_time', flat=True))
+    times |= set(SheetStatus.objects.exclude(start_time=None).values_list(
+        'start_time', flat=True))
+    times |= set(SheetStatus.objects.exclude(end_time=None).values_list(
+        'end_time', flat=True))
+    return sorted(times)
+
+
 def get_profiles_title_status(period=None, time=None):
+    '''
+    List of all profiles with .title, .titles, .title_name, .status and
+    .in_current, sorted in the order of the sheet.
+
+    Results are kept in a process-level index keyed by period and time
+    bucket (the number of status and alias times up to `time`),
+    which is cleared when titles_changed() bumps the data version.
+    '''
+    version, changed_time = get_title_version()
+    with _title_index_lock:
+        if _title_index['version'] != version:
+            _title_index['version'] = version
+            _title_index['event_times'] = _title_event_times()
+            _title_index['results'] = OrderedDict()
+        results = _title_index['results']
+        if time is None:
+            bucket = None
+        else:
+            bucket = bisect.bisect_right(_title_index['event_times'], time)
+        key = (period, config.GFYEAR, bucket)
+        try:
+            profiles = results.pop(key)
+        except KeyError:
+            profiles = _compute_profiles_title_status(period, time)
+            while len(results) >= TITLE_INDEX_SIZE:
+                results.popitem(last=False)
+        results[key] = profiles
+    # Callers modify the returned profiles, so return copies.
+    return [copy.copy(p) for p in profiles]
+
+
+def _compute_profiles_title_status(period, time):
     def profile_key(p):
         if p.status is None:
             return (3, p.name)
@@ -1099,7 +2108,7 @@ def get_profiles_title_status(period=None, time=None):
         if p.title:
             p.title_name = (
                 '%s %s' %
-                (tk.prefix(p.title, period or config.GFYEAR, type='unicode')
+                (title_prefix(p.title, period or config.GFYEAR, type='unicode')
                  if p.title.period else p.title.root,
                  p.name))
         else:
@@ -1146,10 +2155,9 @@ class SheetImage(models.Model):
         except AttributeError:
             pass
 
-        from regnskab.images.utils import load_pdf_page
+        from regnskab.images.cache import load_sheet_page
 
-        with self.sheet.image_file_name() as filename:
-            self._image = load_pdf_page(filename, self.page - 1)
+        self._image = load_sheet_page(self.sheet, self.page) / 255.0
 
         return self._image
 
@@ -1178,3 +2186,125 @@ class SheetImage(models.Model):
             res.append(groups)
             i = j
         self.person_counts = res
+
+
+class Job(models.Model):
+    '''
+    A unit of slow work (rendering emails, extracting sheet images,
+    rendering PDFs) queued by a view with regnskab.jobs.enqueue() and run
+    by the run_jobs management command.
+    '''
+
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATES = [
+        (PENDING, 'I kø'),
+        (RUNNING, 'I gang'),
+        (DONE, 'Færdig'),
+        (FAILED, 'Fejlet'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    # Pending jobs with the same kind and key are coalesced
+    key = models.CharField(max_length=200, blank=True)
+    arguments = JSONField(default={})
+    state = models.CharField(max_length=10, choices=STATES, default=PENDING)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    message = models.TextField(blank=True)
+    # Where to go when the job is done
+    next_url = models.CharField(max_length=200, blank=True)
+    output = models.BinaryField(null=True, blank=True)
+    output_type = models.CharField(max_length=100, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL,
+                                   null=True, blank=False)
+    created_time = models.DateTimeField(auto_now_add=True)
+    started_time = models.DateTimeField(null=True, blank=True)
+    finished_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_time']
+        index_together = [('state', 'kind', 'key')]
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.kind, self.key, self.get_state_display())
+
+    @property
+    def finished(self):
+        return self.state in (Job.DONE, Job.FAILED)
+
+    def set_progress(self, progress, total=None):
+        '''
+        Save the progress of a running job. Only the progress fields are
+        written, so this is cheap enough to call once per item.
+        '''
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        Job.objects.filter(pk=self.pk).update(
+            progress=self.progress, total=self.total)
+
+
+class OutboxMessage(models.Model):
+    '''
+    A message waiting to be sent, being sent, or sent, by
+    regnskab.outbox.process_outbox(). The MIME message is stored when the
+    message is queued, so sending can be resumed after a crash.
+    '''
+
+    PENDING, SENDING, SENT, FAILED = 'pending', 'sending', 'sent', 'failed'
+    STATES = [
+        (PENDING, 'Venter'),
+        (SENDING, 'Sendes'),
+        (SENT, 'Sendt'),
+        (FAILED, 'Fejlet'),
+    ]
+
+    session = models.ForeignKey(Session, on_delete=models.CASCADE,
+                                null=True, blank=True)
+    newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE,
+                                   null=True, blank=True)
+    profile = models.ForeignKey(Profile, on_delete=models.SET_NULL,
+                                null=True, blank=True, related_name='+')
+    from_email = models.CharField(max_length=255)
+    recipients = JSONField(default=[])
+    message = models.BinaryField()
+    # The rows queued by one call of regnskab.outbox.queue_messages()
+    batch = models.CharField(max_length=32, db_index=True)
+    state = models.CharField(max_length=10, choices=STATES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_time = models.DateTimeField(null=True, blank=True)
+    claimed_time = models.DateTimeField(null=True, blank=True)
+    sent_time = models.DateTimeField(null=True, blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['pk']
+        index_together = [('state', 'next_attempt_time')]
+
+    def __str__(self):
+        return '%s (%s)' % (', '.join(self.recipients),
+                            self.get_state_display())
+
+
+class CrossesImage(models.Model):
+    '''
+    The rows of a profile in the sheet images of a session, stitched
+    together and stored as the PNG that is attached to the profile's email
+    as krydser.png. Made by regnskab.mime.update_crosses_images().
+
+    key identifies the rows that the image was made from, so a stored
+    image whose key differs from the current rows is out of date.
+    png is None if none of the profile's rows have an image.
+    '''
+
+    session = models.ForeignKey(Session, on_delete=models.CASCADE,
+                                related_name='+')
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE,
+                                related_name='+')
+    key = models.CharField(max_length=40)
+    png = models.BinaryField(null=True)
+    updated_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('session', 'profile')]
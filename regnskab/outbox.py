@@ -0,0 +1,243 @@
+'''
+Persistent outbox of emails to send.
+
+queue_messages() stores each EmailMessage as an OutboxMessage row with
+its complete MIME message. process_outbox() sends the pending rows in
+chunks over one reused connection to the email backend, and records the
+delivery state of each message. A message that fails is retried with
+exponential backoff, up to MAX_ATTEMPTS attempts.
+
+A message that is still marked as sending after CLAIM_TIMEOUT was
+claimed by a process that died. It is queued again, so a message may
+be delivered twice after a crash, but never lost. Retries and stale
+messages are sent by the workers of ./manage.py run_jobs when no job is
+pending (see regnskab.jobs.work()), or by ./manage.py send_outbox.
+
+The chunk size, attempts and backoff can be set in the Django settings
+REGNSKAB_OUTBOX_CHUNK_SIZE, REGNSKAB_OUTBOX_MAX_ATTEMPTS and
+REGNSKAB_OUTBOX_BACKOFF (seconds).
+'''
+
+import time
+import uuid
+import logging
+import datetime
+
+import django.core.mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.db.models import Count
+from django.utils import timezone
+
+from regnskab.models import OutboxMessage
+
+
+logger = logging.getLogger('regnskab')
+
+CHUNK_SIZE = getattr(settings, 'REGNSKAB_OUTBOX_CHUNK_SIZE', 50)
+MAX_ATTEMPTS = getattr(settings, 'REGNSKAB_OUTBOX_MAX_ATTEMPTS', 5)
+BACKOFF = getattr(settings, 'REGNSKAB_OUTBOX_BACKOFF', 60)
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+METRICS_KEY = 'regnskab.outbox.metrics'
+
+
+class RawMessage:
+    '''
+    A MIME message stored as bytes, with the as_bytes() signature
+    that Django's email backends expect of SafeMIMEText.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        lines = self.data.splitlines()
+        return linesep.encode().join(lines) + linesep.encode()
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.as_bytes(linesep=linesep).decode('ascii', 'replace')
+
+    def get_charset(self):
+        # Called by the console and file backends. The stored message is
+        # already encoded, so as_bytes() is written as it is.
+        return None
+
+
+class StoredMessage(EmailMessage):
+    '''
+    The EmailMessage of an OutboxMessage, whose message() is the stored
+    MIME message instead of one built from subject, body and attachments.
+    '''
+
+    def __init__(self, outbox_message):
+        super().__init__(from_email=outbox_message.from_email,
+                         to=list(outbox_message.recipients))
+        self.outbox_message = outbox_message
+
+    def message(self):
+        return RawMessage(bytes(self.outbox_message.message))
+
+
+def queue_messages(messages, email_set=None, profiles=None):
+    '''
+    Store the given EmailMessages in the outbox, attributed to a Session
+    or Newsletter and the given profiles (one per message).
+    '''
+    return queue_raw_messages(
+        [(m.from_email, m.recipients(), m.message().as_bytes())
+         for m in messages],
+        email_set, profiles)
+
+
+def queue_raw_messages(items, email_set=None, profiles=None):
+    '''
+    Same as queue_messages(), but for (from_email, recipients, MIME bytes)
+    tuples as made by regnskab.mime.build_message().
+    '''
+    from regnskab.models import Session
+
+    if profiles is None:
+        profiles = [None] * len(items)
+    # bulk_create() does not set the primary keys,
+    # so the new rows are found by their batch instead.
+    batch = uuid.uuid4().hex
+    kwargs = dict(batch=batch)
+    if email_set is not None:
+        key = 'session' if isinstance(email_set, Session) else 'newsletter'
+        kwargs[key] = email_set
+    rows = [
+        OutboxMessage(
+            profile=profile,
+            from_email=from_email,
+            recipients=recipients,
+            message=data,
+            **kwargs)
+        for (from_email, recipients, data), profile in zip(items, profiles)]
+    OutboxMessage.objects.bulk_create(rows)
+    return list(OutboxMessage.objects.filter(batch=batch).order_by('pk'))
+
+
+def requeue_stale():
+    '''
+    Queue messages again whose sending process died.
+    '''
+    return OutboxMessage.objects.filter(
+        state=OutboxMessage.SENDING,
+        claimed_time__lt=timezone.now() - CLAIM_TIMEOUT).update(
+            state=OutboxMessage.PENDING)
+
+
+def has_due_messages():
+    '''
+    Return True if process_outbox() would send any message now.
+    '''
+    requeue_stale()
+    qs = OutboxMessage.objects.filter(state=OutboxMessage.PENDING)
+    return qs.exclude(next_attempt_time__gt=timezone.now()).exists()
+
+
+def claim_chunk(chunk_size, ids=None):
+    '''
+    Mark up to chunk_size pending messages that are due as sending,
+    and return them.
+    '''
+    now = timezone.now()
+    qs = OutboxMessage.objects.filter(state=OutboxMessage.PENDING)
+    qs = qs.exclude(next_attempt_time__gt=now)
+    if ids is not None:
+        qs = qs.filter(pk__in=ids)
+    candidates = list(qs.values_list('pk', flat=True)[:chunk_size])
+    # Claim one by one, since another process may claim some of them.
+    claimed = [
+        pk for pk in candidates
+        if OutboxMessage.objects.filter(
+            pk=pk, state=OutboxMessage.PENDING).update(
+                state=OutboxMessage.SENDING, claimed_time=now)]
+    return list(OutboxMessage.objects.filter(pk__in=claimed))
+
+
+def send_one(connection, outbox_message, max_attempts, backoff):
+    outbox_message.attempts += 1
+    try:
+        # Does nothing if the connection is already open.
+        connection.open()
+        connection.send_messages([StoredMessage(outbox_message)])
+    except Exception as exn:
+        outbox_message.last_error = '%s: %s' % (type(exn).__name__, exn)
+        if outbox_message.attempts >= max_attempts:
+            outbox_message.state = OutboxMessage.FAILED
+        else:
+            outbox_message.state = OutboxMessage.PENDING
+            delay = backoff * 2 ** (outbox_message.attempts - 1)
+            outbox_message.next_attempt_time = (
+                timezone.now() + datetime.timedelta(seconds=delay))
+        # Start over with a new connection, in case it was the connection
+        # that failed.
+        connection.close()
+    else:
+        outbox_message.state = OutboxMessage.SENT
+        outbox_message.sent_time = timezone.now()
+        outbox_message.last_error = ''
+    outbox_message.save(update_fields=[
+        'state', 'attempts', 'last_error', 'next_attempt_time',
+        'sent_time'])
+    return outbox_message.state
+
+
+def process_outbox(chunk_size=None, ids=None, connection=None,
+                   max_attempts=None, backoff=None, progress=None):
+    '''
+    Send the pending messages that are due (all of them, or those with
+    the given ids) and return the metrics of the run: the number of
+    messages sent, failed and retried, the number of chunks, and the
+    throughput in messages per second.
+    '''
+    chunk_size = chunk_size or CHUNK_SIZE
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    backoff = BACKOFF if backoff is None else backoff
+    if connection is None:
+        connection = django.core.mail.get_connection()
+    requeue_stale()
+
+    metrics = dict(sent=0, failed=0, retried=0, chunks=0)
+    t1 = time.time()
+    try:
+        while True:
+            chunk = claim_chunk(chunk_size, ids)
+            if not chunk:
+                break
+            metrics['chunks'] += 1
+            for outbox_message in chunk:
+                state = send_one(connection, outbox_message,
+                                 max_attempts, backoff)
+                if state == OutboxMessage.SENT:
+                    metrics['sent'] += 1
+                elif state == OutboxMessage.FAILED:
+                    metrics['failed'] += 1
+                else:
+                    metrics['retried'] += 1
+            if progress is not None:
+                progress(metrics['sent'] + metrics['failed'])
+    finally:
+        connection.close()
+    metrics['seconds'] = time.time() - t1
+    metrics['per_second'] = (
+        metrics['sent'] / metrics['seconds'] if metrics['seconds'] else 0)
+    metrics['finished_time'] = timezone.now()
+    cache.set(METRICS_KEY, metrics, None)
+    logger.info("Outbox: %(sent)s sendt, %(failed)s fejlet, " +
+                "%(retried)s forsøges igen, %(per_second).1f/s", metrics)
+    return metrics
+
+
+def get_outbox_status(**filters):
+    '''
+    Count the outbox messages (e.g. of session=...) in each state,
+    and include the metrics of the last run of process_outbox().
+    '''
+    counts = {k: 0 for k, v in OutboxMessage.STATES}
+    qs = OutboxMessage.objects.filter(**filters).order_by()
+    counts.update(qs.values_list('state').annotate(n=Count('pk')))
+    return dict(counts=counts, last_run=cache.get(METRICS_KEY))
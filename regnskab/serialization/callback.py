@@ -62,3 +62,24 @@ class BulkSaveAll(DataLoadCallback):
     def __call__(self):
         if self.objects:
             self.objects[0].__class__.objects.bulk_create(self.objects)
+
+
+class SetPurchaseAmounts(DataLoadCallback):
+    '''
+    Update the denormalized Purchase.profile and Purchase.amount
+    before the purchases are saved with bulk_create.
+    The PurchaseKind objects must already be saved, since only their pks
+    are known when loading.
+    '''
+
+    def __init__(self, objects):
+        self.objects = list(objects)
+
+    def __call__(self):
+        from regnskab.models import PurchaseKind
+
+        kind_ids = set(o.kind_id for o in self.objects)
+        kinds = PurchaseKind.objects.in_bulk(kind_ids)
+        for o in self.objects:
+            o.kind = kinds[o.kind_id]
+            o.set_amount()
@@ -42,6 +42,15 @@ def main():
                    cb.objects[0].__class__.__name__))
         cb()
 
+    from regnskab.models import (
+        rebuild_balances, rebuild_kind_totals, titles_changed,
+        rebuild_search_index,
+    )
+    print('Rebuild balances of %d profiles' % rebuild_balances())
+    rebuild_kind_totals()
+    titles_changed()
+    rebuild_search_index()
+
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,5 @@
 from .codegen import base
+from .callback import SetPurchaseAmounts
 
 
 class TitleData(base('Title')):
@@ -67,6 +68,10 @@ class PurchaseData(base('Purchase')):
     shape = 'list'
     bulk = True
 
+    def load(self, data_lists, parents):
+        set_parents, save_all = super().load(data_lists, parents)
+        return [set_parents, SetPurchaseAmounts(save_all.objects), save_all]
+
 
 class SheetRowData(base('SheetRow')):
     parent_field = 'sheet'
@@ -5,12 +5,14 @@ class RegnskabSite(object):
         from django.conf import settings
         from django.conf.urls import url, include
         from regnskab import views
-        from regnskab.views import images, email
+        from regnskab.views import images, email, jobs
         import krydsliste
 
         urls = [
             url(r'^$', views.Home.as_view(), name='home'),
             url(r'^log/$', views.Log.as_view(), name='log'),
+            url(r'^cache\.json$', views.CacheInfo.as_view(),
+                name='cache_info'),
             url(r'^session/(?P<session>\d+)/sheet/new/$',
                 views.SheetCreate.as_view(), name='sheet_create'),
             url(r'^sheet/(?P<pk>\d+)/$', views.SheetDetail.as_view(),
@@ -38,6 +40,12 @@ class RegnskabSite(object):
                 views.EmailDetail.as_view(), name='email_detail'),
             url(r'^session/(?P<pk>\d+)/email/(?P<profile>\d+)/send/$',
                 views.EmailSend.as_view(), name='email_send'),
+            url(r'^session/(?P<pk>\d+)/email/(?P<profile>\d+)/' +
+                r'krydser-(?P<key>[0-9a-f]+)\.png$',
+                views.EmailCrossesImage.as_view(),
+                name='email_crosses_image'),
+            url(r'^inline/(?P<hash>[a-z0-9]+-[0-9a-f]+)$',
+                views.EmailInline.as_view(), name='email_inline'),
             url(r'^session/(?P<pk>\d+)/payment/$',
                 views.PaymentBatchCreate.as_view(),
                 name='payment_batch_create'),
@@ -57,6 +65,11 @@ class RegnskabSite(object):
                 name='profile_detail'),
             url(r'^profile/search/$', views.ProfileSearch.as_view(),
                 name='profile_search'),
+            url(r'^profile/search\.json$', views.ProfileTypeahead.as_view(),
+                name='profile_typeahead'),
+            url(r'^profile/directory/(?P<period>\d+)\.json$',
+                views.ProfileDirectory.as_view(),
+                name='profile_directory'),
             url(r'^sheet/(?P<pk>\d+)/(?P<page>\d+)/orig\.png$',
                 images.SheetImageFile.as_view(),
                 name='sheet_image_file'),
@@ -94,6 +107,12 @@ class RegnskabSite(object):
             url(r'^news/(?P<pk>\d+)/email/(?P<profile>\d+)/send/$',
                 email.NewsletterEmailSend.as_view(),
                 name='newsletter_email_send'),
+            url(r'^job/(?P<pk>\d+)/$', jobs.JobDetail.as_view(),
+                name='job_detail'),
+            url(r'^job/(?P<pk>\d+)/status/$', jobs.JobStatus.as_view(),
+                name='job_status'),
+            url(r'^job/(?P<pk>\d+)/output/$', jobs.JobOutput.as_view(),
+                name='job_output'),
             url(r'^krydsliste/', include(krydsliste.site.urls)),
         ]
         if settings.DEBUG:
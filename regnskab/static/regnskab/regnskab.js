@@ -278,6 +278,41 @@ var filter_persons_cached = function () {
     };
 }();
 
+// Matches of the server's fuzzy search (TK_TYPEAHEAD_URL), used when no
+// person matches a query locally, e.g. because of a typo.
+var typeahead_results = {};
+var typeahead_listeners = [];
+
+function fetch_typeahead(query) {
+    typeahead_results[query] = null;
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', window.TK_TYPEAHEAD_URL + '?all=1&q=' + encodeURIComponent(query));
+    xhr.onload = function () {
+        if (xhr.status !== 200) return;
+        typeahead_results[query] = JSON.parse(xhr.responseText);
+        typeahead_listeners.forEach(function (fn) {
+            return fn();
+        });
+    };
+    xhr.send();
+}
+
+function typeahead_persons(persons, query) {
+    if (query.trim().length < 3) return [];
+    if (!(query in typeahead_results)) fetch_typeahead(query);
+    var results = typeahead_results[query];
+    if (!results) return [];
+    var by_id = {};
+    persons.forEach(function (p) {
+        by_id[p.id] = p;
+    });
+    return results.filter(function (r) {
+        return r.id in by_id;
+    }).map(function (r) {
+        return { 'display': r.display, 'person': by_id[r.id] };
+    });
+}
+
 var Cross = function (_React$PureComponent) {
     _inherits(Cross, _React$PureComponent);
 
@@ -473,6 +508,29 @@ var Name = function (_React$Component3) {
     }
 
     _createClass(Name, [{
+        key: 'componentDidMount',
+        value: function componentDidMount() {
+            this.onTypeahead = this.onTypeahead.bind(this);
+            typeahead_listeners.push(this.onTypeahead);
+        }
+    }, {
+        key: 'componentWillUnmount',
+        value: function componentWillUnmount() {
+            typeahead_listeners.splice(typeahead_listeners.indexOf(this.onTypeahead), 1);
+        }
+    }, {
+        key: 'onTypeahead',
+        value: function onTypeahead() {
+            if (this.props.personValue === null && this.props.nameValue.trim() !== '') {
+                var choices = this.getChoices();
+                if (choices.length > 0) {
+                    this.props.onChange(choices[0].person.id, this.props.nameValue);
+                    return;
+                }
+            }
+            this.forceUpdate();
+        }
+    }, {
         key: 'onPersonChange',
         value: function onPersonChange(v) {
             this.props.onChange(v, this.props.nameValue);
@@ -496,6 +554,7 @@ var Name = function (_React$Component3) {
         value: function getChoices(query) {
             if (typeof query === 'undefined') query = this.props.nameValue;
             var choices = filter_persons_cached(this.props.persons, query);
+            if (choices.length === 0) choices = typeahead_persons(this.props.persons, query);
             return choices.map(function (_ref3) {
                 var display = _ref3.display;
                 var person = _ref3.person;
@@ -769,15 +828,42 @@ var Main = function (_React$Component6) {
     _inherits(Main, _React$Component6);
 
     function Main() {
+        var _ref6;
+
+        var _temp6, _this13, _ret6;
+
         _classCallCheck(this, Main);
 
-        return _possibleConstructorReturn(this, (Main.__proto__ || Object.getPrototypeOf(Main)).apply(this, arguments));
+        for (var _len6 = arguments.length, args = Array(_len6), _key6 = 0; _key6 < _len6; _key6++) {
+            args[_key6] = arguments[_key6];
+        }
+
+        return _ret6 = (_temp6 = (_this13 = _possibleConstructorReturn(this, (_ref6 = Main.__proto__ || Object.getPrototypeOf(Main)).call.apply(_ref6, [this].concat(args))), _this13), _this13.state = {
+            persons: null
+        }, _temp6), _possibleConstructorReturn(_this13, _ret6);
     }
 
     _createClass(Main, [{
+        key: 'componentDidMount',
+        value: function componentDidMount() {
+            var _this14 = this;
+
+            var xhr = new XMLHttpRequest();
+            xhr.open('GET', window.TK_PROFILES_URL);
+            xhr.onload = function () {
+                if (xhr.status === 200) _this14.setState({ persons: JSON.parse(xhr.responseText) });
+            };
+            xhr.send();
+        }
+    }, {
         key: 'render',
         value: function render() {
-            var persons = window.TK_PROFILES;
+            var persons = this.state.persons;
+            if (persons === null) return React.createElement(
+                'p',
+                null,
+                'Henter personer...'
+            );
             return React.createElement(Sheet, { persons: persons });
         }
     }]);
@@ -0,0 +1,191 @@
+'''
+Whole-history statistics on purchases and transactions.
+
+The ledger (every Purchase and Transaction) is loaded once per process into
+parallel NumPy arrays, and pivots equivalent to regnskab.utils.sum_vector()
+and sum_matrix() are computed with np.bincount() instead of one GROUP BY
+query and one Python dict per row.
+
+The loaded ledger is cached in each process until ledger_changed() or
+rebuild_balances() bumps the ledger's DataVersion in any process.
+'''
+
+import threading
+
+import numpy as np
+
+from regnskab.models import (
+    Purchase, Transaction, LEDGER_VERSION_KEY, get_version,
+)
+from regnskab.fixedpoint import COUNT, AMOUNT, to_fixed, from_fixed
+
+
+def _factorize(raw):
+    '''
+    Turn a sequence of hashable keys into an integer code array
+    and the list of keys (labels) that the codes refer to.
+
+    >>> codes, labels = _factorize(['a', None, 'a', 'b'])
+    >>> codes.tolist(), labels
+    ([0, 1, 0, 2], ['a', None, 'b'])
+    '''
+    code_of = {}
+    codes = np.fromiter(
+        (code_of.setdefault(x, len(code_of)) for x in raw),
+        dtype=np.intp, count=len(raw))
+    return codes, list(code_of)
+
+
+def _to_fixed(values, places):
+    return np.fromiter((to_fixed(v, places) for v in values),
+                       dtype=np.int64, count=len(values))
+
+
+class Ledger:
+    '''
+    Every purchase and transaction as one row in parallel arrays.
+
+    Key columns (usable in where(), sum_vector() and sum_matrix()):
+
+    - source: 'purchase' or 'transaction'
+    - profile: profile id (None for purchases on rows without a profile)
+    - kind: PurchaseKind.name or Transaction.kind
+    - sheet: sheet id (None for transactions)
+    - session: session id (None for legacy sheets and transactions)
+    - period: Sheet.period or Transaction.period
+    - session_period: period of the session (None if no session)
+
+    Value columns, stored as int64 fixed point (see regnskab.fixedpoint)
+    with VALUE_PLACES decimals:
+
+    - count: purchase count, or transaction amount
+      (the value shown in the usual kind-by-X tables)
+    - amount: Purchase.amount or Transaction.amount (the balance change)
+    '''
+
+    KEYS = ('source', 'profile', 'kind', 'sheet', 'session', 'period',
+            'session_period')
+    VALUE_PLACES = {'count': COUNT, 'amount': AMOUNT}
+
+    def __init__(self, keys, values):
+        self.codes = {}
+        self.labels = {}
+        self._code_of = {}
+        for k in self.KEYS:
+            self.codes[k], self.labels[k] = _factorize(keys[k])
+            self._code_of[k] = {x: i for i, x in enumerate(self.labels[k])}
+        self.values = {k: _to_fixed(values[k], places)
+                       for k, places in self.VALUE_PLACES.items()}
+        self.size = len(self.codes['source'])
+
+    @classmethod
+    def load(cls):
+        purchase_qs = Purchase.objects.order_by().values_list(
+            'profile_id', 'kind__name', 'row__sheet_id',
+            'row__sheet__session_id', 'row__sheet__period',
+            'row__sheet__session__period', 'count', 'amount')
+        transaction_qs = Transaction.objects.order_by().values_list(
+            'profile_id', 'kind', 'session_id', 'period',
+            'session__period', 'amount')
+        keys = {k: [] for k in cls.KEYS}
+        values = {k: [] for k in cls.VALUE_PLACES}
+        for (profile, kind, sheet, session, period, session_period,
+             count, amount) in purchase_qs:
+            keys['source'].append('purchase')
+            keys['profile'].append(profile)
+            keys['kind'].append(kind)
+            keys['sheet'].append(sheet)
+            keys['session'].append(session)
+            keys['period'].append(period)
+            keys['session_period'].append(session_period)
+            values['count'].append(count)
+            values['amount'].append(amount)
+        for (profile, kind, session, period, session_period,
+             amount) in transaction_qs:
+            keys['source'].append('transaction')
+            keys['profile'].append(profile)
+            keys['kind'].append(kind)
+            keys['sheet'].append(None)
+            keys['session'].append(session)
+            keys['period'].append(period)
+            keys['session_period'].append(session_period)
+            values['count'].append(amount)
+            values['amount'].append(amount)
+        return cls(keys, values)
+
+    def where(self, **conditions):
+        '''
+        Return the boolean mask of rows where each given key column
+        equals the given label, e.g. ledger.where(period=2016, session=None).
+        '''
+        mask = np.ones(self.size, dtype=bool)
+        for k, label in conditions.items():
+            try:
+                code = self._code_of[k][label]
+            except KeyError:
+                return np.zeros(self.size, dtype=bool)
+            mask &= self.codes[k] == code
+        return mask
+
+    def group_sum(self, keys, value, mask=None):
+        '''
+        Sum the value column grouped by the given key columns.
+        The result maps each tuple of labels that occurs in the
+        (masked) ledger to the sum as a Decimal.
+        '''
+        codes = [self.codes[k] for k in keys]
+        values = self.values[value]
+        if mask is not None:
+            codes = [c[mask] for c in codes]
+            values = values[mask]
+        if not len(values):
+            return {}
+        shape = [len(self.labels[k]) for k in keys]
+        flat = np.ravel_multi_index(codes, shape)
+        groups, inverse = np.unique(flat, return_inverse=True)
+        # bincount sums in float64, which is exact for integers below 2**53.
+        sums = np.bincount(inverse, weights=values, minlength=len(groups))
+        sums = np.rint(sums).astype(np.int64).tolist()
+        group_codes = [c.tolist() for c in np.unravel_index(groups, shape)]
+        labels = [self.labels[k] for k in keys]
+        places = self.VALUE_PLACES[value]
+        result = {}
+        for i, s in enumerate(sums):
+            key = tuple(ls[c[i]] for ls, c in zip(labels, group_codes))
+            result[key] = from_fixed(s, places)
+        return result
+
+    def sum_vector(self, index, value, mask=None):
+        '''
+        Equivalent of regnskab.utils.sum_vector(): d[x] is the sum of
+        value where index = x.
+        '''
+        return {x: v for (x,), v in
+                self.group_sum((index,), value, mask).items()}
+
+    def sum_matrix(self, column, row, value, mask=None):
+        '''
+        Equivalent of regnskab.utils.sum_matrix(): d[x1][x2] is the sum of
+        value where column = x1 and row = x2.
+        '''
+        res = {}
+        for (x1, x2), v in self.group_sum((column, row), value, mask).items():
+            res.setdefault(x1, {})[x2] = v
+        return res
+
+
+_cached = None
+_lock = threading.Lock()
+
+
+def get_ledger():
+    '''
+    Return the process-cached Ledger, reloading it if the ledger
+    has changed since it was loaded.
+    '''
+    global _cached
+    version, changed_time = get_version(LEDGER_VERSION_KEY)
+    with _lock:
+        if _cached is None or _cached[0] != version:
+            _cached = (version, Ledger.load())
+        return _cached[1]
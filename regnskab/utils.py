@@ -1,9 +1,11 @@
 import re
+import functools
 from unittest.mock import patch
 from django.db.models import F, Sum
 from django.utils import html, safestring
 from django.core.mail import EmailMessage, SafeMIMEMultipart
 import html2text
+import tktitler as tk
 from django.conf import settings
 
 
@@ -56,6 +58,43 @@ def sum_matrix(qs, column_spec, row_spec, value_spec):
     return res
 
 
+TITLE_PREFIX_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=TITLE_PREFIX_CACHE_SIZE)
+def _title_prefix(root, period, gfyear, type):
+    if type is None:
+        return tk.prefix((root, period), gfyear)
+    return tk.prefix((root, period), gfyear, type=type)
+
+
+def title_prefix(title, gfyear, type=None):
+    '''
+    Memoized tk.prefix(title, gfyear, type=type) for a Title or an Alias
+    (or a (root, period) tuple). The result only depends on the root and
+    period of the title, gfyear and type, so the rendering is cached in
+    an LRU of TITLE_PREFIX_CACHE_SIZE entries.
+
+    gfyear must be given explicitly rather than through tk.set_gfyear,
+    since it is part of the cache key.
+    '''
+    if isinstance(title, tuple):
+        root, period = title
+    else:
+        root, period = title.root, title.period
+    return _title_prefix(root, period, gfyear, type)
+
+
+def title_prefix_info():
+    '''
+    Hit/miss counters of the title_prefix() cache in this process,
+    as a dict for monitoring.
+    '''
+    info = _title_prefix.cache_info()
+    return dict(hits=info.hits, misses=info.misses,
+                size=info.currsize, maxsize=info.maxsize)
+
+
 def line_to_html(line):
     strip = line.lstrip()
     leading_ws = len(line) - len(strip)
@@ -1,12 +1,13 @@
 from .base import (
-    Home, Log, SessionCreate, SheetCreate, SheetDetail, SheetRowUpdate,
+    Home, Log, CacheInfo, SessionCreate, SheetCreate, SheetDetail, SheetRowUpdate,
     SessionList, SessionUpdate,
     get_profiles_title_status, ProfileList, ProfileDetail, ProfileSearch,
+    ProfileDirectory, ProfileTypeahead,
     TransactionBatchCreateBase, PaymentBatchCreate, PurchaseNoteList,
     PurchaseBatchCreate, PaymentPurchaseList,
 )
 from .printing import BalancePrint
 from .email import (
     EmailTemplateList, EmailTemplateUpdate, EmailTemplateCreate,
-    EmailList, EmailDetail, EmailSend,
+    EmailList, EmailDetail, EmailSend, EmailInline, EmailCrossesImage,
 )
@@ -8,9 +8,9 @@ import json
 
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.urlresolvers import reverse
-from django.conf import settings
-from django.http import HttpResponse
-from django.db.models import F, Sum
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from django.db.models import F, Sum, Count
 from django.utils import timezone
 from django.utils.html import format_html, format_html_join
 from django.template.defaultfilters import floatformat
@@ -19,6 +19,10 @@ from django.views.generic import (
     TemplateView, FormView, View,
 )
 from django.template.response import TemplateResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
 from regnskab.forms import (
     SheetCreateForm, AnonymousEmailTemplateForm, SheetRowForm,
     TransactionBatchForm, BalancePrintForm,
@@ -28,16 +32,23 @@ from regnskab.models import (
     Sheet, SheetRow, SheetStatus, Profile, Alias, Title, Email,
     EmailTemplate, Session, PurchaseKind,
     Transaction, Purchase,
-    compute_balance, get_inka,
-    config, get_profiles_title_status,
+    compute_balance, get_balances, ledger_changed, get_inka,
+    get_initial_balances, snapshot_initial_balances,
+    get_period_totals, get_session_totals, config,
+    TimelineEntry, save_timeline, timeline_changed,
+    get_profiles_title_status,
+    SearchEntry, SearchTrigram, trigrams, refresh_search_index,
+    update_search_index, titles_changed,
+    get_title_version,
 )
 from regnskab.rules import (
     get_max_debt, get_max_debt_after_payment, get_default_prices,
 )
+from regnskab.jobs import (
+    enqueue, enqueue_regenerate_emails, enqueue_crosses_images,
+)
 from .auth import regnskab_permission_required_method
-from regnskab.utils import sum_matrix
-
-import tktitler as tk
+from regnskab.utils import sum_matrix, title_prefix, title_prefix_info
 
 logger = logging.getLogger('regnskab')
 
@@ -78,6 +89,20 @@ class Log(View):
         return HttpResponse(s, content_type='text/plain; charset=utf8')
 
 
+class CacheInfo(View):
+    '''
+    The hit/miss counters of the in-process caches of the process that
+    answers the request as JSON, for monitoring.
+    '''
+
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        return JsonResponse(dict(title_prefix=title_prefix_info()))
+
+
 def already_sent_view(request, regnskab_session):
     context = dict(session=regnskab_session)
     return TemplateResponse(
@@ -97,6 +122,7 @@ class SessionCreate(TemplateView):
         session = Session(created_by=self.request.user, period=config.GFYEAR,
                           email_template=email_template)
         session.save()
+        snapshot_initial_balances(session, balances=get_balances())
         logger.info("%s: Opret ny opgørelse id=%s",
                     self.request.user, session.pk)
         if session.email_template:
@@ -127,8 +153,6 @@ class SheetCreate(FormView):
                     period=config.GFYEAR)
 
     def form_valid(self, form):
-        from regnskab.images.extract import extract_images
-
         data = form.cleaned_data
         sheet = Sheet(name=data['name'],
                       start_date=data['start_date'],
@@ -143,32 +167,21 @@ class SheetCreate(FormView):
                 position=i + 1,
                 unit_price=kind['unit_price'])
             for i, kind in enumerate(data['kinds'])]
-        if data['image_file']:
-            # extract_images sets sheet.row_image
-            try:
-                images, rows, purchases = extract_images(sheet, kinds)
-            except Exception as exn:
-                if settings.DEBUG and not isinstance(exn, ValidationError):
-                    raise
-                form.add_error(None, exn)
-                return self.form_invalid(form)
-        else:
-            images, rows, purchases = [], [], []
         sheet.save()
-        for o in images + rows:
-            o.sheet = o.sheet  # Update sheet_id
-        for o in images + rows:
-            o.save()
         for o in kinds:
             o.sheets.add(sheet)
-        for o in purchases:
-            o.row = o.row  # Update row_id
-        Purchase.objects.bulk_create(purchases)
         logger.info("%s: Opret ny krydsliste id=%s i opgørelse=%s " +
                     "med priser %s",
                     self.request.user, sheet.pk, self.regnskab_session.pk,
                     ' '.join('%s=%s' % (k['name'], k['unit_price'])
                              for k in data['kinds']))
+        if data['image_file']:
+            # The rows are extracted from the image by a background job.
+            job = enqueue('extract_images', 'Sheet:%s' % sheet.pk,
+                          dict(sheet=sheet.pk), user=self.request.user,
+                          next_url=reverse('regnskab:sheet_update',
+                                           kwargs=dict(pk=sheet.pk)))
+            return redirect('regnskab:job_detail', pk=job.pk)
         return redirect('regnskab:sheet_update', pk=sheet.pk)
 
 
@@ -209,7 +222,73 @@ class SheetDetail(TemplateView):
 
 
 def auto_prefix(t, period):
-    return tk.prefix(t, period) if t.period else t.root
+    return title_prefix(t, period) if t.period else t.root
+
+
+def build_profile_directory(period):
+    profiles = get_profiles_title_status(period=period)
+    aliases = {}
+    for o in Alias.objects.filter(end_time=None):
+        aliases.setdefault(o.profile_id, []).append(o)
+    for o in Title.objects.all():
+        aliases.setdefault(o.profile_id, []).append(o)
+
+    result = []
+    for i, profile in enumerate(profiles):
+        titles = aliases.get(profile.id, ())
+        titles_input = [auto_prefix(t, period) for t in titles]
+        title_input = profile.title and auto_prefix(profile.title, period)
+        result.append(dict(
+            titles=titles_input, title=title_input, sort_key=i,
+            name=profile.name, title_name=profile.title_name,
+            id=profile.pk, in_current=profile.in_current))
+    return result
+
+
+def profile_directory_etag(period):
+    version, changed_time = get_title_version()
+    return '%s-%s-%s' % (period, config.GFYEAR, version)
+
+
+def get_profile_directory_json(period):
+    '''
+    Compact JSON of build_profile_directory(period), cached until
+    titles_changed() bumps the title version or GFYEAR changes.
+    '''
+    key = 'regnskab.profile_directory.%s' % profile_directory_etag(period)
+    data = cache.get(key)
+    if data is None:
+        data = json.dumps(build_profile_directory(period),
+                          separators=(',', ':'))
+        cache.set(key, data, 24 * 60 * 60)
+    return data
+
+
+class ProfileDirectory(View):
+    '''
+    The profiles shown in the sheet editor as JSON. The editor requests it
+    with ?v= set to the current ETag, so a cached copy can be reused
+    until the titles change.
+    '''
+
+    @regnskab_permission_required_method
+    @method_decorator(gzip_page)
+    @method_decorator(condition(
+        etag_func=lambda request, period: profile_directory_etag(int(period)),
+        last_modified_func=lambda request, period: get_title_version()[1]))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, period):
+        period = int(period)
+        response = HttpResponse(get_profile_directory_json(period),
+                                content_type='application/json')
+        if request.GET.get('v') == profile_directory_etag(period):
+            patch_cache_control(response, private=True,
+                                max_age=24 * 60 * 60)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
 
 
 class SheetRowUpdate(FormView):
@@ -232,27 +311,6 @@ class SheetRowUpdate(FormView):
     def get_sheet(self):
         return get_object_or_404(Sheet.objects, pk=self.kwargs['pk'])
 
-    def get_profiles(self):
-        period = self.get_sheet().period
-
-        profiles = get_profiles_title_status(period=period)
-        aliases = {}
-        for o in Alias.objects.filter(end_time=None):
-            aliases.setdefault(o.profile_id, []).append(o)
-        for o in Title.objects.all():
-            aliases.setdefault(o.profile_id, []).append(o)
-
-        result = []
-        for i, profile in enumerate(profiles):
-            titles = aliases.get(profile.id, ())
-            titles_input = [auto_prefix(t, period) for t in titles]
-            title_input = profile.title and auto_prefix(profile.title, period)
-            result.append(dict(
-                titles=titles_input, title=title_input, sort_key=i,
-                name=profile.name, title_name=profile.title_name,
-                id=profile.pk, in_current=profile.in_current))
-        return result
-
     def get_initial_data(self):
         row_objects = self.sheet.rows()
         row_data = []
@@ -272,8 +330,11 @@ class SheetRowUpdate(FormView):
     def get_context_data(self, **kwargs):
         context_data = super(SheetRowUpdate, self).get_context_data(**kwargs)
         context_data['sheet'] = self.sheet
-        profiles = self.get_profiles()
-        context_data['profiles_json'] = json.dumps(profiles, indent=2)
+        context_data['profiles_url'] = '%s?v=%s' % (
+            reverse('regnskab:profile_directory',
+                    kwargs=dict(period=self.sheet.period)),
+            profile_directory_etag(self.sheet.period))
+        context_data['typeahead_url'] = reverse('regnskab:profile_typeahead')
         context_data['session'] = self.regnskab_session
         return context_data
 
@@ -368,7 +429,16 @@ class SheetRowUpdate(FormView):
             o.save()
         for o in save_purchases:
             o.row = o.row  # Update o.row_id
+            o.set_amount()
         Purchase.objects.bulk_create(save_purchases)
+        profile_ids = set(
+            [d['profile'].id for d in delete if d['profile']] +
+            [o.profile_id for o in save_rows if o.profile_id])
+        ledger_changed(
+            profile_ids,
+            since=sheet.created_time,
+            periods=(sheet.period, sheet.session and sheet.session.period))
+        return profile_ids
 
     def form_valid(self, form):
         try:
@@ -376,14 +446,22 @@ class SheetRowUpdate(FormView):
         except ValidationError as exn:
             form.add_error(None, exn)
             return self.form_invalid(form)
+        dates = (self.sheet.start_date, self.sheet.end_date)
         self.sheet.start_date = form.cleaned_data['start_date']
         self.sheet.end_date = form.cleaned_data['end_date']
         self.sheet.save()
-        self.save_rows(row_objects)
+        if dates != (self.sheet.start_date, self.sheet.end_date):
+            # The timeline of every profile on the sheet shows its dates.
+            timeline_changed(self.sheet.sheetrow_set.values_list(
+                'profile_id', flat=True))
+        profile_ids = self.save_rows(row_objects)
+        enqueue_crosses_images(self.regnskab_session, profile_ids)
+        job = None
         if self.regnskab_session.email_template:
-            self.regnskab_session.regenerate_emails()
+            job = enqueue_regenerate_emails(
+                self.regnskab_session, profile_ids, user=self.request.user)
         return self.render_to_response(
-            self.get_context_data(form=form, saved=True))
+            self.get_context_data(form=form, saved=True, job=job))
 
 
 class Sortable:
@@ -588,19 +666,6 @@ class SessionList(TemplateView):
                 transpose.setdefault(k2, {})[k1] = v
         return transpose
 
-    @staticmethod
-    def merge_legacy_data(by_sheet_time, by_sheet, period):
-        if not by_sheet_time:
-            return
-        date_to_sheet = dict(
-            Sheet.objects.filter(session=None, period=period).values_list(
-                'end_date', 'id'))
-        for col_key, column in by_sheet_time.items():
-            output = by_sheet.setdefault(col_key, {})
-            for time, v in column.items():
-                sheet_id = date_to_sheet[time.date()]
-                output[sheet_id] = v
-
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
 
@@ -609,11 +674,7 @@ class SessionList(TemplateView):
         except (ValueError, KeyError):
             period = config.GFYEAR
 
-        by_year = sum_matrix(
-            Purchase.objects.all(),
-            'kind__name', 'row__sheet__period', 'count')
-        by_year.update(sum_matrix(
-            Transaction.objects.all(), 'kind', 'period', 'amount'))
+        by_year = get_period_totals()
         period_table = PurchaseStatsTable(self.request)
         period_table.columns_before = (('period', 'Årgang', 'key'),)
         period_table.sortable(self.request.GET, 'y')
@@ -621,27 +682,7 @@ class SessionList(TemplateView):
             r['period'] = format_html(
                 '<a href="?year={0}">{0}</a>', r['key'])
 
-        purchases_by_session_qs = Purchase.objects.filter(
-            row__sheet__session__period=period)
-        by_session = sum_matrix(
-            purchases_by_session_qs,
-            'kind__name', 'row__sheet__session_id', 'count')
-        purchases_by_sheet_qs = Purchase.objects.filter(
-            row__sheet__session=None,
-            row__sheet__period=period)
-        by_sheet = sum_matrix(
-            purchases_by_sheet_qs,
-            'kind__name', 'row__sheet_id', 'count')
-
-        transactions_by_session_qs = Transaction.objects.filter(
-            session__period=period)
-        by_session.update(sum_matrix(
-            transactions_by_session_qs, 'kind', 'session_id', 'amount'))
-        transactions_by_sheet_qs = Transaction.objects.filter(
-            session=None, period=period)
-        by_sheet_time = sum_matrix(
-            transactions_by_sheet_qs, 'kind', 'time', 'amount')
-        self.merge_legacy_data(by_sheet_time, by_sheet, period)
+        by_session, by_sheet = get_session_totals(period)
 
         session_table = PurchaseStatsTable(self.request)
         session_table.columns_before = (('date', 'Dato', 'raw_date'),)
@@ -766,10 +807,13 @@ class SessionUpdate(FormView):
         self.object.email_template.markup = form.cleaned_data['markup']
         try:
             self.object.email_template.clean()
-            self.object.regenerate_emails()
+            counts = self.object.regenerate_emails()
         except ValidationError as exn:
             form.add_error(None, exn)
             return self.form_invalid(form)
+        logger.info("%s: Gendan emails for opgørelse %s: %s",
+                    self.request.user, self.object.pk,
+                    ' '.join('%s=%s' % kv for kv in sorted(counts.items())))
         if save_it:
             self.object.email_template.save()
             # Update self.object.email_template_id
@@ -840,6 +884,7 @@ class ProfileList(TemplateView):
 class ProfileDetail(TemplateView):
     template_name = 'regnskab/profile_detail.html'
     REMOVE_ALIAS = 'remove_'
+    PAGE_SIZE = 100
 
     @regnskab_permission_required_method
     def dispatch(self, request, *args, **kwargs):
@@ -931,7 +976,11 @@ class ProfileDetail(TemplateView):
                     profile=self.profile,
                     root=s,
                     end_time=None)
+                ended = list(existing_same.values_list('pk', flat=True))
                 existing_same.update(end_time=now)
+                # update() does not send post_save.
+                update_search_index(Alias.objects.filter(pk__in=ended))
+                titles_changed()
                 Alias.objects.create(profile=self.profile,
                                      root=s,
                                      is_title=True,
@@ -958,9 +1007,7 @@ class ProfileDetail(TemplateView):
 
     def get_sheets(self):
         qs = Purchase.objects.all()
-        qs = qs.filter(row__profile=self.profile)
-        qs = qs.annotate(
-            amount=F('kind__unit_price') * F('count'))
+        qs = qs.filter(profile=self.profile)
         qs = qs.annotate(date=F('row__sheet__end_date'))
         qs = qs.annotate(sheet=F('row__sheet_id'))
         qs = qs.annotate(session=F('row__sheet__session_id'))
@@ -1019,6 +1066,12 @@ class ProfileDetail(TemplateView):
             name = 'Email'
             yield date, href, amount, name
 
+    def get_timeline(self):
+        qs = TimelineEntry.objects.filter(profile=self.profile)
+        if not qs.exists():
+            save_timeline(self.profile, self.get_rows())
+        return qs
+
     def get_rows(self):
         sheets, session_start = self.get_sheets()
         transactions = list(self.get_transactions(session_start))
@@ -1026,12 +1079,11 @@ class ProfileDetail(TemplateView):
         # TODO: List SheetStatus, Alias, Title
         return sorted(transactions + sheets + emails, key=lambda x: x[0])
 
-    @tk.set_gfyear(lambda: config.GFYEAR)
     def get_names(self):
         names = []
         for o in self.profile.title_set.all():
             names.append(dict(
-                name=tk.prefix(o),
+                name=title_prefix(o, config.GFYEAR),
                 since='Titel siden %s/%02d' % (o.period, (o.period+1) % 100),
                 period=o.period,
                 remove=None,
@@ -1039,7 +1091,8 @@ class ProfileDetail(TemplateView):
         for o in self.profile.alias_set.all():
             start = o.start_time.date() if o.start_time else 'altid'
             end = o.end_time.date() if o.end_time else 'altid'
-            name = tk.prefix(o, type='unicode') if o.period else o.root
+            name = (title_prefix(o, config.GFYEAR, type='unicode')
+                    if o.period else o.root)
             if o.end_time is None:
                 names.append(dict(
                     name=name,
@@ -1060,7 +1113,7 @@ class ProfileDetail(TemplateView):
         title_qs = title_qs.order_by('-period')
         if title_qs:
             return ('real_title',
-                    tk.prefix(title_qs[0], config.GFYEAR, type='unicode'))
+                    title_prefix(title_qs[0], config.GFYEAR, type='unicode'))
         alias_qs = Alias.objects.filter(profile=self.profile)
         alias_qs = alias_qs.filter(is_title=True, end_time=None)
         alias_qs = alias_qs.order_by()
@@ -1076,26 +1129,107 @@ class ProfileDetail(TemplateView):
         context_data['profile'] = self.profile
         context_data['sheetstatus'] = self.sheetstatus
 
+        try:
+            before = int(self.request.GET['before'])
+        except (KeyError, ValueError):
+            before = None
+        qs = self.get_timeline().order_by('-position')
+        if before is not None:
+            qs = qs.filter(position__lt=before)
+        entries = list(qs[:self.PAGE_SIZE + 1])
+        older = entries[self.PAGE_SIZE:]
+        entries = entries[:self.PAGE_SIZE]
+
         rows = []
-        balance = Decimal()
-        for date, href, amount, name in self.get_rows():
-            if amount is not None:
-                balance += amount
+        for o in entries:
             rows.append(dict(
-                date=date,
-                href=href,
-                name=name,
-                amount=floatformat(amount, 2) if amount is not None else '',
-                balance=floatformat(balance, 2),
+                date=o.date,
+                href=o.href,
+                name=o.name,
+                amount=(floatformat(o.amount, 2)
+                        if o.amount is not None else ''),
+                balance=floatformat(o.balance, 2),
             ))
 
         context_data['rows'] = rows
+        context_data['newer'] = before is not None
+        context_data['older'] = entries[-1].position if older else None
         context_data['names'] = self.get_names()
         alias_key, alias_value = self.get_alias_data()
         context_data[alias_key] = alias_value
         return context_data
 
 
+# Number of fuzzy candidates from the trigram index
+# that are ranked with difflib.
+SEARCH_CANDIDATES = 200
+
+
+def search_profiles(q, only_current, limit=50):
+    '''
+    Return up to `limit` (display, profile) pairs matching q, best first.
+    '''
+    if not q:
+        return
+
+    refresh_search_index()
+    results = []
+
+    entry_qs = SearchEntry.objects.all()
+    if only_current:
+        entry_qs = entry_qs.exclude(profile__sheetstatus=None)
+        entry_qs = entry_qs.filter(profile__sheetstatus__end_time=None)
+    alias_qs = entry_qs.filter(kind=SearchEntry.ALIAS)
+    if only_current:
+        alias_qs = alias_qs.filter(active=True)
+    title_qs = entry_qs.filter(kind=SearchEntry.TITLE)
+    profile_qs = entry_qs.filter(kind=SearchEntry.PROFILE)
+
+    seen = set()
+
+    def add(sort_key, o):
+        if o.pk not in seen:
+            seen.add(o.pk)
+            results.append((sort_key, o))
+
+    for o in alias_qs.filter(key=q.lower()):
+        add((4, o.profile_id), o)
+    for o in title_qs.filter(key=q.lower().replace('$', 's')):
+        add((4, o.profile_id), o)
+    if q.upper() != 'FUAN':
+        fu_ids = Title.objects.filter(kind=Title.FU, root=q.upper())
+        fu_ids = fu_ids.values_list('pk', flat=True)
+        for o in title_qs.filter(object_id__in=list(fu_ids)):
+            add((3, o.profile_id), o)
+    for o in profile_qs.filter(key__contains=q.lower()):
+        if q.lower() in o.key.split():
+            add((3, o.display, o.profile_id), o)
+        else:
+            add((2, o.display, o.profile_id), o)
+
+    grams = trigrams(q)
+    if grams:
+        candidates = (
+            SearchTrigram.objects.filter(trigram__in=grams)
+            .filter(entry__in=alias_qs | profile_qs)
+            .values('entry_id').annotate(n=Count('entry_id'))
+            .order_by('-n')[:SEARCH_CANDIDATES])
+        candidate_ids = [c['entry_id'] for c in candidates]
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(q.lower())
+        for o in SearchEntry.objects.filter(pk__in=candidate_ids):
+            matcher.set_seq1(o.key)
+            add((0, matcher.ratio(), o.display, o.object_id), o)
+
+    results.sort(key=lambda x: x[0], reverse=True)
+    results = results[:limit]
+    profiles = Profile.objects.in_bulk(
+        [o.profile_id for sort_key, o in results])
+    results = [(o.display, profiles[o.profile_id])
+               for sort_key, o in results]
+    return results
+
+
 class ProfileSearch(TemplateView):
     template_name = 'regnskab/profile_search.html'
 
@@ -1103,64 +1237,8 @@ class ProfileSearch(TemplateView):
     def dispatch(self, request, *args, **kwargs):
         return super().dispatch(request, *args, **kwargs)
 
-    @tk.set_gfyear(lambda: config.GFYEAR)
     def get_results(self, q, only_current):
-        if not q:
-            return
-
-        results = []
-
-        matcher = difflib.SequenceMatcher()
-        matcher.set_seq2(q.lower())
-        alias_qs = Alias.objects.all()
-        if only_current:
-            alias_qs = alias_qs.filter(end_time=None)
-            alias_qs = alias_qs.exclude(profile__sheetstatus=None)
-            alias_qs = alias_qs.filter(profile__sheetstatus__end_time=None)
-        for o in alias_qs:
-            input_title = tk.prefix(o) if o.period else o.root
-            if input_title.lower() == q.lower():
-                sort_key = (4, o.profile_id)
-            else:
-                matcher.set_seq1(input_title.lower())
-                sort_key = (0, matcher.ratio(), input_title, o.pk)
-            value = (input_title, o.profile)
-            results.append((sort_key, value))
-
-        title_qs = Title.objects.all()
-        if only_current:
-            title_qs = title_qs.exclude(profile__sheetstatus=None)
-            title_qs = title_qs.filter(profile__sheetstatus__end_time=None)
-        for o in title_qs:
-            input_title = tk.prefix(o) if o.period else o.root
-            if q.upper().replace('$', 'S') == input_title.replace('$', 'S'):
-                sort_key = (4, o.profile_id)
-                value = (input_title, o.profile)
-                results.append((sort_key, value))
-            elif o.kind == Title.FU and q.upper() == o.root != 'FUAN':
-                sort_key = (3, o.profile_id)
-                value = (input_title, o.profile)
-                results.append((sort_key, value))
-
-        profile_qs = Profile.objects.all()
-        if only_current:
-            profile_qs = profile_qs.exclude(sheetstatus=None)
-            profile_qs = profile_qs.filter(sheetstatus__end_time=None)
-        for o in profile_qs:
-            if q.lower() in o.name.lower().split():
-                sort_key = (3, o.name, o.pk)
-            elif q.lower() in o.name.lower():
-                sort_key = (2, o.name, o.pk)
-            else:
-                matcher.set_seq1(o.name.lower())
-                sort_key = (0, matcher.ratio(), o.name, o.pk)
-            value = (o.name, o)
-            results.append((sort_key, value))
-
-        results.sort(reverse=True)
-        results = results[:50]
-        results = [value for sort_key, value in results]
-        return results
+        return search_profiles(q, only_current)
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
@@ -1172,6 +1250,30 @@ class ProfileSearch(TemplateView):
         return context_data
 
 
+class ProfileTypeahead(View):
+    '''
+    The best matches of ?q= among aliases, titles and profile names as JSON.
+    Used by the sheet editor for the fuzzy matches that its own filtering
+    of the profile directory does not find.
+    Only profiles on the sheet are searched unless ?all=1 is given.
+    '''
+
+    LIMIT = 10
+
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request):
+        q = request.GET.get('q', '').strip()
+        only_current = not request.GET.get('all')
+        results = search_profiles(q, only_current, self.LIMIT) or []
+        return JsonResponse(
+            [dict(display=display, name=profile.name, id=profile.pk)
+             for display, profile in results],
+            safe=False)
+
+
 class TransactionBatchCreateBase(FormView):
     form_class = TransactionBatchForm
     template_name = 'regnskab/transaction_batch_create.html'
@@ -1226,6 +1328,7 @@ class TransactionBatchCreateBase(FormView):
         delete = []
 
         now = timezone.now()
+        since = min((o.created_time for o in existing.values()), default=now)
         for profile, amount, selected in form.profile_data():
             if selected:
                 o = Transaction(
@@ -1256,9 +1359,15 @@ class TransactionBatchCreateBase(FormView):
             o.save()
         delete_ids = [o.id for o in delete]
         Transaction.objects.filter(id__in=delete_ids).delete()
+        profile_ids = set(o.profile_id for o in new + save + delete)
+        ledger_changed(profile_ids,
+                       since=since,
+                       periods=set(o.period for o in new + save + delete) |
+                       {self.regnskab_session.period})
 
         if self.regnskab_session.email_template:
-            self.regnskab_session.regenerate_emails()
+            enqueue_regenerate_emails(self.regnskab_session, profile_ids,
+                                      user=self.request.user)
         return self.get_success_view()
 
     def get_period(self):
@@ -1304,7 +1413,7 @@ class PaymentBatchCreate(TransactionBatchCreateBase):
         period = self.get_period()
         time = self.regnskab_session.created_time
 
-        amounts = compute_balance(created_before=time)
+        amounts = get_initial_balances(self.regnskab_session)
         existing_qs = self.get_existing()
         existing = {o.profile_id: o for o in existing_qs}
         for p in get_profiles_title_status(period=period, time=time):
@@ -1427,10 +1536,6 @@ class PaymentPurchaseList(TemplateView):
         profile_sheets = {}
         purchase_qs = Purchase.objects.filter(
             row__sheet__session=self.regnskab_session)
-        purchase_qs = purchase_qs.annotate(
-            amount=F('kind__unit_price') * F('count'))
-        purchase_qs = purchase_qs.annotate(
-            profile_id=F('row__profile_id'))
         purchase_qs = purchase_qs.annotate(
             sheet_id=F('row__sheet_id'))
 
@@ -1440,9 +1545,8 @@ class PaymentPurchaseList(TemplateView):
             x.setdefault(o.sheet_id, []).append(o)
 
         profile_ids = set(payments.keys()) | set(profile_sheets.keys())
-        initial_balances = compute_balance(
-            profile_ids=profile_ids,
-            created_before=self.regnskab_session.created_time)
+        initial_balances = get_initial_balances(
+            self.regnskab_session, profile_ids=profile_ids)
 
         sheet_ids = set(s_id for p_id, sheets in profile_sheets.items()
                         for s_id in sheets.keys())
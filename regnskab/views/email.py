@@ -1,10 +1,14 @@
 import logging
 import itertools
 
-import django.core.mail
 from django.core.exceptions import ValidationError
-from django.http import Http404
+from django.core.urlresolvers import reverse
+from django.db.transaction import atomic
+from django.http import Http404, HttpResponse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from django.shortcuts import redirect, get_object_or_404
 from django.views.generic import (
     View, TemplateView, ListView, CreateView, UpdateView, DetailView, FormView,
@@ -12,12 +16,15 @@ from django.views.generic import (
 
 from regnskab.forms import EmailTemplateForm, AnonymousEmailTemplateForm
 from regnskab.models import (
-    EmailTemplate, Email,
+    EmailTemplate, EmailTemplateInline, Email, CrossesImage,
     Profile, Session,
     get_profiles_title_status, config,
     Newsletter, NewsletterEmail,
+    get_balances, snapshot_initial_balances, timeline_changed,
 )
-from regnskab.images.utils import save_png, png_data_uri
+from regnskab.jobs import enqueue_send_emails, get_unfinished_email_job
+from regnskab.mime import get_crosses_image, send_test_email
+from regnskab.outbox import get_outbox_status
 
 from .auth import regnskab_permission_required_method
 from django.conf import settings
@@ -121,6 +128,7 @@ class NewsletterCreate(FormView):
             period=config.GFYEAR,
             created_by=self.request.user)
         newsletter.save()
+        snapshot_initial_balances(newsletter, balances=get_balances())
         try:
             template.clean()
             newsletter.regenerate_emails()
@@ -209,6 +217,8 @@ class EmailList(EmailListBase):
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
         context_data['session'] = self.regnskab_session
+        context_data['outbox'] = get_outbox_status(
+            session=self.regnskab_session)
         return context_data
 
 
@@ -227,51 +237,6 @@ class NewsletterEmailList(EmailListBase):
         return context_data
 
 
-def get_image_for_emails(emails):
-    import numpy as np
-    import scipy.misc
-
-    assert all(isinstance(email, Email) for email in emails)
-    if not emails:
-        return []
-
-    session = emails[0].session
-    assert all(email.session == session for email in emails)
-    assert all(email.profile_id for email in emails)
-    sheets = session.sheet_set.exclude(row_image=None)
-    sheets = sheets.prefetch_related('sheetrow_set')
-    rows_by_profile = {email.profile_id: [] for email in emails}
-    for sheet in sheets:
-        if not sheet.row_image:
-            continue
-        row_image = scipy.misc.imread(sheet.row_image)
-        for row in sheet.sheetrow_set.all():
-            try:
-                p = rows_by_profile[row.profile_id]
-            except KeyError:
-                continue
-            p.append(row_image[row.image_start:row.image_stop])
-    for email in emails:
-        images = rows_by_profile.pop(email.profile_id)
-        if not images:
-            yield None
-            continue
-        image_width = max(image.shape[1] for image in images)
-        for i, image in enumerate(images):
-            if image.shape[1] < image_width:
-                images[i] = np.pad(
-                    image,
-                    [(0, 0), (0, image_width - image.shape[1])],
-                    'maximum')
-        images_concat = np.concatenate(images)
-        yield images_concat
-
-
-def get_image_for_email(email):
-    result, = get_image_for_emails([email])
-    return result
-
-
 class EmailDetail(DetailView):
     template_name = 'regnskab/email_detail.html'
 
@@ -291,10 +256,12 @@ class EmailDetail(DetailView):
         return context_data
 
     def get_images(self):
-        together = get_image_for_email(self.get_object())
-        if together is not None:
-            png_data = save_png(together)
-            return png_data_uri(png_data)
+        crosses_image = get_crosses_image(self.get_object())
+        if crosses_image.png is not None:
+            return reverse('regnskab:email_crosses_image',
+                           kwargs=dict(pk=self.regnskab_session.pk,
+                                       profile=self.profile.pk,
+                                       key=crosses_image.key))
 
     def get_object(self):
         return get_object_or_404(
@@ -303,6 +270,53 @@ class EmailDetail(DetailView):
             profile_id=self.kwargs['profile'])
 
 
+def immutable_response(content, content_type):
+    '''
+    Response for a URL that contains the hash of its content,
+    which the browser can cache forever.
+    '''
+    response = HttpResponse(content, content_type=content_type)
+    patch_cache_control(response, private=True, immutable=True,
+                        max_age=365 * 24 * 60 * 60)
+    return response
+
+
+class EmailInline(View):
+    '''
+    An EmailTemplateInline, addressed by the hash of its blob.
+    '''
+
+    @regnskab_permission_required_method
+    @method_decorator(condition(etag_func=lambda request, hash: hash))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, hash):
+        inline = EmailTemplateInline.objects.filter(hash=hash).first()
+        if inline is None:
+            raise Http404()
+        return immutable_response(bytes(inline.blob), inline.mime_type)
+
+
+class EmailCrossesImage(View):
+    '''
+    The krydser.png of an email, addressed by the key of the CrossesImage,
+    which changes whenever the image does.
+    '''
+
+    @regnskab_permission_required_method
+    @method_decorator(condition(etag_func=lambda request, **kw: kw['key']))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, pk, profile, key):
+        crosses_image = get_object_or_404(
+            CrossesImage, session_id=pk, profile_id=profile, key=key)
+        if crosses_image.png is None:
+            raise Http404()
+        return immutable_response(bytes(crosses_image.png), 'image/png')
+
+
 class NewsletterEmailDetail(DetailView):
     template_name = 'regnskab/newsletter_email_detail.html'
 
@@ -333,6 +347,10 @@ class EmailSend(View):
 
     def post(self, request, pk, profile=None):
         regnskab_session = get_object_or_404(Session.objects, pk=pk)
+        job = get_unfinished_email_job(regnskab_session)
+        if job is not None:
+            # The emails are out of date; wait for the job.
+            return redirect('regnskab:job_detail', pk=job.pk)
         if profile is None:
             qs = Email.objects.filter(session=regnskab_session)
         else:
@@ -343,17 +361,8 @@ class EmailSend(View):
         if not emails:
             raise Http404()
 
-        messages = [e.to_message() for e in emails]
-        for message, image in zip(messages, get_image_for_emails(emails)):
-            if image is not None:
-                png_data = save_png(image)
-                message.attach('krydser.png', png_data, 'image/png')
-        override_recipient = (len(messages) == 1 and
+        override_recipient = (len(emails) == 1 and
                               self.request.POST.get('override_recipient'))
-        if override_recipient:
-            for m in messages:
-                m.to = [override_recipient]
-        email_backend = django.core.mail.get_connection()
         if profile:
             logger.info("%s: Send email for %s i opgørelse %s til %s",
                         self.request.user, p, regnskab_session.pk,
@@ -361,13 +370,18 @@ class EmailSend(View):
         else:
             logger.info("%s: Send emails i opgørelse %s",
                         self.request.user, regnskab_session.pk)
-        email_backend.send_messages(messages)
         if override_recipient:
+            send_test_email(emails[0], override_recipient)
             return redirect('regnskab:email_list', pk=emails[0].session_id)
-        else:
+        with atomic():
             regnskab_session.send_time = timezone.now()
             regnskab_session.save()
-            return redirect('regnskab:home')
+            job = enqueue_send_emails(regnskab_session, emails,
+                                      user=self.request.user,
+                                      next_url=reverse('regnskab:home'))
+        # The emails now appear on the recipients' timelines.
+        timeline_changed(e.profile_id for e in emails)
+        return redirect('regnskab:job_detail', pk=job.pk)
 
 
 class NewsletterEmailSend(View):
@@ -377,6 +391,10 @@ class NewsletterEmailSend(View):
 
     def post(self, request, pk, profile=None):
         newsletter = get_object_or_404(Newsletter, pk=pk)
+        job = get_unfinished_email_job(newsletter)
+        if job is not None:
+            # The emails are out of date; wait for the job.
+            return redirect('regnskab:job_detail', pk=job.pk)
         if profile is None:
             qs = NewsletterEmail.objects.filter(newsletter=newsletter)
         else:
@@ -388,13 +406,8 @@ class NewsletterEmailSend(View):
         if not emails:
             raise Http404()
 
-        messages = [e.to_message() for e in emails]
-        override_recipient = (len(messages) == 1 and
+        override_recipient = (len(emails) == 1 and
                               self.request.POST.get('override_recipient'))
-        if override_recipient:
-            for m in messages:
-                m.to = [override_recipient]
-        email_backend = django.core.mail.get_connection()
         if profile:
             logger.info("%s: Send email for %s i nyhedsbrev %s til %s",
                         self.request.user, p, newsletter.pk,
@@ -402,8 +415,14 @@ class NewsletterEmailSend(View):
         else:
             logger.info("%s: Send emails i nyhedsbrev %s",
                         self.request.user, newsletter.pk)
-        email_backend.send_messages(messages)
-        if not override_recipient:
+        if override_recipient:
+            send_test_email(emails[0], override_recipient)
+            return redirect('regnskab:newsletter_email_list', pk=pk)
+        with atomic():
             newsletter.send_time = timezone.now()
             newsletter.save()
-        return redirect('regnskab:newsletter_email_list', pk=pk)
+            job = enqueue_send_emails(
+                newsletter, emails, user=self.request.user,
+                next_url=reverse('regnskab:newsletter_email_list',
+                                 kwargs=dict(pk=pk)))
+        return redirect('regnskab:job_detail', pk=job.pk)
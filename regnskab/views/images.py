@@ -8,11 +8,12 @@ from django.core.urlresolvers import reverse
 from django.views.generic import (
     FormView, View, TemplateView,
 )
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, redirect
 from django.utils.html import format_html, format_html_join
 from django.http import HttpResponse
 
-from regnskab.models import SheetImage, Purchase
+from regnskab.models import SheetImage
+from regnskab.jobs import enqueue
 from .auth import regnskab_permission_required_method
 from regnskab.images.quadrilateral import (
     Quadrilateral, extract_quadrilateral,
@@ -20,9 +21,7 @@ from regnskab.images.quadrilateral import (
 from regnskab.images.forms import (
     SheetImageCrossesForm, SheetImageParametersForm,
 )
-from regnskab.images.extract import (
-    extract_images, plot_extract_rows_cols,
-)
+from regnskab.images.extract import plot_extract_rows_cols
 from regnskab.images.utils import png_data_uri
 
 import numpy as np
@@ -155,22 +154,15 @@ class SheetImageParameters(FormView, SheetImageMixin):
         sheet_image = self.get_sheet_image()
         for k in sheet_image.parameters.keys() & form.cleaned_data.keys():
             sheet_image.parameters[k] = form.cleaned_data[k]
-        sheet = sheet_image.sheet
         sheet_image.save()  # Save parameters
-        images, rows, purchases = extract_images(
-            sheet, list(sheet.purchasekind_set.all()))
-        sheet_image, = [im for im in images if im.page == sheet_image.page]
-        sheet_image.set_verified(False)
-        sheet_image.save()  # Save computed values
-        if form.cleaned_data['reset']:
-            sheet.sheetrow_set.all().delete()
-            for o in rows:
-                o.save()
-            for o in purchases:
-                o.row = o.row  # Update row_id
-            Purchase.objects.bulk_create(purchases)
-        return self.render_to_response(
-            self.get_context_data(form=form, saved=True))
+        # The sheet is extracted again by a background job.
+        job = enqueue('extract_sheet_image',
+                      'Sheet:%s' % sheet_image.sheet_id,
+                      dict(sheet_image=sheet_image.pk,
+                           reset=form.cleaned_data['reset']),
+                      user=self.request.user,
+                      next_url=self.request.path)
+        return redirect('regnskab:job_detail', pk=job.pk)
 
 
 def get_sheetimage_cross_classes(qs):
@@ -0,0 +1,56 @@
+from django.http import HttpResponse, JsonResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.views.generic import TemplateView, View
+
+from regnskab.models import Job
+from .auth import regnskab_permission_required_method
+
+
+def job_status(job):
+    return dict(id=job.pk, kind=job.kind, state=job.state,
+                state_display=job.get_state_display(),
+                progress=job.progress, total=job.total,
+                finished=job.finished,
+                next_url=job.next_url if job.state == Job.DONE else '',
+                has_output=bool(job.output_type))
+
+
+class JobDetail(TemplateView):
+    template_name = 'regnskab/job_detail.html'
+
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        self.object = get_object_or_404(Job.objects, pk=kwargs['pk'])
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['job'] = self.object
+        context_data['status'] = job_status(self.object)
+        return context_data
+
+
+class JobStatus(View):
+    '''
+    The state and progress of a job as JSON, polled by job_detail.html.
+    '''
+
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, pk):
+        job = get_object_or_404(Job.objects.defer('output'), pk=pk)
+        return JsonResponse(job_status(job))
+
+
+class JobOutput(View):
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, pk):
+        job = get_object_or_404(Job.objects, pk=pk)
+        if job.output is None:
+            raise Http404()
+        return HttpResponse(bytes(job.output), content_type=job.output_type)
@@ -1,4 +1,3 @@
-import io
 import re
 import random
 import logging
@@ -7,30 +6,24 @@ from decimal import Decimal
 from collections import defaultdict
 
 from django.core.urlresolvers import reverse
-from django.core.exceptions import ValidationError
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse
 from django.conf import settings
 from django.db.models import F, Min
 from django.utils import timezone
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, redirect
 from django.views.generic import FormView
 
-import tktitler as tk
-
 from regnskab.models import (
     Session, Purchase, Transaction, Sheet, PurchaseKind,
-    compute_balance, get_profiles_title_status,
+    get_balances, get_profiles_title_status,
 )
 from regnskab.rules import get_max_debt, get_default_prices
+from regnskab.utils import title_prefix
+from regnskab.fixedpoint import ORE, COUNT, to_fixed, from_fixed
 from regnskab.forms import BalancePrintForm
-from regnskab.texrender import tex_to_pdf, RenderError, pdfnup
+from regnskab.jobs import enqueue
 from .auth import regnskab_permission_required_method
 
-try:
-    from uniprint.api import print_new_document
-except ImportError:
-    from regnskab.texrender import print_new_document
-
 logger = logging.getLogger('regnskab')
 
 
@@ -115,10 +108,9 @@ class BalancePrint(FormView):
         purchase_qs = purchase_qs.annotate(
             name=F('kind__name'),
             sheet_id=F('row__sheet_id'),
-            profile_id=F('row__profile_id'),
             session_id=F('row__sheet__session_id'))
         purchase_qs = purchase_qs.values_list(
-            'sheet_id', 'name', 'profile_id', 'session_id', 'count')
+            'sheet_id', 'name', 'profile', 'session_id', 'count')
 
         kinds = {
             (sheet_id, o.name): o.unit_price
@@ -136,19 +128,29 @@ class BalancePrint(FormView):
         if not prices:
             prices = get_default_prices()
 
-        counts = defaultdict(Decimal)
-        cur_counts = defaultdict(Decimal)
+        # Sum counts in ten-thousandths of a cross and payments in øre
+        # (see regnskab.fixedpoint), converting to Decimal at the end.
+        # Other crates are converted to ølkasser by their price ratio,
+        # which is not a whole number of ten-thousandths, so the ølkasse
+        # column is summed as Decimal and only rounded when displayed.
+        counts = defaultdict(int)
+        cur_counts = defaultdict(int)
+        kasser = defaultdict(Decimal)
+        cur_kasser = defaultdict(Decimal)
 
         for sheet_id, name, profile_id, session_id, count in purchase_qs:
             if name in ('guldølkasse', 'sodavandkasse'):
-                real_name = 'ølkasse'
                 real_count = count * (kinds[sheet_id, name] /
                                       kinds[sheet_id, 'ølkasse'])
+                kasser[profile_id] += real_count
+                if session_id == self.regnskab_session.id:
+                    cur_kasser[profile_id] += real_count
+                continue
             elif name in ('ølkasse', 'ølkasser'):
                 real_name = 'ølkasse'
-                real_count = count
             else:
-                real_name, real_count = name, count
+                real_name = name
+            real_count = to_fixed(count, COUNT)
             counts[profile_id, real_name] += real_count
             if session_id == self.regnskab_session.id:
                 cur_counts[profile_id, real_name] += real_count
@@ -159,16 +161,29 @@ class BalancePrint(FormView):
         period_start_time = timezone.get_current_timezone().localize(
             datetime.datetime.combine(period_start_date, datetime.time()))
         transaction_qs = transaction_qs.filter(time__gte=period_start_time)
-        for o in transaction_qs:
-            if o.kind == Transaction.PAYMENT:
+        transaction_qs = transaction_qs.values_list(
+            'kind', 'profile_id', 'session_id', 'amount')
+        for kind, profile_id, session_id, amount in transaction_qs:
+            amount = to_fixed(amount, ORE)
+            if kind == Transaction.PAYMENT:
                 real_name = 'betalt'
-                amount = -o.amount
+                amount = -amount
             else:
                 real_name = 'andet'
-                amount = o.amount
-            counts[o.profile_id, real_name] += amount
-            if o.session_id == self.regnskab_session.id:
-                cur_counts[o.profile_id, real_name] += amount
+            counts[profile_id, real_name] += amount
+            if session_id == self.regnskab_session.id:
+                cur_counts[profile_id, real_name] += amount
+
+        places = dict(betalt=ORE, andet=ORE)
+        counts = {(p_id, k): from_fixed(v, places.get(k, COUNT))
+                  for (p_id, k), v in counts.items()}
+        cur_counts = {(p_id, k): from_fixed(v, places.get(k, COUNT))
+                      for (p_id, k), v in cur_counts.items()}
+        for p_id, v in kasser.items():
+            counts[p_id, 'ølkasse'] = counts.get((p_id, 'ølkasse'), 0) + v
+        for p_id, v in cur_kasser.items():
+            cur_counts[p_id, 'ølkasse'] = (
+                cur_counts.get((p_id, 'ølkasse'), 0) + v)
 
         context = {}
         for name, unit_price in prices.items():
@@ -199,21 +214,21 @@ class BalancePrint(FormView):
             profiles.insert(0, FORM)
             FORM.name = 'Vinderen'
             FORM.title = None
-        balances = compute_balance()
+        balances = get_balances()
 
         rows = []
         for p in profiles:
             balance = balances.get(p.id, 0)
             context['total_balance'] += balance
             for k in keys:
-                context['total_%s' % k] += counts[p.id, k]
-                context['last_%s' % k] += cur_counts[p.id, k]
+                context['total_%s' % k] += counts.get((p.id, k), 0)
+                context['last_%s' % k] += cur_counts.get((p.id, k), 0)
             p_context = {}
             if p.title:
                 if p.title.period is None:
                     title_str = title_to_tex(p.title.root)
                 else:
-                    title_str = tk.prefix(p.title, period, type='tex')
+                    title_str = title_prefix(p.title, period, type='tex')
                 p_context['name'] = '%s %s' % (title_str, p.name)
             else:
                 p_context['name'] = p.name
@@ -247,43 +262,24 @@ class BalancePrint(FormView):
             return HttpResponse(tex_source,
                                 content_type='text/plain; charset=utf8')
 
-        try:
-            pdf = tex_to_pdf(tex_source)
-        except RenderError as exn:
-            form.add_error(None, str(exn) + ': ' + exn.output)
-            return self.form_invalid(form)
-
-        try:
-            pdf = pdfnup(pdf)
-        except RenderError as exn:
-            form.add_error(None, str(exn) + ': ' + exn.output)
-            return self.form_invalid(form)
-
-        if mode == BalancePrintForm.PDF:
-            return HttpResponse(pdf, content_type='application/pdf')
-
-        if mode != BalancePrintForm.PRINT:
+        if mode not in (BalancePrintForm.PDF, BalancePrintForm.PRINT):
             raise ValueError(mode)
 
-        filename = 'regnskab_%s.pdf' % self.regnskab_session.pk
-        username = self.request.user.username
-        fake = settings.DEBUG
-        try:
-            output = print_new_document(io.BytesIO(pdf),
-                                        filename=filename,
-                                        username=username,
-                                        printer='A2',
-                                        duplex=False, fake=fake)
-        except Exception as exn:
-            if settings.DEBUG and not isinstance(exn, ValidationError):
-                raise
-            form.add_error(None, str(exn))
-            return self.form_invalid(form)
-
-        logger.info("%s: Udskriv opgørelse id=%s på A2",
-                    self.request.user, self.regnskab_session.pk)
-
-        url = reverse('regnskab:session_update',
-                      kwargs=dict(pk=self.regnskab_session.id),
-                      current_app=self.request.resolver_match.namespace)
-        return HttpResponseRedirect(url + '?print=success')
+        # pdflatex and printing run in a background job.
+        print_it = mode == BalancePrintForm.PRINT
+        if print_it:
+            next_url = reverse(
+                'regnskab:session_update',
+                kwargs=dict(pk=self.regnskab_session.id),
+                current_app=self.request.resolver_match.namespace)
+            next_url += '?print=success'
+        else:
+            next_url = ''
+        job = enqueue(
+            'balance_print', 'Session:%s' % self.regnskab_session.pk,
+            dict(session=self.regnskab_session.pk, tex_source=tex_source,
+                 print_it=print_it,
+                 filename='regnskab_%s.pdf' % self.regnskab_session.pk,
+                 fake=settings.DEBUG),
+            coalesce=False, user=self.request.user, next_url=next_url)
+        return redirect('regnskab:job_detail', pk=job.pk)
@@ -6,8 +6,11 @@ import collections
 
 from regnskab.models import (
     Profile, Title, Alias, EmailTemplate, SheetStatus,
-    config, BEST_ORDER,
+    Session, Sheet, SheetRow, PurchaseKind, Purchase,
+    config, BEST_ORDER, titles_changed, rebuild_search_index,
+    get_balances, snapshot_initial_balances, ledger_changed,
 )
+from regnskab.rules import get_default_prices
 from regnskab.legacy.import_sheets import Helper
 
 
@@ -54,7 +57,7 @@ class RandomState:
     def make_aliases(self, n):
         result = {}
         for i in range(n):
-            profile = self.rng.choice(n)
+            profile = int(self.rng.choice(n))
             root = ''.join(self.letter_choice() for _ in range(4))
             result.setdefault(profile, []).append(root)
         return result
@@ -117,7 +120,7 @@ def auto_data(gfyear=None, years=5, best=BEST, n_fu=10, hangarounds=40):
         rng = RandomState(314159)
 
         profiles = []
-        alias_dict = rng.make_aliases(profiles)
+        alias_dict = rng.make_aliases(years * (len(best) + n_fu))
 
         def make(name, root, age, in_current):
             profile = Profile(
@@ -127,7 +130,9 @@ def auto_data(gfyear=None, years=5, best=BEST, n_fu=10, hangarounds=40):
             titles.append(Title(profile=profile, kind=kind,
                                 root=root, period=gfyear - age))
             statuses.append(get_status(profile, in_current))
-            for root in alias_dict.get(len(profiles
+            for alias in alias_dict.get(len(profiles), ()):
+                aliases.append(Alias(profile=profile, root=alias))
+            profiles.append(profile)
 
         for age in range(years):
             for root in best:
@@ -143,13 +148,16 @@ def auto_data(gfyear=None, years=5, best=BEST, n_fu=10, hangarounds=40):
     def make_hangarounds(hangarounds):
         rng = RandomState(3141592)
         profiles = []
-        alias_dict = rng.make_aliases(profiles)
+        alias_dict = rng.make_aliases(hangarounds)
         for i in range(hangarounds):
             profile = Profile(
                 name='Hænger%s Hængersen' % i,
                 email='dummyhangaround%s@example.com' % i)
             if i % 4 < 3:
                 statuses.append(get_status(profile, i % 4 < 2))
+            for alias in alias_dict.get(i, ()):
+                aliases.append(Alias(profile=profile, root=alias))
+            profiles.append(profile)
         return profiles
 
     profiles = make_bestfu(years) + make_hangarounds(hangarounds)
@@ -174,3 +182,76 @@ def generate_auto_data(*args, **kwargs):
     Helper.save_all(aliases, bulk=True)
     Helper.save_all(statuses, bulk=True)
     Helper.save_all(emails, unique_attrs=['name'])
+    titles_changed()
+    rebuild_search_index()
+
+
+ROW_HEIGHT = 40
+ROW_WIDTH = 920
+
+
+def row_image_png(rng, rows):
+    '''
+    A white stitched row image with a grid and random crosses,
+    which compresses about as well as a scanned sheet.
+    '''
+    from regnskab.images.utils import save_png
+
+    im = np.full((rows * ROW_HEIGHT, ROW_WIDTH), 255, dtype=np.uint8)
+    im[::ROW_HEIGHT] = 0
+    im[:, ::ROW_WIDTH // 20] = 0
+    for i in range(rows):
+        for x in rng.rng.choice(ROW_WIDTH - 10, 8):
+            y = i * ROW_HEIGHT + 10
+            for d in range(10):
+                im[y + d, x + d] = im[y + d, x + 9 - d] = 0
+    return save_png(im)
+
+
+def generate_session(members, sheets, seed=2718):
+    '''
+    Create a session of the given number of sheets, each with a row
+    (with an image and random purchases) for each of the given number of
+    members, as input to ./manage.py benchmark_send. The members are made
+    by generate_auto_data().
+    '''
+    from django.core.files.base import ContentFile
+
+    rng = RandomState(seed)
+    extra = max(0, members - 5 * (len(BEST) + 10))
+    generate_auto_data(hangarounds=extra)
+    profiles = list(Profile.objects.order_by('pk')[:members])
+    email_template = EmailTemplate.objects.get(name=EMAIL_NAME)
+    session = Session(period=config.GFYEAR, email_template=email_template)
+    session.save()
+    snapshot_initial_balances(session, balances=get_balances())
+    today = datetime.date.today()
+    for i in range(sheets):
+        sheet = Sheet(name='Benchmark %s' % (i + 1),
+                      start_date=today, end_date=today,
+                      period=config.GFYEAR, session=session,
+                      row_image_width=ROW_WIDTH)
+        sheet.row_image = ContentFile(row_image_png(rng, len(profiles)),
+                                      'benchmark-rows.png')
+        sheet.save()
+        kinds = [PurchaseKind.get_or_create(name=name, position=j + 1,
+                                            unit_price=price)
+                 for j, (name, price) in enumerate(get_default_prices())]
+        for kind in kinds:
+            kind.sheets.add(sheet)
+        rows = [SheetRow(sheet=sheet, profile=profile, name=profile.name,
+                         position=j + 1, image_start=j * ROW_HEIGHT,
+                         image_stop=(j + 1) * ROW_HEIGHT)
+                for j, profile in enumerate(profiles)]
+        purchases = []
+        for row in rows:
+            row.save()
+            for kind in kinds:
+                count = int(rng.rng.poisson(2))
+                if count:
+                    purchases.append(Purchase(row=row, kind=kind,
+                                              count=count))
+                    purchases[-1].set_amount()
+        Purchase.objects.bulk_create(purchases)
+    ledger_changed([p.id for p in profiles], periods=(config.GFYEAR,))
+    return session
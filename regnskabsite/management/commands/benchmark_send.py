@@ -0,0 +1,180 @@
+import sys
+import json
+import threading
+import contextlib
+
+import django.core.mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db.transaction import atomic, set_rollback
+from django.utils import timezone
+
+from regnskab.benchmark import best_of
+from regnskab.images import cache as row_image_cache
+from regnskab.mime import update_crosses_images, build_messages
+from regnskab.models import (
+    Email, CrossesImage, OutboxMessage, regenerate_emails, regenerate_email,
+)
+from regnskab.outbox import queue_raw_messages, process_outbox
+from regnskabsite.fixtures import generate_session
+
+
+@contextlib.contextmanager
+def smtp_server():
+    '''
+    Run a local SMTP server that accepts and discards every message,
+    like smtpd.DebuggingServer without the printing, and yield its port.
+    '''
+    import smtpd
+    import asyncore
+
+    class Server(smtpd.SMTPServer):
+        def process_message(self, *args, **kwargs):
+            pass
+
+    server = Server(('127.0.0.1', 0), None, decode_data=False)
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs=dict(timeout=0.1), daemon=True)
+    thread.start()
+    try:
+        yield server.socket.getsockname()[1]
+    finally:
+        server.close()
+        thread.join()
+
+
+def get_phases(session, connection):
+    '''
+    Return (name, fn, setup) of each phase of rendering and sending the
+    emails of the session, in the order EmailSend and the send_emails job
+    run them. Each phase uses the results of the previous ones.
+    '''
+    state = {}
+
+    def recipient_data():
+        state['data'] = session.get_recipient_data()
+
+    def render():
+        session._templates = session.email_template.compile()
+        return [regenerate_email(session, d) for d in state['data'].values()]
+
+    def delete_emails():
+        Email.objects.filter(session=session).delete()
+
+    def regenerate():
+        regenerate_emails(session)
+        state['emails'] = list(session.email_set.select_related('profile'))
+
+    def clear_crosses_images():
+        CrossesImage.objects.filter(session=session).delete()
+        row_image_cache.clear()
+
+    def to_message():
+        return [e.to_message().message().as_bytes() for e in state['emails']]
+
+    def build():
+        # In this process, since forking worker processes would close the
+        # database connection and with it the rolled back transaction.
+        state['items'] = list(build_messages(state['emails'], workers=1))
+
+    def delete_outbox():
+        OutboxMessage.objects.filter(session=session).delete()
+
+    def queue():
+        state['ids'] = [o.pk for o in queue_raw_messages(
+            state['items'], session, [e.profile for e in state['emails']])]
+
+    def reset_outbox():
+        OutboxMessage.objects.filter(pk__in=state['ids']).update(
+            state=OutboxMessage.PENDING, attempts=0, sent_time=None)
+        django.core.mail.outbox = []
+
+    def send():
+        metrics = process_outbox(ids=state['ids'], connection=connection,
+                                 backoff=0)
+        if metrics['sent'] != len(state['ids']):
+            errors = OutboxMessage.objects.filter(
+                pk__in=state['ids']).exclude(last_error='')
+            raise CommandError('Sent %s of %s: %s' % (
+                metrics['sent'], len(state['ids']),
+                errors.values_list('last_error', flat=True).first()))
+
+    return [
+        ('recipient_data', recipient_data, None),
+        ('render', render, None),
+        ('regenerate_emails', regenerate, delete_emails),
+        ('crosses_images', lambda: update_crosses_images(session),
+         clear_crosses_images),
+        ('crosses_images_stored', lambda: update_crosses_images(session),
+         None),
+        ('to_message', to_message, None),
+        ('build_messages', build, None),
+        ('queue', queue, delete_outbox),
+        ('send', send, reset_outbox),
+    ]
+
+
+class Command(BaseCommand):
+    help = ('Time each phase of rendering and sending the emails of a ' +
+            'synthetic session with the given number of members and ' +
+            'sheets, through the locmem email backend or a local SMTP ' +
+            'server. The session is rolled back afterwards. ' +
+            'With --json, the results are appended to a file as one JSON ' +
+            'object per line, so they can be compared over time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--members', type=int, default=200)
+        parser.add_argument('-s', '--sheets', type=int, default=4)
+        parser.add_argument('-r', '--repeat', type=int, default=3)
+        parser.add_argument('-b', '--backend', choices=('locmem', 'smtp'),
+                            default='locmem')
+        parser.add_argument('--json', metavar='FILE',
+                            help='Append the results to FILE ("-" for ' +
+                            'standard output)')
+
+    def handle(self, *args, **options):
+        with contextlib.ExitStack() as stack:
+            if options['backend'] == 'smtp':
+                port = stack.enter_context(smtp_server())
+                connection = django.core.mail.get_connection(
+                    'django.core.mail.backends.smtp.EmailBackend',
+                    host='127.0.0.1', port=port, username='', password='',
+                    use_tls=False, use_ssl=False)
+            else:
+                connection = django.core.mail.get_connection(
+                    'django.core.mail.backends.locmem.EmailBackend')
+            results = self.run(connection, options)
+        if options['json'] == '-':
+            self.stdout.write(json.dumps(results, sort_keys=True))
+            return
+        self.stdout.write('%(members)s medlemmer, %(sheets)s krydslister, '
+                          '%(emails)s emails, %(backend)s' % results)
+        for r in results['phases']:
+            self.stdout.write('%(name)-22s %(seconds)8.4f s  '
+                              '%(per_second)8.1f/s' % r)
+        if options['json']:
+            with open(options['json'], 'a') as fp:
+                fp.write(json.dumps(results, sort_keys=True) + '\n')
+
+    def run(self, connection, options):
+        results = dict(
+            time=timezone.now().isoformat(),
+            python=sys.version.split()[0],
+            members=options['members'],
+            sheets=options['sheets'],
+            repeat=options['repeat'],
+            backend=options['backend'])
+        with atomic():
+            session = generate_session(options['members'], options['sheets'])
+            try:
+                times = [(name, best_of(fn, options['repeat'], setup)[0])
+                         for name, fn, setup in get_phases(session,
+                                                           connection)]
+                n = results['emails'] = session.email_set.count()
+                results['phases'] = [
+                    dict(name=name, seconds=t, per_second=n / t if t else 0)
+                    for name, t in times]
+            finally:
+                for sheet in session.sheet_set.all():
+                    sheet.row_image.delete(save=False)
+                set_rollback(True)
+        return results
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db.transaction import atomic, set_rollback
+from django.utils import timezone
+
+from regnskab.benchmark import best_of
+from regnskab.models import (
+    Profile, config, get_profiles_title_status, titles_changed,
+)
+from regnskabsite.fixtures import generate_auto_data
+
+
+class Command(BaseCommand):
+    help = ('Time get_profiles_title_status() with and without the title ' +
+            'index on a synthetic membership. The generated data is ' +
+            'rolled back afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-y', '--years', type=int, default=50)
+        parser.add_argument('-r', '--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        with atomic():
+            generate_auto_data(years=options['years'])
+            self.stdout.write('%s profiles' % Profile.objects.count())
+            cases = [
+                ('current', {}),
+                ('period', dict(period=config.GFYEAR - 1)),
+                ('period+time', dict(period=config.GFYEAR - 1,
+                                     time=timezone.now())),
+            ]
+            for name, kwargs in cases:
+                def uncached():
+                    titles_changed()
+                    return get_profiles_title_status(**kwargs)
+
+                t_miss, r_miss = best_of(uncached, repeat)
+                t_hit, r_hit = best_of(
+                    lambda: get_profiles_title_status(**kwargs), repeat)
+                same = ([(p.id, p.title_name, p.in_current) for p in r_miss] ==
+                        [(p.id, p.title_name, p.in_current) for p in r_hit])
+                self.stdout.write(
+                    '%-12s miss %8.4f s  hit %8.4f s  %7.1fx  %s' %
+                    (name, t_miss, t_hit, t_miss / t_hit,
+                     'same' if same else 'DIFFERENT'))
+            set_rollback(True)
+        titles_changed()
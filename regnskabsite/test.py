@@ -1,10 +1,11 @@
 import os
 import time
 import traceback
+from urllib.parse import urlparse
 
 import django
 from django.test import Client
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, resolve
 
 
 def get_sent_session():
@@ -51,6 +52,7 @@ def main():
                       (response.status_code, code), flush=True)
             else:
                 print('OK (%s)' % code, flush=True)
+            return response
 
     assert_get('/admin/login/', dict(username='rav', password='hej'), code=302)
 
@@ -81,7 +83,15 @@ def main():
     assert_get('payment_purchase_list', pk=sent_session.pk)
     assert_get('profile_list')
     assert_get('balance_print', dict(mode='source'), pk=fresh_session.pk)
-    assert_get('balance_print', dict(mode='pdf'), pk=sent_session.pk)
+    response = assert_get('balance_print', dict(mode='pdf'), code=302,
+                          pk=sent_session.pk)
+    if response is not None and response.status_code == 302:
+        # The PDF is rendered by a job; run it and fetch the result.
+        from regnskab.jobs import work
+        work(once=True)
+        # The test client makes the Location header absolute.
+        job_path = urlparse(response.url).path
+        assert_get('job_output', **resolve(job_path).kwargs)
 
 
 